@@ -3,6 +3,10 @@ import os
 import sys
 
 if __name__ == "__main__":
+    # The omrs commands run with the minimal command-line settings profile
+    commands_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'omrs', 'management', 'commands')
+    if len(sys.argv) > 1 and os.path.exists(os.path.join(commands_dir, sys.argv[1] + '.py')):
+        os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omrs.settings_cli")
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "omrs.settings")
 
     from django.core.management import execute_from_command_line
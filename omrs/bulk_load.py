@@ -0,0 +1,171 @@
+"""
+Bulk loading of the concept dictionary tables with LOAD DATA LOCAL INFILE.
+
+TableFile writes the rows of one table as a tab-separated file in the format that LOAD DATA
+reads by default (backslash escapes, \\N for NULL). Its columns are the model's fields, and
+values that are not given take the field default, as an ORM save would. Primary keys are
+assigned by the caller, so rows can reference each other before anything is loaded.
+
+load_table_files() loads the files in a single transaction on a session with foreign key and
+unique checks switched off, then runs verify_integrity() over the loaded rows before
+committing: every foreign key must point at an existing row, no unique column may hold a
+duplicate and each table must hold the number of rows written. Any problem rolls the whole
+load back.
+
+LOAD DATA LOCAL lets the server ask the client for any file it can read, so it is enabled only
+on the connection that load_table_files() opens for the load, never on the Django connections.
+"""
+import datetime
+import os
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from omrs.models import (Concept, ConceptAnswer, ConceptDescription, ConceptName, ConceptNumeric,
+                         ConceptReferenceMap, ConceptReferenceTerm, ConceptSet)
+
+
+# Tables written by a bulk load, in load order
+BULK_LOAD_MODELS = (
+    Concept,
+    ConceptName,
+    ConceptDescription,
+    ConceptNumeric,
+    ConceptReferenceTerm,
+    ConceptReferenceMap,
+    ConceptAnswer,
+    ConceptSet,
+)
+
+TSV_ESCAPES = (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r'), ('\0', '\\0'))
+
+
+class BulkLoadError(Exception):
+    """ BulkLoadError """
+    pass
+
+
+def tsv_value(value):
+    """ Returns value formatted as a LOAD DATA field """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, datetime.datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    else:
+        value = str(value)
+    for char, escaped in TSV_ESCAPES:
+        value = value.replace(char, escaped)
+    return value
+
+
+class TableFile(object):
+    """ Writes the rows of one model's table to a TSV file for LOAD DATA """
+
+    def __init__(self, directory, model):
+        self.model = model
+        self.table = model._meta.db_table
+        self.fields = model._meta.fields
+        self.filename = os.path.join(directory, self.table + '.tsv')
+        self.fp = open(self.filename, 'wb')
+        self.count = 0
+        # Range of the primary keys written, used to select the loaded rows when verifying
+        self.min_pk = None
+        self.max_pk = None
+
+    def write(self, **values):
+        """ Writes one row, given as field attribute names (e.g. concept_id) and values """
+        pk = values[self.model._meta.pk.attname]
+        self.min_pk = pk if self.min_pk is None else min(self.min_pk, pk)
+        self.max_pk = pk if self.max_pk is None else max(self.max_pk, pk)
+        row = [values[field.attname] if field.attname in values else field.get_default() for field in self.fields]
+        self.fp.write('\t'.join(tsv_value(value) for value in row) + '\n')
+        self.count += 1
+
+    def close(self):
+        self.fp.close()
+
+    def load_sql(self):
+        columns = ', '.join('`%s`' % field.column for field in self.fields)
+        return "LOAD DATA LOCAL INFILE %%s INTO TABLE `%s` CHARACTER SET utf8 (%s)" % (self.table, columns)
+
+
+def open_load_connection(using=DEFAULT_DB_ALIAS):
+    """ Opens a MySQL connection of its own, with LOAD DATA LOCAL INFILE enabled, to the database using """
+    connection = connections[using]
+    params = connection.get_connection_params()
+    params['local_infile'] = 1
+    return connection.get_new_connection(params)
+
+
+def load_table_files(table_files, using=DEFAULT_DB_ALIAS):
+    """
+    Loads the table files in one transaction with foreign key and unique checks deferred to
+    verify_integrity(), and returns a dictionary of table name to rows loaded.
+
+    Raises BulkLoadError, after rolling the load back, if the loaded rows fail verification.
+    """
+    load_connection = open_load_connection(using)
+    loaded = {}
+    try:
+        load_connection.autocommit(False)
+        cursor = load_connection.cursor()
+        cursor.execute('SET foreign_key_checks = 0, unique_checks = 0')
+        try:
+            for table_file in table_files:
+                if table_file.count:
+                    cursor.execute(table_file.load_sql(), [os.path.abspath(table_file.filename)])
+                    loaded[table_file.table] = cursor.rowcount
+        finally:
+            cursor.execute('SET foreign_key_checks = 1, unique_checks = 1')
+        problems = verify_integrity(table_files, loaded, cursor)
+        if problems:
+            raise BulkLoadError('Bulk load rolled back, the loaded rows failed verification:\n%s' %
+                                '\n'.join(problems))
+        load_connection.commit()
+    finally:
+        # Closing the connection without a commit rolls the load back
+        load_connection.close()
+    return loaded
+
+
+def verify_integrity(table_files, loaded, cursor):
+    """ Returns a list of problems found in the rows loaded from table_files, queried with cursor """
+    problems = []
+    for table_file in table_files:
+        if not table_file.count:
+            continue
+        model = table_file.model
+        pk_column = model._meta.pk.column
+        in_range = 'c.`%s` BETWEEN %%s AND %%s' % pk_column
+        pk_range = [table_file.min_pk, table_file.max_pk]
+
+        if loaded.get(table_file.table) != table_file.count:
+            problems.append('%s: %d rows written, %s loaded' % (
+                table_file.table, table_file.count, loaded.get(table_file.table)))
+
+        for field in table_file.fields:
+            if field.rel is not None:
+                parent = field.rel.to
+                parent_column = field.rel.get_related_field().column
+                cursor.execute(
+                    'SELECT COUNT(*) FROM `%s` c LEFT JOIN `%s` p ON p.`%s` = c.`%s` '
+                    'WHERE c.`%s` IS NOT NULL AND p.`%s` IS NULL AND %s' % (
+                        table_file.table, parent._meta.db_table, parent_column, field.column,
+                        field.column, parent_column, in_range), pk_range)
+                orphans = cursor.fetchone()[0]
+                if orphans:
+                    problems.append('%s.%s: %d rows reference a missing %s' % (
+                        table_file.table, field.column, orphans, parent._meta.db_table))
+            elif field.unique and not field.primary_key:
+                cursor.execute(
+                    'SELECT COUNT(*) FROM `%s` c JOIN `%s` d ON d.`%s` = c.`%s` AND d.`%s` <> c.`%s` '
+                    'WHERE %s' % (table_file.table, table_file.table, field.column, field.column,
+                                  pk_column, pk_column, in_range), pk_range)
+                duplicates = cursor.fetchone()[0]
+                if duplicates:
+                    problems.append('%s.%s: %d loaded rows duplicate an existing value' % (
+                        table_file.table, field.column, duplicates))
+    return problems
@@ -0,0 +1,129 @@
+"""
+Cached lookup of concepts serialized in the OCL export format.
+
+ConceptLookupService serializes a concept, its mappings (including linked answers) and its set
+members with the same code as extract_db, and keeps the serialized JSON in an in-process LRU
+cache together with an ETag for each document. Multi-get requests load all cache misses as row
+records, with one query per table for each chunk of IDs.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import threading
+import time
+
+from omrs.models import Concept
+from omrs.management.commands import chunks
+
+
+# Documents cached for each concept
+CONCEPT_DOCUMENT = 'concept'
+MAPPINGS_DOCUMENT = 'mappings'
+SET_MEMBERS_DOCUMENT = 'set_members'
+
+
+def make_etag(body):
+    """ Returns a strong ETag for a response body """
+    return '"%s"' % hashlib.md5(body).hexdigest()
+
+
+class LruCache(object):
+    """ Thread-safe least-recently-used cache with a maximum size and an entry lifetime """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """ Returns the cached value for key, or None if it is missing or expired """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            # Re-insert to mark the entry as most recently used
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.ttl, value)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class ConceptLookupService(object):
+    """ Serves serialized concepts, mappings and set members from an LRU cache """
+
+    def __init__(self, org_id, source_id, cache_size, cache_ttl):
+        self.org_id = org_id
+        self.source_id = source_id
+        # concept_id -> {document: (json, etag)}
+        self.documents = LruCache(cache_size, cache_ttl)
+        # uuid -> concept_id
+        self.uuids = LruCache(cache_size, cache_ttl)
+
+    def get_exporter(self):
+        """ Returns an extract_db command set up to serialize concepts for this org and source """
+        from omrs.management.commands.extract_db import Command as ExtractDbCommand
+        exporter = ExtractDbCommand()
+        exporter.init_exporter(self.org_id, self.source_id)
+        return exporter
+
+    def serialize(self, exporter, concept):
+        """ Returns the cached documents of a concept: {document: (json, etag)} """
+        mappings = exporter.export_concept_mappings(concept) + exporter.export_concept_qanda(concept)
+        documents = {}
+        for document, data in ((CONCEPT_DOCUMENT, exporter.export_concept(concept)),
+                               (MAPPINGS_DOCUMENT, mappings),
+                               (SET_MEMBERS_DOCUMENT, exporter.export_concept_set_members(concept))):
+            body = json.dumps(data)
+            documents[document] = (body, make_etag(body))
+        return documents
+
+    def get_many(self, concept_ids):
+        """
+        Returns a dictionary of concept_id to cached documents for the concepts in concept_ids
+        that exist. Cache misses are fetched and serialized in bulk.
+        """
+        found = {}
+        misses = []
+        for concept_id in concept_ids:
+            documents = self.documents.get(concept_id)
+            if documents is None:
+                misses.append(concept_id)
+            else:
+                found[concept_id] = documents
+        if misses:
+            exporter = self.get_exporter()
+            for chunk in chunks(misses):
+                for concept in exporter.fetch_concepts(chunk):
+                    documents = self.serialize(exporter, concept)
+                    self.documents.set(concept.concept_id, documents)
+                    found[concept.concept_id] = documents
+        return found
+
+    def get(self, concept_id):
+        """ Returns the cached documents for one concept, or None if it does not exist """
+        return self.get_many([concept_id]).get(concept_id)
+
+    def get_concept_id_for_uuid(self, uuid):
+        """ Returns the concept_id of the concept with uuid, or None if there is none """
+        concept_id = self.uuids.get(uuid)
+        if concept_id is None:
+            concept_ids = list(Concept.objects.filter(uuid=uuid).values_list('concept_id', flat=True)[:1])
+            if not concept_ids:
+                return None
+            concept_id = concept_ids[0]
+            self.uuids.set(uuid, concept_id)
+        return concept_id
@@ -0,0 +1,111 @@
+"""
+Persistent cache of exported OCL records for extract_db.
+
+Each concept's exported concept record and mapping records are stored in a SQLite file,
+keyed by org, source and concept_id, together with a fingerprint of the rows they were built
+from. The fingerprint covers the concept's date_changed / date_retired and the newest
+date_created / date_changed (and row count) of its names, descriptions, reference maps,
+answers and set members, so a cached record is reused only while none of these has changed.
+"""
+import hashlib
+import json
+import sqlite3
+
+from django.db.models import Count, Max
+
+from omrs.models import (Concept, ConceptAnswer, ConceptDescription, ConceptName, ConceptReferenceMap,
+                         ConceptSet)
+from omrs.streaming import stream_values
+
+
+# Bump when the layout of exported records changes so that old cache entries are ignored
+CACHE_FORMAT_VERSION = 1
+
+# Related rows aggregated into each concept's fingerprint: (model, concept field, date fields)
+FINGERPRINT_RELATIONS = (
+    (ConceptName, 'concept', ('date_created', 'date_voided')),
+    (ConceptDescription, 'concept', ('date_created', 'date_changed')),
+    (ConceptReferenceMap, 'concept', ('date_created', 'date_changed', 'concept_reference_term__date_changed')),
+    (ConceptAnswer, 'question_concept', ('date_created',)),
+    (ConceptSet, 'concept_set_owner', ('date_created',)),
+)
+
+
+def compute_fingerprints(concept_ids=None, concept_limit=None):
+    """
+    Returns a dictionary of concept_id to fingerprint for the selected concepts.
+
+    Uses one query on concept plus one grouped aggregate query per related table.
+    :param concept_ids: Only fingerprint these concepts, if set.
+    :param concept_limit: Only fingerprint concepts with concept_id <= concept_limit, if set.
+    """
+    def restrict(queryset, field):
+        if concept_ids is not None:
+            queryset = queryset.filter(**{field + '__in': concept_ids})
+        if concept_limit is not None:
+            queryset = queryset.filter(**{field + '__lte': concept_limit})
+        return queryset
+
+    parts = {}
+    concepts = restrict(Concept.objects.all(), 'concept_id')
+    for row in stream_values(concepts, 'concept_id', 'retired', 'date_created', 'date_changed', 'date_retired'):
+        parts[row[0]] = [CACHE_FORMAT_VERSION, row[1:]]
+
+    for model, concept_field, date_fields in FINGERPRINT_RELATIONS:
+        aggregates = dict(('max_%d' % n, Max(field)) for n, field in enumerate(date_fields))
+        rows = restrict(model.objects.all(), concept_field).values(concept_field).annotate(
+            row_count=Count(model._meta.pk.name), **aggregates)
+        for row in rows:
+            if row[concept_field] in parts:
+                parts[row[concept_field]].append(
+                    (model._meta.db_table, row['row_count']) +
+                    tuple(row['max_%d' % n] for n in range(len(date_fields))))
+
+    return dict((concept_id, hashlib.md5(repr(concept_parts)).hexdigest())
+                for concept_id, concept_parts in parts.iteritems())
+
+
+class ExportCache(object):
+    """ SQLite-backed store of exported records, scoped to one org and source """
+
+    def __init__(self, filename, org_id, source_id):
+        self.org_id = org_id
+        self.source_id = source_id
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS export_cache ('
+            'org_id TEXT, source_id TEXT, concept_id INTEGER, fingerprint TEXT, '
+            'concept_json TEXT, mappings_json TEXT, counters_json TEXT, '
+            'PRIMARY KEY (org_id, source_id, concept_id))')
+
+    def get_many(self, concept_ids, fingerprints):
+        """
+        Returns a dictionary of concept_id to (concept_json, mapping_json_lines, counters) for
+        the concepts whose cached fingerprint matches the current one.
+        """
+        cached = {}
+        if not concept_ids:
+            return cached
+        cursor = self.connection.execute(
+            'SELECT concept_id, fingerprint, concept_json, mappings_json, counters_json FROM export_cache '
+            'WHERE org_id = ? AND source_id = ? AND concept_id IN (%s)' % ', '.join('?' * len(concept_ids)),
+            [self.org_id, self.source_id] + list(concept_ids))
+        for concept_id, fingerprint, concept_json, mappings_json, counters_json in cursor:
+            if fingerprints.get(concept_id) == fingerprint:
+                mapping_lines = mappings_json.split('\n') if mappings_json else []
+                cached[concept_id] = (concept_json, mapping_lines, json.loads(counters_json))
+        return cached
+
+    def set(self, concept_id, fingerprint, concept_data, mapping_data, counters):
+        """ Stores the exported records and counter increments for a concept """
+        self.connection.execute(
+            'INSERT OR REPLACE INTO export_cache VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self.org_id, self.source_id, concept_id, fingerprint, json.dumps(concept_data),
+             '\n'.join(json.dumps(map_dict) for map_dict in mapping_data), json.dumps(counters)))
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,60 @@
+"""
+SQL filters for subset exports.
+
+ExportFilter turns the subset options of extract_db into query predicates, so that only the
+selected rows are read: concept class, datatype and retired status restrict the concept query;
+locales restrict the name and description queries; map sources restrict the reference map
+query, and answers and set members are only read when the export's own source is selected.
+"""
+
+
+def split_option(value):
+    """ Returns the comma-separated values of an option, or None if it is not set """
+    if not value:
+        return None
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+
+class ExportFilter(object):
+    """ Query predicates for the concepts and related rows selected for export """
+
+    def __init__(self, retired_only=False, classes=None, datatypes=None, locales=None, map_sources=None,
+                 own_source=None):
+        self.retired_only = retired_only
+        self.classes = classes
+        self.datatypes = datatypes
+        self.locales = locales
+        self.map_sources = map_sources
+        # Source that Q-AND-A and CONCEPT-SET mappings, which are always internal, belong to
+        self.own_source = own_source
+
+    def filters_concepts(self):
+        """ Returns True if the filter excludes some concepts """
+        return bool(self.retired_only or self.classes or self.datatypes)
+
+    def filters_records(self):
+        """ Returns True if the filter changes the content of exported concept and mapping records """
+        return bool(self.locales or self.map_sources)
+
+    def filter_concepts(self, queryset):
+        """ Applies the concept-level predicates to a Concept queryset """
+        if self.retired_only:
+            queryset = queryset.filter(retired=True)
+        if self.classes:
+            queryset = queryset.filter(concept_class__name__in=self.classes)
+        if self.datatypes:
+            queryset = queryset.filter(datatype__name__in=self.datatypes)
+        return queryset
+
+    def relation_lookups(self, relation):
+        """
+        Returns the lookups restricting the rows of a ConceptRecord relation (see omrs.rows),
+        or None if the relation is not needed at all.
+        """
+        if relation in ('names', 'descriptions') and self.locales:
+            return {'locale__in': self.locales}
+        if relation == 'reference_maps' and self.map_sources:
+            return {'concept_reference_term__concept_source__name__in': self.map_sources}
+        if relation in ('answers', 'set_members') and self.map_sources and self.own_source not in self.map_sources:
+            return None
+        return {}
@@ -0,0 +1,124 @@
+"""
+Compact sets of integer IDs for reconciling an export against the database.
+
+OpenMRS primary keys are auto-increment integers, so the IDs of a table are dense over a
+range. IdBitmap stores such a set as one bit per ID of that range: the 170,000 concept IDs
+of a CIEL dictionary take about 21 KB, where a dictionary of ID strings takes tens of MB.
+Membership, add and discard are constant time, and iteration yields the IDs in order.
+
+The IDs of an export are not bounded like that: one stray ID of 10**9 would make a bitmap of
+125 MB. RangeIdSet keeps such IDs in a bitmap only within the range of the table's IDs, and
+any others in a set.
+"""
+import heapq
+
+# Offsets of the set bits of every byte value, so iteration skips whole empty bytes
+BYTE_BITS = tuple(tuple(bit for bit in range(8) if value >> bit & 1) for value in range(256))
+
+
+def parse_id(value):
+    """ Returns value (e.g. an OCL concept ID) as an integer ID, or None if it is not one written as such """
+    try:
+        id = int(value)
+    except (TypeError, ValueError):
+        return None
+    # '012' or ' 12' name another OCL ID than '12'
+    return id if id >= 0 and str(id) == str(value) else None
+
+
+class IdBitmap(object):
+    """ Set of non-negative integer IDs stored as a bitmap over the range of the IDs """
+
+    def __init__(self, ids=()):
+        # base is the ID of the first bit, a multiple of 8 so the bitmap can grow downwards by whole bytes
+        self.base = None
+        self.bits = bytearray()
+        self.count = 0
+        for id in ids:
+            self.add(id)
+
+    def _grow(self, id):
+        """ Extends the bitmap to cover id, doubling its size so streams of IDs grow it in amortized O(1) """
+        if self.base is None:
+            self.base = id & ~7
+            self.bits = bytearray(1)
+        elif id < self.base:
+            base = min(id & ~7, max(0, self.base - (len(self.bits) << 3)))
+            self.bits[0:0] = bytearray((self.base - base) >> 3)
+            self.base = base
+        offset = id - self.base
+        if offset >> 3 >= len(self.bits):
+            self.bits.extend(bytearray(max((offset >> 3) + 1 - len(self.bits), len(self.bits))))
+
+    def add(self, id):
+        if id < 0:
+            raise ValueError('IDs must not be negative: %s' % id)
+        if self.base is None or id < self.base or (id - self.base) >> 3 >= len(self.bits):
+            self._grow(id)
+        offset = id - self.base
+        mask = 1 << (offset & 7)
+        if not self.bits[offset >> 3] & mask:
+            self.bits[offset >> 3] |= mask
+            self.count += 1
+
+    def discard(self, id):
+        if id in self:
+            offset = id - self.base
+            self.bits[offset >> 3] &= ~(1 << (offset & 7)) & 0xff
+            self.count -= 1
+
+    def __contains__(self, id):
+        if self.base is None or id < self.base:
+            return False
+        offset = id - self.base
+        return offset >> 3 < len(self.bits) and bool(self.bits[offset >> 3] & (1 << (offset & 7)))
+
+    def __len__(self):
+        return self.count
+
+    def bounds(self):
+        """ Returns the (smallest, largest) IDs the bitmap has room for, or None if it is empty """
+        if self.base is None:
+            return None
+        return self.base, self.base + (len(self.bits) << 3) - 1
+
+    def __iter__(self):
+        """ Yields the IDs in ascending order """
+        for index, value in enumerate(self.bits):
+            if value:
+                start = self.base + (index << 3)
+                for bit in BYTE_BITS[value]:
+                    yield start + bit
+
+
+class RangeIdSet(object):
+    """ Set of non-negative integer IDs kept in an IdBitmap within bounds (smallest, largest) and in a set outside them """
+
+    def __init__(self, bounds=None, ids=()):
+        self.low, self.high = bounds or (0, -1)
+        self.bitmap = IdBitmap()
+        self.others = set()
+        for id in ids:
+            self.add(id)
+
+    def add(self, id):
+        if self.low <= id <= self.high:
+            self.bitmap.add(id)
+        elif id < 0:
+            raise ValueError('IDs must not be negative: %s' % id)
+        else:
+            self.others.add(id)
+
+    def discard(self, id):
+        self.bitmap.discard(id)
+        self.others.discard(id)
+
+    def __contains__(self, id):
+        return id in self.bitmap or id in self.others
+
+    def __len__(self):
+        return len(self.bitmap) + len(self.others)
+
+    def __iter__(self):
+        """ Yields the IDs in ascending order """
+        return heapq.merge(self.bitmap, sorted(self.others))
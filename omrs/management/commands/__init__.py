@@ -1,4 +1,39 @@
 """ Init for commands """
+import os
+
+# Maximum number of values passed to a single SQL "IN (...)" clause
+IN_QUERY_CHUNK_SIZE = 500
+
+
+def chunks(values, size=IN_QUERY_CHUNK_SIZE):
+    """ Yields successive lists of at most 'size' items from 'values' """
+    chunk = []
+    for value in values:
+        chunk.append(value)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_concept_ids(value):
+    """
+    Returns the list of integer concept IDs in value, which is either a comma-separated list
+    (e.g. 5839,1065) or the name of a file of IDs separated by commas or whitespace.
+    Duplicate IDs are dropped, keeping the first occurrence. Raises ValueError for a bad ID.
+    """
+    if os.path.isfile(value):
+        with open(value, 'r') as fp:
+            value = fp.read()
+    concept_ids = []
+    seen = set()
+    for token in value.replace(',', ' ').split():
+        concept_id = int(token)
+        if concept_id not in seen:
+            seen.add(concept_id)
+            concept_ids.append(concept_id)
+    return concept_ids
 
 
 class UnrecognizedSourceException(Exception):
@@ -13,6 +48,13 @@ class OclOpenmrsHelper(object):
     MAP_TYPE_CONCEPT_SET = 'CONCEPT-SET'
     MAP_TYPE_Q_AND_A = 'Q-AND-A'
 
+    # Base URLs of the OCL API environments selected with the commands' --env option
+    OCL_API_URL = {
+        'dev': 'http://api.dev.openconceptlab.com/',
+        'staging': 'http://api.staging.openconceptlab.com/',
+        'production': 'http://api.openconceptlab.com/',
+    }
+
     # Directory of sources with metadata
     SOURCE_DIRECTORY = [
         {'owner_type': 'org', 'owner_id': 'IHTSDO', 'omrs_id': 'SNOMED CT', 'ocl_id': 'SNOMED-CT'},
@@ -62,6 +104,17 @@ class OclOpenmrsHelper(object):
          'ocl_id': 'HL7-DiagnosticServiceSections'},
     ]
 
+    @classmethod
+    def get_api_url(cls, ocl_api_env=None, api_url=None):
+        """ Returns the OCL API URL given by an --api_url or --env option, otherwise the OCL_API_URL setting """
+        from django.conf import settings
+        return api_url or cls.OCL_API_URL.get(ocl_api_env) or settings.OCL_API_URL
+
+    @classmethod
+    def get_concept_id_from_url(cls, concept_url):
+        """ Returns the integer concept ID from an OCL concept URL, e.g. /orgs/CIEL/sources/CIEL/concepts/5839/ """
+        return int(concept_url.split('/')[-2])
+
     @classmethod
     def get_source_owner_id(cls, omrs_source_id=None, ocl_source_id=None):
         """ Returns the owner ID for the specified source """
@@ -0,0 +1,90 @@
+"""
+Command to check OCL concept and mapping files before they are synced with sync_bahmni_db.
+
+    manage.py check_ocl_files --concept_file=concepts.json --mapping_file=mappings.json > errors.json
+
+Both files are read once, line by line. One JSON record is printed per problem found, with the
+file, line number, field and error: missing or mistyped fields, malformed concept and source
+URLs, duplicate concept IDs, and mappings that reference concepts which are neither in the
+concept file nor in the keys file (--keys) of an earlier concept sync. The command fails if any
+problem is found, so it can gate a sync:
+
+    manage.py check_ocl_files --concept_file=concepts.json --mapping_file=mappings.json -v0 && manage.py sync_bahmni_db ...
+
+Set verbosity to 0 (e.g. '-v0') to suppress the error records and the results summary output.
+"""
+from optparse import make_option
+import json
+
+from django.core.management import BaseCommand, CommandError
+from omrs.ocl_schema import OclFileValidator
+
+
+class Command(BaseCommand):
+    """
+    Check OCL concept and mapping files before syncing them
+    """
+
+    # Command attributes
+    help = 'Check OCL concept and mapping files before syncing them'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--concept_file',
+                    action='store',
+                    dest='concept_filename',
+                    default=None,
+                    help='OCL concept filename'),
+        make_option('--mapping_file',
+                    action='store',
+                    dest='mapping_filename',
+                    default=None,
+                    help='OCL mapping filename'),
+        make_option('--keys',
+                    action='store',
+                    dest='keys',
+                    default=None,
+                    help='Keys file of an earlier concept sync, for concepts referenced by mappings'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options, checks the files and writes the error report """
+        self.concept_filename = options['concept_filename']
+        self.mapping_filename = options['mapping_filename']
+        self.verbosity = int(options['verbosity'])
+        if not self.concept_filename and not self.mapping_filename:
+            raise CommandError('ERROR: concept_file or mapping_file is required')
+
+        known_concept_ids = []
+        if options['keys']:
+            with open(options['keys'], 'r') as fp:
+                known_concept_ids = [int(concept_id) for concept_id in json.load(fp)]
+        self.validator = OclFileValidator(
+            known_concept_ids=known_concept_ids,
+            check_references=bool(self.concept_filename or options['keys']))
+
+        self.cnt_errors = 0
+        if self.concept_filename:
+            self.report(self.validator.validate_concept_file(self.concept_filename))
+        if self.mapping_filename:
+            self.report(self.validator.validate_mapping_file(self.mapping_filename))
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+        if self.cnt_errors:
+            raise CommandError('%d problems found in the OCL files' % self.cnt_errors)
+
+    def report(self, errors):
+        for error in errors:
+            self.cnt_errors += 1
+            if self.verbosity:
+                print json.dumps(error)
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        print 'Lines checked: %d' % self.validator.cnt_lines
+        print 'Problems found: %d' % self.cnt_errors
+        print '------------------------------------------------------'
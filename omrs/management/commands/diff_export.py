@@ -0,0 +1,123 @@
+"""
+Command to diff two OCL exports, e.g. two releases of the same dictionary.
+
+    manage.py diff_export --old=ciel_v1.json --new=ciel_v2.json > diff.json
+
+Both files may be JSON-lines files written by extract_db --raw or OCL source version export
+documents. Concepts are matched by id and mappings by from concept, to concept and map type.
+One JSON record per added, removed or changed concept or mapping is printed. The files are
+sorted on disk in runs of --run_size records and merged, so memory use stays bounded on full
+dictionary exports.
+
+The added and changed records can be written as JSON-lines files for an incremental sync:
+
+    manage.py diff_export --old=v1.json --new=v2.json --concept_output=c.json --mapping_output=m.json -v0
+    manage.py sync_bahmni_db --concept --concept_file=c.json --keys=keys.json
+    manage.py sync_bahmni_db --mapping --mapping_file=m.json --keys=keys.json
+
+Fields that change in every release without changing the content (e.g. version URLs) can be
+left out of the comparison with --ignore_fields.
+
+Set verbosity to 0 (e.g. '-v0') to suppress the change records and the results summary.
+"""
+from optparse import make_option
+import json
+import shutil
+import tempfile
+
+from django.core.management import BaseCommand, CommandError
+from omrs.ocl_diff import ADDED, CHANGED, CONCEPT, MAPPING, REMOVED, RUN_SIZE, OclExportDiff
+
+
+class Command(BaseCommand):
+    """
+    Diff two OCL exports
+    """
+
+    # Command attributes
+    help = 'Diff two OCL exports'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--old',
+                    action='store',
+                    dest='old_filename',
+                    default=None,
+                    help='OCL export or JSON-lines file of the old version'),
+        make_option('--new',
+                    action='store',
+                    dest='new_filename',
+                    default=None,
+                    help='OCL export or JSON-lines file of the new version'),
+        make_option('--concept_output',
+                    action='store',
+                    dest='concept_output',
+                    default=None,
+                    help='Write the added and changed concepts to this JSON-lines file'),
+        make_option('--mapping_output',
+                    action='store',
+                    dest='mapping_output',
+                    default=None,
+                    help='Write the added and changed mappings to this JSON-lines file'),
+        make_option('--ignore_fields',
+                    action='store',
+                    dest='ignore_fields',
+                    default='',
+                    help='Comma-separated record fields left out of the comparison. e.g. version_url,updated_on'),
+        make_option('--run_size',
+                    action='store',
+                    dest='run_size',
+                    default=RUN_SIZE,
+                    help='Number of records sorted in memory at a time'),
+        make_option('--temp_dir',
+                    action='store',
+                    dest='temp_dir',
+                    default=None,
+                    help='Directory for the temporary sort files'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options, runs the diff and writes the results """
+        self.old_filename = options['old_filename']
+        self.new_filename = options['new_filename']
+        self.verbosity = int(options['verbosity'])
+        if not self.old_filename or not self.new_filename:
+            raise CommandError('ERROR: old and new are required options')
+        ignore_fields = tuple(field.strip() for field in options['ignore_fields'].split(',') if field.strip())
+
+        self.counts = {}
+        outputs = {}
+        directory = tempfile.mkdtemp(prefix='diff_export', dir=options['temp_dir'])
+        try:
+            if options['concept_output']:
+                outputs[CONCEPT] = open(options['concept_output'], 'w')
+            if options['mapping_output']:
+                outputs[MAPPING] = open(options['mapping_output'], 'w')
+            self.diff = OclExportDiff(self.old_filename, self.new_filename, directory,
+                                      run_size=int(options['run_size']), ignore_fields=ignore_fields)
+            for change, key, old_json, new_json in self.diff.changes():
+                key = json.loads(key)
+                record_type = key[0]
+                self.counts[(record_type, change)] = self.counts.get((record_type, change), 0) + 1
+                if self.verbosity:
+                    print json.dumps({'change': change, 'type': record_type, 'key': key[1:]})
+                if new_json is not None and record_type in outputs:
+                    outputs[record_type].write(new_json + '\n')
+        finally:
+            for fp in outputs.itervalues():
+                fp.close()
+            shutil.rmtree(directory)
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        for record_type in (CONCEPT, MAPPING):
+            for change in (ADDED, REMOVED, CHANGED):
+                print '%ss %s: %d' % (record_type.capitalize(), change, self.counts.get((record_type, change), 0))
+        print 'Duplicate records ignored: %d' % self.diff.cnt_duplicates
+        print '------------------------------------------------------'
@@ -26,6 +26,50 @@ The OCL-CIEL test data set uses --concept_limit=2000:
     manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_limit=2000 --mappings > m2k.json
     manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_limit=2000 --retired > r2k.json
 
+To export a selection of concepts in one run, pass a comma-separated list of IDs or the name of
+a file of IDs with --concept_ids. The concepts and their names, descriptions, mappings, answers
+and set members are loaded in bulk:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_ids=5839,1065 --concepts > c.json
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concept_ids=ids.txt --mappings > m.json
+
+Repeated exports of a dictionary that rarely changes can reuse the records of unchanged
+concepts from an on-disk cache. Concepts whose dates (or the dates of their names,
+descriptions, mappings, answers and set members) changed since they were cached are exported
+again and the cache is updated:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concepts --cache=export_cache.sqlite3 > concepts.json
+
+Subset exports push their filters down into SQL, so only the selected rows are read. --class
+and --datatype select concepts, --locales selects names and descriptions, and --map_sources
+selects reference mappings by OpenMRS source name (answers and set members are kept only if
+the org_id source is listed):
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concepts --class=Diagnosis --locales=en > dx.json
+
+For parallel imports, the export can be split into numbered JSON-lines shards of at most
+--shard_records records or --shard_bytes bytes. A concept and its mappings are always written
+to the same shard. A manifest.json with the record count, size and SHA-256 checksum of each
+shard is written next to them:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw --concepts --mappings --output_dir=export --shard_records=50000
+
+Large exports can overlap reading from the database, serializing JSON and writing output with
+--pipeline. Concepts are fetched in a reader thread and serialized in a second thread, or in a
+pool of --serializers processes, while records are written in their original order:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concepts --pipeline --serializers=4 > concepts.json
+
+Progress of a long export can be followed without touching stdout: --status_file keeps a JSON
+file, and --metrics_file a Prometheus textfile, updated with the concepts processed, rate, ETA,
+query count and memory use:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concepts --status_file=status.json --metrics_file=extract_db.prom > concepts.json
+
+Transient MySQL errors (lost connections, lock wait timeouts and deadlocks) are retried up to
+--max_retries times on a new connection: the current chunk of concepts is fetched again and
+the stream of concept IDs resumes after the last ID read.
+
 NOTES:
 - OCL does not handle the OpenMRS drug table -- it is ignored for now
 
@@ -36,12 +80,23 @@ BUGS:
 """
 from optparse import make_option
 import json
+import multiprocessing
 
 import datetime
 from django.core.management import BaseCommand, CommandError
+from django.db import connections
 from omrs.models import Concept, ConceptReferenceSource
-from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import requests
+from omrs.snapshot import enable_snapshot
+from omrs.export_cache import ExportCache, compute_fingerprints
+from omrs.export_filters import ExportFilter, split_option
+from omrs.pipeline import run_pipeline
+from omrs.progress import ProgressReporter
+from omrs.retry import DEFAULT_MAX_RETRIES, Retrier
+from omrs.rows import load_concept_records
+from omrs.shards import ShardWriter
+from omrs.streaming import stream_values
+from omrs.management.commands import (OclOpenmrsHelper, UnrecognizedSourceException, chunks,
+                                      parse_concept_ids)
 
 
 
@@ -52,12 +107,18 @@ class Command(BaseCommand):
 
     # Command attributes
     help = 'Extract concepts from OpenMRS database in the form of json'
+    requires_model_validation = False
     option_list = BaseCommand.option_list + (
         make_option('--concept_id',
                     action='store',
                     dest='concept_id',
                     default=None,
                     help='ID for concept to export, if specified only export this one. e.g. 5839'),
+        make_option('--concept_ids',
+                    action='store',
+                    dest='concept_ids',
+                    default=None,
+                    help='Comma-separated concept IDs, or a file of IDs, to export. e.g. 5839,1065'),
         make_option('--concept_limit',
                     action='store',
                     dest='concept_limit',
@@ -83,6 +144,26 @@ class Command(BaseCommand):
                     dest='retire_sw',
                     default=False,
                     help='If specify, output a list of retired concepts.'),
+        make_option('--class',
+                    action='store',
+                    dest='concept_classes',
+                    default=None,
+                    help='Comma-separated concept classes to export. e.g. Diagnosis,Symptom'),
+        make_option('--datatype',
+                    action='store',
+                    dest='datatypes',
+                    default=None,
+                    help='Comma-separated concept datatypes to export. e.g. Coded,Numeric'),
+        make_option('--locales',
+                    action='store',
+                    dest='locales',
+                    default=None,
+                    help='Comma-separated locales of the names and descriptions to export. e.g. en,fr'),
+        make_option('--map_sources',
+                    action='store',
+                    dest='map_sources',
+                    default=None,
+                    help='Comma-separated OpenMRS sources of the reference mappings to export. e.g. SNOMED CT'),
         make_option('--org_id',
                     action='store',
                     dest='org_id',
@@ -108,13 +189,83 @@ class Command(BaseCommand):
                     dest='token',
                     default=None,
                     help='OCL API token to validate OpenMRS reference sources'),
+        make_option('--cache',
+                    action='store',
+                    dest='cache_filename',
+                    default=None,
+                    help='Cache file of exported records, reused for concepts unchanged since the last export.'),
+        make_option('--output_dir',
+                    action='store',
+                    dest='output_dir',
+                    default=None,
+                    help='Write the export as numbered JSON-lines shards and a manifest to this directory.'),
+        make_option('--shard_records',
+                    action='store',
+                    dest='shard_records',
+                    default=None,
+                    help='Maximum number of records per shard.'),
+        make_option('--shard_bytes',
+                    action='store',
+                    dest='shard_bytes',
+                    default=None,
+                    help='Maximum size of a shard in bytes.'),
+        make_option('--shard_prefix',
+                    action='store',
+                    dest='shard_prefix',
+                    default=None,
+                    help='Shard filename prefix, by default "concepts", "mappings", "retired" or "export".'),
+        make_option('--pipeline',
+                    action='store_true',
+                    dest='pipeline',
+                    default=False,
+                    help='Overlap fetching, serializing and writing of the exported records.'),
+        make_option('--serializers',
+                    action='store',
+                    dest='serializers',
+                    default='1',
+                    help='Number of processes serializing records with --pipeline, 1 to use a thread.'),
+        make_option('--status_file',
+                    action='store',
+                    dest='status_filename',
+                    default=None,
+                    help='JSON file updated with the progress of the export.'),
+        make_option('--metrics_file',
+                    action='store',
+                    dest='metrics_filename',
+                    default=None,
+                    help='Prometheus textfile (*.prom) updated with the progress of the export.'),
+        make_option('--max_retries',
+                    action='store',
+                    dest='max_retries',
+                    default=DEFAULT_MAX_RETRIES,
+                    help='Number of times to retry after a transient database error.'),
+        make_option('--snapshot',
+                    action='store_true',
+                    dest='snapshot',
+                    default=False,
+                    help='Read from the local snapshot database created by snapshot_db instead of MySQL.'),
+    )
+
+    # Counters incremented by export_concept() and export_all_mappings_for_concept(), replayed
+    # from the cache for concepts that are not exported again
+    EXPORT_COUNTERS = (
+        'cnt_concepts_exported',
+        'cnt_internal_mappings_exported',
+        'cnt_external_mappings_exported',
+        'cnt_ignored_self_mappings',
+        'cnt_questions_exported',
+        'cnt_answers_exported',
+        'cnt_concept_sets_exported',
+        'cnt_set_members_exported',
     )
 
-    OCL_API_URL = {
-        'dev': 'http://api.dev.openconceptlab.com/',
-        'staging': 'http://api.staging.openconceptlab.com/',
-        'production': 'http://api.openconceptlab.com/',
-    }
+    # Counters incremented by serialize_concept(), returned by the pipeline's serializer processes
+    SERIALIZER_COUNTERS = EXPORT_COUNTERS + ('cnt_total_concepts_processed', 'cnt_retired_concepts_exported')
+
+    # Chunks of fetched concepts queued between the pipeline stages, per serializer
+    PIPELINE_QUEUE_SIZE = 2
+
+    OCL_API_URL = OclOpenmrsHelper.OCL_API_URL
 
 
 
@@ -130,6 +281,14 @@ class Command(BaseCommand):
         self.org_id = options['org_id']
         self.source_id = options['source_id']
         self.concept_id = options['concept_id']
+        self.concept_ids = None
+        try:
+            if options['concept_ids'] is not None:
+                self.concept_ids = parse_concept_ids(options['concept_ids'])
+            elif self.concept_id is not None:
+                self.concept_ids = [int(self.concept_id)]
+        except ValueError as e:
+            raise CommandError('Invalid concept ID: %s' % e)
         self.concept_limit = options['concept_limit']
         self.raw = options['raw']
         self.do_mapping = options['mapping']
@@ -137,7 +296,24 @@ class Command(BaseCommand):
         self.do_retire = options['retire_sw']
         if self.concept_limit is not None:
             self.concept_limit = int(self.concept_limit)
+        self.cache_filename = options['cache_filename']
+        self.export_filter = ExportFilter(
+            classes=split_option(options['concept_classes']), datatypes=split_option(options['datatypes']),
+            locales=split_option(options['locales']), map_sources=split_option(options['map_sources']),
+            own_source=self.org_id)
+        self.output_dir = options['output_dir']
+        self.shard_records = int(options['shard_records']) if options['shard_records'] else None
+        self.shard_bytes = int(options['shard_bytes']) if options['shard_bytes'] else None
+        self.shard_prefix = options['shard_prefix']
+        self.pipeline = options['pipeline']
+        try:
+            self.serializers = int(options['serializers'])
+        except ValueError:
+            raise CommandError("ERROR: 'serializers' must be a number")
         self.verbosity = int(options['verbosity'])
+        self.retrier = Retrier(max_retries=int(options['max_retries']), verbosity=self.verbosity)
+        self.progress = ProgressReporter('extract_db', status_filename=options['status_filename'],
+                                         metrics_filename=options['metrics_filename'])
         self.ocl_api_token = options['token']
         if options['ocl_api_env']:
             self.ocl_api_env = options['ocl_api_env'].lower()
@@ -149,6 +325,10 @@ class Command(BaseCommand):
         # Validate the options
         self.validate_options()
 
+        # Read from the local snapshot if requested
+        if options['snapshot']:
+            enable_snapshot()
+
         # Validate all reference sources
         if options['check_sources']:
             self.check_sources()
@@ -169,10 +349,22 @@ class Command(BaseCommand):
         self.cnt_concept_sets_exported = 0
         self.cnt_set_members_exported = 0
         self.cnt_retired_concepts_exported = 0
+        self.cnt_cache_hits = 0
+        self.cnt_cache_misses = 0
+        self.missing_concept_ids = []
 
         # Process concepts, mappings, or retirement script
+        self.shard_writer = None
+        self.manifest = None
         if self.do_export:
+            if self.output_dir:
+                self.shard_writer = ShardWriter(
+                    self.output_dir, self.get_shard_prefix(), max_records=self.shard_records,
+                    max_bytes=self.shard_bytes, metadata={'org_id': self.org_id, 'source_id': self.source_id})
             self.export()
+            if self.shard_writer:
+                self.manifest = self.shard_writer.close()
+            self.progress.finish()
 
         # Display final counts
         if self.verbosity:
@@ -191,6 +383,16 @@ class Command(BaseCommand):
                 ("ERROR: 'org_id' and 'source_id' are required options for a concept or "
                  "mapping export and must be valid identifiers for an organization and "
                  "source in OCL"))
+        if self.cache_filename and self.export_filter.filters_records():
+            raise CommandError("ERROR: 'locales' and 'map_sources' change the exported records and cannot use the 'cache' option")
+        if self.output_dir and not self.raw:
+            raise CommandError("ERROR: 'output_dir' writes JSON-lines shards and requires the 'raw' option")
+        if (self.shard_records or self.shard_bytes) and not self.output_dir:
+            raise CommandError("ERROR: 'shard_records' and 'shard_bytes' require the 'output_dir' option")
+        if self.pipeline and self.cache_filename:
+            raise CommandError("ERROR: the 'pipeline' and 'cache' options cannot be combined")
+        if self.serializers < 1 or (self.serializers > 1 and not self.pipeline):
+            raise CommandError("ERROR: 'serializers' must be at least 1 and requires the 'pipeline' option")
         if self.ocl_api_env not in self.OCL_API_URL:
             raise CommandError('Invalid "env" option provided: %s' % self.ocl_api_env)
         return True
@@ -217,6 +419,16 @@ class Command(BaseCommand):
             print 'Ignored Self Mappings: %d' % self.cnt_ignored_self_mappings
         if self.do_retire:
             print 'EXPORT COUNT: Retired Concept IDs: %d' % self.cnt_retired_concepts_exported
+        if self.cache_filename:
+            print 'Cache: %d concepts reused, %d exported again' % (self.cnt_cache_hits, self.cnt_cache_misses)
+        if self.retrier.counts:
+            print 'Transient database errors retried: %s' % self.retrier.summary()
+        if self.manifest:
+            print 'Shards written to %s: %d' % (self.output_dir, len(self.manifest['shards']))
+        if self.missing_concept_ids and self.export_filter.filters_concepts():
+            print 'Concept IDs not found or excluded by filters: %s' % ', '.join(str(c) for c in self.missing_concept_ids)
+        elif self.missing_concept_ids:
+            print 'Concept IDs not found: %s' % ', '.join(str(c) for c in self.missing_concept_ids)
         print '------------------------------------------------------'
 
 
@@ -225,6 +437,7 @@ class Command(BaseCommand):
 
     def check_sources(self):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
+        import requests
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
         reference_sources = ConceptReferenceSource.objects.all()
@@ -270,39 +483,272 @@ class Command(BaseCommand):
         if self.raw:
             output_indent = None
 
-        # Create the concept enumerator, applying 'concept_id' and 'concept_limit' options
-        if self.concept_id is not None:
-            # If 'concept_id' option set, fetch a single concept and convert to enumerator
-            concept = Concept.objects.get(concept_id=self.concept_id)
-            concept_enumerator = enumerate([concept]) 
+        # Concepts are counted as their records are written
+        self.progress.start_phase('concepts', total=len(self.concept_ids) if self.concept_ids is not None else None)
+
+        # A retired concept list needs only the IDs, which are selected in SQL
+        if self.do_retire and not self.do_concept and not self.do_mapping:
+            self.export_retired_concept_ids(output_indent)
+            return
+
+        # Reuse cached records for unchanged concepts if a cache file is set
+        if self.cache_filename:
+            self.export_with_cache(output_indent)
+            return
+
+        # Create the concept iterator, applying 'concept_ids' and 'concept_limit' options
+        if self.concept_ids is not None:
+            # If 'concept_id' or 'concept_ids' option set, fetch only those concepts in bulk
+            concepts = self.fetch_concepts(self.concept_ids)
         else:
-            # Fetch all concepts and filter with 'concept_limit' if set
+            # Stream all concept IDs, filtered with 'concept_limit' if set, and fetch the concepts in bulk
             # TODO: 'concept_limit' is based on numeric value of concept_id not on actual count
-            concept_results = Concept.objects.all()
+            concept_results = self.export_filter.filter_concepts(Concept.objects.order_by('concept_id'))
             if self.concept_limit is not None:
                 concept_results = concept_results.filter(concept_id__lte=self.concept_limit)
-            concept_enumerator = enumerate(concept_results)
+            if self.progress.enabled:
+                self.progress.set_total(concept_results.count())
+            concepts = self.fetch_concepts(self.stream_concept_ids(concept_results))
 
-        # Iterate concept enumerator and process the export
-        for num, concept in concept_enumerator:
-            self.cnt_total_concepts_processed += 1
-            export_data = ''
-            if self.do_concept:
-                export_data = self.export_concept(concept)
-                if export_data:
-                    print json.dumps(export_data, indent=output_indent)
-            if self.do_mapping:
-                export_data = self.export_all_mappings_for_concept(concept)
-                if export_data:
-                    for map_dict in export_data:
-                        print json.dumps(map_dict, indent=output_indent)
-            if self.do_retire:
-                export_data = self.export_concept_id_if_retired(concept)
-                if export_data:
-                    print json.dumps(export_data, indent=output_indent)
+        # Overlap fetching, serializing and writing if requested
+        if self.pipeline:
+            self.export_pipelined(concepts, output_indent)
+            return
+
+        # Iterate concepts and process the export
+        for concept in concepts:
+            self.write_records(concept.concept_id, self.serialize_concept(concept, output_indent))
 
         # self.print_debug_summary()
 
+    def serialize_concept(self, concept, output_indent):
+        """ Returns the JSON lines exported for one concept """
+        self.cnt_total_concepts_processed += 1
+        export_data = ''
+        output = []
+        if self.do_concept:
+            export_data = self.export_concept(concept)
+            if export_data:
+                output.append(json.dumps(export_data, indent=output_indent))
+        if self.do_mapping:
+            export_data = self.export_all_mappings_for_concept(concept)
+            if export_data:
+                for map_dict in export_data:
+                    output.append(json.dumps(map_dict, indent=output_indent))
+        if self.do_retire:
+            export_data = self.export_concept_id_if_retired(concept)
+            if export_data:
+                output.append(json.dumps(export_data, indent=output_indent))
+        return output
+
+    def serialize_concepts(self, concepts, output_indent):
+        """ Returns a list of (concept_id, JSON lines) for a chunk of concepts """
+        return [(concept.concept_id, self.serialize_concept(concept, output_indent)) for concept in concepts]
+
+    def export_pipelined(self, concepts, output_indent):
+        """
+        Export loop with fetching, serializing and writing overlapped.
+
+        Chunks of concepts are fetched in a reader thread and serialized in a second thread or,
+        if 'serializers' is more than 1, in a pool of processes. Records are written from this
+        thread in their original order. Bounded queues between the stages hold back a stage
+        that gets ahead of the others.
+        """
+        pool = None
+        if self.serializers > 1:
+            # The serializer processes do not use the database; close the connections so that
+            # none is shared with them
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(
+                self.serializers, init_serializer_process,
+                (self.org_id, self.source_id, self.do_concept, self.do_mapping, self.do_retire, output_indent))
+            serialize = serialize_in_process
+        else:
+            serialize = lambda chunk: (self.serialize_concepts(chunk, output_indent), None)
+        try:
+            run_pipeline(self.read_concept_chunks(concepts), serialize, self.write_serialized,
+                         queue_size=self.PIPELINE_QUEUE_SIZE * self.serializers, pool=pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    def read_concept_chunks(self, concepts):
+        """ Yields lists of fetched concepts, closing the reader thread's connections when done """
+        try:
+            for chunk in chunks(concepts):
+                yield chunk
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    def write_serialized(self, serialized):
+        """ Writes a serialized chunk and adds the counters returned by a serializer process """
+        records, counters = serialized
+        for counter, increment in (counters or {}).iteritems():
+            setattr(self, counter, getattr(self, counter) + increment)
+        for concept_id, output in records:
+            self.write_records(concept_id, output)
+
+    def export_with_cache(self, output_indent):
+        """
+        Export loop that emits cached records for concepts unchanged since they were cached.
+
+        Fingerprints for all selected concepts are computed with grouped aggregate queries.
+        Concepts with a matching cache entry are written straight from the cache; the others
+        are fetched in bulk, exported, and stored in the cache.
+        """
+        export_cache = ExportCache(self.cache_filename, self.org_id, self.source_id)
+        if self.concept_ids is None:
+            fingerprints = compute_fingerprints(concept_limit=self.concept_limit)
+            concept_ids = sorted(fingerprints)
+            self.progress.set_total(len(concept_ids))
+        else:
+            concept_ids = self.concept_ids
+
+        for chunk in chunks(concept_ids):
+            if self.concept_ids is not None:
+                fingerprints = compute_fingerprints(concept_ids=chunk)
+            if self.export_filter.filters_concepts():
+                # Concepts excluded by the class or datatype filters are skipped, not reported missing
+                selected_ids = set(self.export_filter.filter_concepts(Concept.objects.filter(
+                    concept_id__in=chunk)).values_list('concept_id', flat=True))
+                chunk = [concept_id for concept_id in chunk
+                         if concept_id in selected_ids or concept_id not in fingerprints]
+            cached = export_cache.get_many(chunk, fingerprints)
+            stale_ids = [concept_id for concept_id in chunk
+                         if concept_id in fingerprints and concept_id not in cached]
+            stale_concepts = dict((concept.concept_id, concept) for concept in self.fetch_concepts(stale_ids))
+
+            for concept_id in chunk:
+                if concept_id not in fingerprints:
+                    self.missing_concept_ids.append(concept_id)
+                    continue
+                self.cnt_total_concepts_processed += 1
+
+                if concept_id in cached:
+                    # Replay the cached records and the counters they incremented when exported
+                    self.cnt_cache_hits += 1
+                    concept_json, mapping_lines, counters = cached[concept_id]
+                    for counter, increment in counters.iteritems():
+                        setattr(self, counter, getattr(self, counter) + increment)
+                else:
+                    self.cnt_cache_misses += 1
+                    concept = stale_concepts[concept_id]
+                    counters_before = dict((counter, getattr(self, counter)) for counter in self.EXPORT_COUNTERS)
+                    concept_data = self.export_concept(concept)
+                    mapping_data = self.export_all_mappings_for_concept(concept)
+                    counters = dict((counter, getattr(self, counter) - counters_before[counter])
+                                    for counter in self.EXPORT_COUNTERS)
+                    export_cache.set(concept_id, fingerprints[concept_id], concept_data, mapping_data, counters)
+                    concept_json = json.dumps(concept_data)
+                    mapping_lines = [json.dumps(map_dict) for map_dict in mapping_data]
+
+                # Cached records are stored as raw JSON lines and re-indented for display output
+                output = []
+                if self.do_concept:
+                    output.append(self.format_json(concept_json, output_indent))
+                if self.do_mapping:
+                    for mapping_json in mapping_lines:
+                        output.append(self.format_json(mapping_json, output_indent))
+                if self.do_retire and json.loads(concept_json)['retired']:
+                    self.cnt_retired_concepts_exported += 1
+                    output.append(json.dumps(concept_id, indent=output_indent))
+                self.write_records(concept_id, output)
+
+            export_cache.commit()
+        export_cache.close()
+
+    def export_retired_concept_ids(self, output_indent):
+        """ Writes the IDs of the retired concepts, selected with a single streamed query """
+        retired_filter = ExportFilter(retired_only=True, classes=self.export_filter.classes,
+                                      datatypes=self.export_filter.datatypes)
+        concept_results = retired_filter.filter_concepts(Concept.objects.order_by('concept_id'))
+        if self.concept_limit is not None:
+            concept_results = concept_results.filter(concept_id__lte=self.concept_limit)
+        if self.concept_ids is not None:
+            retired_ids = (concept_id for chunk in chunks(self.concept_ids)
+                           for (concept_id,) in stream_values(concept_results.filter(concept_id__in=chunk),
+                                                              'concept_id'))
+        else:
+            retired_ids = self.stream_concept_ids(concept_results)
+        for concept_id in retired_ids:
+            self.cnt_total_concepts_processed += 1
+            self.cnt_retired_concepts_exported += 1
+            self.write_records(concept_id, [json.dumps(concept_id, indent=output_indent)])
+
+    def write_records(self, concept_id, output):
+        """ Writes the exported records of one concept to stdout, or to the current shard """
+        self.progress.advance()
+        if self.shard_writer:
+            self.shard_writer.write_group(output, concept_id)
+        else:
+            for line in output:
+                print line
+
+    def get_shard_prefix(self):
+        """ Returns the shard filename prefix for the records being exported """
+        if self.shard_prefix:
+            return self.shard_prefix
+        selected = [prefix for prefix, selected in (('concepts', self.do_concept), ('mappings', self.do_mapping),
+                                                    ('retired', self.do_retire)) if selected]
+        return selected[0] if len(selected) == 1 else 'export'
+
+    def format_json(self, json_text, output_indent):
+        """ Returns JSON text as is for raw output, or re-indented for display """
+        if output_indent is None:
+            return json_text
+        return json.dumps(json.loads(json_text), indent=output_indent)
+
+    def init_exporter(self, org_id, source_id, export_filter=None, retrier=None):
+        """
+        Sets up the attributes that fetch_concepts() and the export methods use, for exporters
+        that do not run handle(): the concept lookup API and the pipeline's serializer processes.
+        """
+        self.org_id = org_id
+        self.source_id = source_id
+        self.export_filter = export_filter or ExportFilter(own_source=org_id)
+        self.retrier = retrier or Retrier()
+        self.missing_concept_ids = []
+        for counter in self.SERIALIZER_COUNTERS:
+            setattr(self, counter, 0)
+
+    def fetch_concepts(self, concept_ids):
+        """
+        Yields a ConceptRecord for each of the concepts in concept_ids, in the order given.
+
+        Concepts are loaded in chunks as row records together with the rows of their related
+        tables, so each chunk costs a fixed number of queries. IDs not found are recorded in
+        missing_concept_ids.
+        """
+        for chunk in chunks(concept_ids):
+            concepts_by_id = self.retrier.run(load_concept_records, chunk, self.export_filter)
+            for concept_id in chunk:
+                if concept_id in concepts_by_id:
+                    yield concepts_by_id[concept_id]
+                else:
+                    self.missing_concept_ids.append(concept_id)
+
+    def stream_concept_ids(self, concept_results):
+        """
+        Yields the IDs of concept_results, ordered by concept_id, from a streamed query that is
+        resumed after the last ID read if a transient database error interrupts it.
+        """
+        last_concept_id = None
+        while True:
+            remaining = concept_results
+            if last_concept_id is not None:
+                remaining = concept_results.filter(concept_id__gt=last_concept_id)
+            try:
+                for (concept_id,) in stream_values(remaining, 'concept_id'):
+                    last_concept_id = concept_id
+                    self.retrier.attempts = 0
+                    yield concept_id
+                return
+            except Exception as e:
+                self.retrier.recover(e)
+
 
 
     ## CONCEPT EXPORT
@@ -311,7 +757,7 @@ class Command(BaseCommand):
         """
         Export one concept as OCL-formatted dictionary.
 
-        :param concept: Concept to export from OpenMRS database.
+        :param concept: ConceptRecord of the concept to export from OpenMRS database.
         :returns: OCL-formatted dictionary for the concept.
 
         Note:
@@ -326,8 +772,8 @@ class Command(BaseCommand):
         extras = {}
         data = {}
         data['id'] = concept.concept_id
-        data['concept_class'] = concept.concept_class.name
-        data['datatype'] = concept.datatype.name
+        data['concept_class'] = concept.concept_class_name
+        data['datatype'] = concept.datatype_name
         data['external_id'] = concept.uuid
         data['retired'] = concept.retired
         extras['is_set'] = concept.is_set
@@ -335,7 +781,7 @@ class Command(BaseCommand):
         data['date_created'] = self.datetime_handler(concept.date_created)
         # Concept Names
         names = []
-        for concept_name in concept.conceptname_set.all():
+        for concept_name in concept.names:
             if not concept_name.voided:
                 names.append({
                     'name': concept_name.name,
@@ -353,7 +799,7 @@ class Command(BaseCommand):
         # Concept Descriptions
         # NOTE: OMRS does not have description_type or locale_preferred -- omitted for now
         descriptions = []
-        for concept_description in concept.conceptdescription_set.all():
+        for concept_description in concept.descriptions:
             descriptions.append({
                 'description': concept_description.description,
                 'locale': concept_description.locale,
@@ -362,7 +808,7 @@ class Command(BaseCommand):
         data['descriptions'] = descriptions
 
         # If the concept is of numeric type, map concept's numeric type data as extras
-        for numeric_metadata in concept.conceptnumeric_set.all():
+        for numeric_metadata in concept.numerics:
             extras_dict = {}
             add_f(extras_dict, 'hi_absolute', numeric_metadata.hi_absolute)
             add_f(extras_dict, 'hi_critical', numeric_metadata.hi_critical)
@@ -430,20 +876,20 @@ class Command(BaseCommand):
         :returns: List of OCL-formatted mapping dictionaries for the concept.
         """
         export_data = []
-        for ref_map in concept.conceptreferencemap_set.all():
+        for ref_map in concept.reference_maps:
             map_dict = None
 
             # Internal Mapping
-            if ref_map.concept_reference_term.concept_source.name == self.org_id:
-                if str(concept.concept_id) == ref_map.concept_reference_term.code:
+            if ref_map.source_name == self.org_id:
+                if str(concept.concept_id) == ref_map.term_code:
                     # mapping to self, so ignore
                     self.cnt_ignored_self_mappings += 1
                 map_dict = self.generate_internal_mapping(
-                    map_type=ref_map.map_type.name,
+                    map_type=ref_map.map_type_name,
                     from_concept=concept,
-                    to_concept_code=ref_map.concept_reference_term.code,
-                    external_id=ref_map.concept_reference_term.uuid,
-                    term_id=ref_map.concept_reference_term.concept_reference_term_id,
+                    to_concept_code=ref_map.term_code,
+                    external_id=ref_map.term_uuid,
+                    term_id=ref_map.term_id,
                     concept_map_id=ref_map.concept_map_id,
                     creator=ref_map.creator,
                     date_created=ref_map.date_created,
@@ -453,18 +899,18 @@ class Command(BaseCommand):
             # External Mapping
             else:
                 # Prepare to_source_id
-                omrs_to_source_id = ref_map.concept_reference_term.concept_source.name
+                omrs_to_source_id = ref_map.source_name
                 to_source_id = OclOpenmrsHelper.get_ocl_source_id_from_omrs_id(omrs_to_source_id)
                 to_org_id = OclOpenmrsHelper.get_source_owner_id(ocl_source_id=to_source_id)
                 # Generate the external mapping dictionary
                 map_dict = self.generate_external_mapping(
-                    map_type=ref_map.map_type.name,
+                    map_type=ref_map.map_type_name,
                     from_concept=concept,
                     to_org_id=to_org_id,
                     to_source_id=to_source_id,
-                    to_concept_code=ref_map.concept_reference_term.code,
-                    to_concept_name=ref_map.concept_reference_term.name,
-                    term_id=ref_map.concept_reference_term.concept_reference_term_id,
+                    to_concept_code=ref_map.term_code,
+                    to_concept_name=ref_map.term_name,
+                    term_id=ref_map.term_id,
                     external_id=ref_map.uuid,
                     concept_map_id=ref_map.concept_map_id,
                     creator=ref_map.creator,
@@ -484,7 +930,7 @@ class Command(BaseCommand):
         :param concept: Concept with the linked answers to export from OpenMRS database.
         :returns: List of OCL-formatted mapping dictionaries representing the linked answers.
         """
-        if not concept.question_answer.count():
+        if not concept.answers:
             return []
 
         # Increment number of concept questions prepared for export
@@ -492,11 +938,11 @@ class Command(BaseCommand):
 
         # Export each of this concept's linked answers as an internal mapping
         maps = []
-        for answer in concept.question_answer.all():
+        for answer in concept.answers:
             map_dict = self.generate_internal_mapping(
                 map_type=OclOpenmrsHelper.MAP_TYPE_Q_AND_A,
                 from_concept=concept,
-                to_concept_code=answer.answer_concept.concept_id,
+                to_concept_code=answer.answer_concept_id,
                 external_id=answer.uuid,
                 creator=answer.creator,
                 date_created=answer.date_created,
@@ -514,7 +960,7 @@ class Command(BaseCommand):
         :param concept: Concept with the set members to export from OpenMRS database.
         :returns: List of OCL-formatted mapping dictionaries representing the set members.
         """
-        if not concept.conceptset_set.count():
+        if not concept.set_members:
             return []
 
         # Iterate number of concept sets prepared for export
@@ -522,11 +968,11 @@ class Command(BaseCommand):
 
         # Export each of this concept's set members as an internal mapping
         maps = []
-        for set_member in concept.conceptset_set.all():
+        for set_member in concept.set_members:
             map_dict = self.generate_internal_mapping(
                 map_type=OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET,
                 from_concept=concept,
-                to_concept_code=set_member.concept.concept_id,
+                to_concept_code=set_member.concept_id,
                 external_id=set_member.uuid,
                 creator=set_member.creator,
                 date_created=set_member.date_created,
@@ -594,6 +1040,33 @@ class Command(BaseCommand):
 
 
 
+## PIPELINE SERIALIZER PROCESSES
+
+# Exporter used by serialize_in_process(), created in each pool process
+serializer = None
+serializer_indent = None
+
+
+def init_serializer_process(org_id, source_id, do_concept, do_mapping, do_retire, output_indent):
+    """ Sets up the exporter of a serializer process started by Command.export_pipelined() """
+    global serializer, serializer_indent
+    serializer = Command()
+    serializer.init_exporter(org_id, source_id)
+    serializer.do_concept = do_concept
+    serializer.do_mapping = do_mapping
+    serializer.do_retire = do_retire
+    serializer_indent = output_indent
+
+
+def serialize_in_process(concepts):
+    """ Returns the serialized chunk and the counter increments it caused """
+    for counter in Command.SERIALIZER_COUNTERS:
+        setattr(serializer, counter, 0)
+    records = serializer.serialize_concepts(concepts, serializer_indent)
+    return records, dict((counter, getattr(serializer, counter)) for counter in Command.SERIALIZER_COUNTERS)
+
+
+
 ## HELPER METHOD
 
 def add_f(dictionary, key, value):
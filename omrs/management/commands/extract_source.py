@@ -38,8 +38,8 @@ import json
 import datetime
 from django.core.management import BaseCommand, CommandError
 from omrs.models import Concept, ConceptReferenceSource
+from omrs.snapshot import enable_snapshot
 from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import requests
 
 
 
@@ -50,6 +50,7 @@ class Command(BaseCommand):
 
     # Command attributes
     help = 'Extract concepts from OpenMRS database in the form of json'
+    requires_model_validation = False
     option_list = BaseCommand.option_list + (
         make_option('--raw',
                     action='store_true',
@@ -71,13 +72,14 @@ class Command(BaseCommand):
                     dest='token',
                     default=None,
                     help='OCL API token to validate OpenMRS reference sources'),
+        make_option('--snapshot',
+                    action='store_true',
+                    dest='snapshot',
+                    default=False,
+                    help='Read from the local snapshot database created by snapshot_db instead of MySQL.'),
     )
 
-    OCL_API_URL = {
-        'dev': 'http://api.dev.openconceptlab.com/',
-        'staging': 'http://api.staging.openconceptlab.com/',
-        'production': 'http://api.openconceptlab.com/',
-    }
+    OCL_API_URL = OclOpenmrsHelper.OCL_API_URL
 
 
 
@@ -104,6 +106,10 @@ class Command(BaseCommand):
         # Validate the options
         self.validate_options()
 
+        # Read from the local snapshot if requested
+        if options['snapshot']:
+            enable_snapshot()
+
         # Determine if an export request
         self.do_export = False
         if self.do_source:
@@ -152,6 +158,7 @@ class Command(BaseCommand):
 
     def check_sources(self):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
+        import requests
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
         reference_sources = ConceptReferenceSource.objects.all()
@@ -0,0 +1,104 @@
+"""
+Command to export the reference terms and term-to-term maps of an OpenMRS dictionary as JSON lines.
+
+    manage.py extract_terms -v0 > terms.json
+    manage.py extract_terms -v0 --sources='ICD-10-WHO,SNOMED CT' > terms.json
+
+Terms are written one per line, grouped by reference source and ordered by code, and each
+source's terms are followed by the maps from them to other terms. Both are streamed from the
+database, so a full SNOMED CT or ICD-10 term set can be exported in one pass with flat memory.
+Use --terms or --term_maps to export only one of the two. The file is read by sync_terms.
+
+Set verbosity to 0 (e.g. '-v0') to suppress the results summary output.
+"""
+from optparse import make_option
+import json
+
+from django.core.management import BaseCommand, CommandError
+from omrs.reference_terms import get_map_type_names, get_sources, iter_term_map_records, iter_term_records
+from omrs.snapshot import enable_snapshot
+
+
+class Command(BaseCommand):
+    """
+    Export reference terms and term maps as JSON lines
+    """
+
+    # Command attributes
+    help = 'Export reference terms and term maps as JSON lines'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--sources',
+                    action='store',
+                    dest='source_names',
+                    default=None,
+                    help='Comma-separated names of the reference sources to export, otherwise all of them'),
+        make_option('--terms',
+                    action='store_true',
+                    dest='terms',
+                    default=False,
+                    help='Export reference terms.'),
+        make_option('--term_maps',
+                    action='store_true',
+                    dest='term_maps',
+                    default=False,
+                    help='Export term-to-term maps.'),
+        make_option('--snapshot',
+                    action='store_true',
+                    dest='snapshot',
+                    default=False,
+                    help='Read from the local snapshot database created by snapshot_db instead of MySQL.'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options and writes the terms and term maps of each source """
+        self.verbosity = int(options['verbosity'])
+        self.do_terms = options['terms']
+        self.do_term_maps = options['term_maps']
+        if not self.do_terms and not self.do_term_maps:
+            self.do_terms = self.do_term_maps = True
+        source_names = None
+        if options['source_names']:
+            source_names = [name.strip() for name in options['source_names'].split(',') if name.strip()]
+
+        # Read from the local snapshot if requested
+        if options['snapshot']:
+            enable_snapshot()
+
+        sources = get_sources(source_names)
+        if source_names and len(sources) < len(set(source_names)):
+            missing = set(source_names) - set(source.name for source in sources)
+            raise CommandError('ERROR: reference sources not found: %s' % ', '.join(sorted(missing)))
+        map_type_names = get_map_type_names()
+
+        # Initialize counters
+        self.cnt_sources_exported = 0
+        self.cnt_terms_exported = 0
+        self.cnt_term_maps_exported = 0
+
+        for source in sources:
+            self.cnt_sources_exported += 1
+            if self.do_terms:
+                for record in iter_term_records(source):
+                    self.cnt_terms_exported += 1
+                    print json.dumps(record)
+            if self.do_term_maps:
+                for record in iter_term_map_records(source, map_type_names):
+                    self.cnt_term_maps_exported += 1
+                    print json.dumps(record)
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        print 'Reference sources exported: %d' % self.cnt_sources_exported
+        if self.do_terms:
+            print 'EXPORT COUNT: Reference Terms: %d' % self.cnt_terms_exported
+        if self.do_term_maps:
+            print 'EXPORT COUNT: Term Maps: %d' % self.cnt_term_maps_exported
+        print '------------------------------------------------------'
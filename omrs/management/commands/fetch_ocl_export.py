@@ -0,0 +1,122 @@
+"""
+Command to download an OCL source version export into the local export cache.
+
+    manage.py fetch_ocl_export --org_id=CIEL --source_id=CIEL --source_version=v2019-07-01 --env=staging --token=...
+
+The export is downloaded with resumable range requests and verified (its size, the MD5 in its
+ETag where there is one, and --sha256 if given) before it is stored in the cache under its
+SHA-256. The cached filename is printed, so the export can be passed to other commands:
+
+    manage.py validate_export --export=$(manage.py fetch_ocl_export -v0 --org_id=CIEL --source_id=CIEL --source_version=v2019-07-01)
+
+An interrupted download continues where it stopped the next time it is fetched, and a cached
+export is not downloaded again.
+
+There is no need to fetch an export before reading it: validate_export, sync_bahmni_db and the
+other commands that read OCL files accept ocl://OWNER/SOURCE/VERSION, which reads the cached
+export or parses the export while it downloads into the cache. Those inputs take the API URL,
+token and cache directory from the OCL_API_URL, OCL_API_TOKEN and OCL_EXPORT_CACHE settings
+(and environment variables):
+
+    manage.py sync_bahmni_db --concept --mapping --concept_file=ocl://CIEL/CIEL/v2019-07-01 --mapping_file=ocl://CIEL/CIEL/v2019-07-01 --keys=keys.json
+
+Set verbosity to 0 (e.g. '-v0') to print only the cached filename.
+"""
+from optparse import make_option
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from omrs.management.commands import OclOpenmrsHelper
+from omrs.ocl_download import DEFAULT_MAX_RETRIES, DownloadError, ExportDownloader
+
+
+class Command(BaseCommand):
+    """
+    Download an OCL source version export into the local export cache
+    """
+
+    # Command attributes
+    help = 'Download an OCL source version export into the local export cache'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--org_id',
+                    action='store',
+                    dest='org_id',
+                    default=None,
+                    help='ID of the organization that owns the source (e.g. CIEL)'),
+        make_option('--source_id',
+                    action='store',
+                    dest='source_id',
+                    default=None,
+                    help='ID of the source (e.g. CIEL)'),
+        make_option('--source_version',
+                    action='store',
+                    dest='source_version',
+                    default=None,
+                    help='Source version to download the export of'),
+        make_option('--sha256',
+                    action='store',
+                    dest='sha256',
+                    default=None,
+                    help='Expected SHA-256 checksum of the export'),
+        make_option('--env',
+                    action='store',
+                    dest='ocl_api_env',
+                    default=None,
+                    help='Download from "dev", "staging", or "production", otherwise from the OCL_API_URL setting'),
+        make_option('--api_url',
+                    action='store',
+                    dest='api_url',
+                    default=None,
+                    help='Base URL of the OCL API to download from, instead of the "env" option'),
+        make_option('--token',
+                    action='store',
+                    dest='token',
+                    default=None,
+                    help='OCL API token, otherwise the OCL_API_TOKEN setting'),
+        make_option('--cache_dir',
+                    action='store',
+                    dest='cache_dir',
+                    default=None,
+                    help='Export cache directory, otherwise the OCL_EXPORT_CACHE setting'),
+        make_option('--max_retries',
+                    action='store',
+                    dest='max_retries',
+                    type='int',
+                    default=DEFAULT_MAX_RETRIES,
+                    help='Times the download is resumed after a dropped connection or server error'),
+    )
+
+    OCL_API_URL = OclOpenmrsHelper.OCL_API_URL
+
+    def handle(self, *args, **options):
+        """ Handles options, downloads the export unless it is cached and prints its filename """
+        self.verbosity = int(options['verbosity'])
+        if not options['org_id'] or not options['source_id'] or not options['source_version']:
+            raise CommandError("ERROR: the 'org_id', 'source_id' and 'source_version' options are required")
+        if options['ocl_api_env'] and options['ocl_api_env'] not in self.OCL_API_URL:
+            raise CommandError('Invalid "env" option provided: %s' % options['ocl_api_env'])
+        api_url = OclOpenmrsHelper.get_api_url(options['ocl_api_env'], options['api_url'])
+
+        downloader = ExportDownloader(
+            api_url, options['token'] or settings.OCL_API_TOKEN, options['cache_dir'] or settings.OCL_EXPORT_CACHE,
+            max_retries=options['max_retries'], verbosity=self.verbosity)
+        cached = downloader.cache.lookup(options['org_id'], options['source_id'], options['source_version'])
+        started = time.time()
+        try:
+            filename = downloader.fetch(options['org_id'], options['source_id'], options['source_version'],
+                                        sha256=options['sha256'])
+        except DownloadError as e:
+            raise CommandError(str(e))
+
+        if self.verbosity:
+            print '------------------------------------------------------'
+            print 'SUMMARY'
+            print '------------------------------------------------------'
+            if cached:
+                print 'Export already cached'
+            else:
+                print 'Export downloaded in %.1f s' % (time.time() - started)
+            print '------------------------------------------------------'
+        print filename
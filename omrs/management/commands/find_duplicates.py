@@ -0,0 +1,118 @@
+"""
+Command to find near-duplicates between an OCL concept file and the Bahmni/OpenMRS dictionary.
+
+    manage.py find_duplicates --concept_file=concepts.json --threshold=0.7 > duplicates.json
+
+Concepts are compared on the character 3-grams of their names and descriptions using MinHash
+signatures and locality-sensitive hashing, so spelling and casing differences that defeat the
+exact name match in sync_bahmni_db are still found. Each match is printed as one JSON record
+with the incoming concept ID, the target concept ID, the estimated similarity and a name from
+each side.
+
+To merge near-duplicates instead of creating new concepts, write the best match of each
+incoming concept at or above --merge_threshold to a merge file and pass it to sync_bahmni_db:
+
+    manage.py find_duplicates --concept_file=concepts.json --merge_file=merge.json -v0 > duplicates.json
+    manage.py sync_bahmni_db --concept --concept_file=concepts.json --merge_file=merge.json
+
+Set verbosity to 0 (e.g. '-v0') to suppress the results summary output.
+"""
+from optparse import make_option
+import json
+
+from django.core.management import BaseCommand, CommandError
+from omrs.near_duplicates import find_near_duplicates, get_ocl_concept_texts, load_target_texts
+from omrs.ocl_files import iter_records
+
+
+class Command(BaseCommand):
+    """
+    Find near-duplicate concepts between an OCL concept file and the target dictionary
+    """
+
+    # Command attributes
+    help = 'Find near-duplicate concepts between an OCL concept file and the target dictionary'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--concept_file',
+                    action='store',
+                    dest='concept_filename',
+                    default=None,
+                    help='OCL concept filename'),
+        make_option('--threshold',
+                    action='store',
+                    dest='threshold',
+                    default=0.7,
+                    help='Minimum estimated similarity (0 to 1) of a reported match'),
+        make_option('--merge_file',
+                    action='store',
+                    dest='merge_filename',
+                    default=None,
+                    help='Write the best match of each incoming concept to this merge file for sync_bahmni_db'),
+        make_option('--merge_threshold',
+                    action='store',
+                    dest='merge_threshold',
+                    default=0.9,
+                    help='Minimum estimated similarity of a match written to the merge file'),
+        make_option('--include_retired',
+                    action='store_true',
+                    dest='include_retired',
+                    default=False,
+                    help='Also match against retired concepts in the target dictionary.'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options, finds the near-duplicates and writes the report """
+        self.concept_filename = options['concept_filename']
+        self.threshold = float(options['threshold'])
+        self.merge_filename = options['merge_filename']
+        self.merge_threshold = float(options['merge_threshold'])
+        self.verbosity = int(options['verbosity'])
+        if not self.concept_filename:
+            raise CommandError('ERROR: concept_file is a required option')
+
+        # Load the incoming concepts' texts and the target dictionary's texts
+        incoming_texts = []
+        incoming_names = {}
+        for concept in iter_records(self.concept_filename):
+            texts = get_ocl_concept_texts(concept)
+            incoming_texts.append((concept['id'], texts))
+            incoming_names[concept['id']] = texts[0] if texts else None
+        target_texts = load_target_texts(include_retired=options['include_retired'])
+
+        # Report every match and keep the best match of each incoming concept for merging
+        self.cnt_matches = 0
+        merges = {}
+        for incoming_id, target_id, similarity in find_near_duplicates(incoming_texts, target_texts,
+                                                                       self.threshold):
+            self.cnt_matches += 1
+            print json.dumps({
+                'incoming_id': incoming_id,
+                'target_id': target_id,
+                'similarity': round(similarity, 3),
+                'incoming_name': incoming_names[incoming_id],
+                'target_name': target_texts[target_id][0],
+            })
+            if similarity >= self.merge_threshold and str(incoming_id) not in merges:
+                merges[str(incoming_id)] = target_id
+        self.cnt_incoming = len(incoming_texts)
+        self.cnt_merges = len(merges)
+
+        if self.merge_filename:
+            with open(self.merge_filename, 'w') as fp:
+                json.dump(merges, fp)
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        print 'Incoming concepts processed: %d' % self.cnt_incoming
+        print 'Near-duplicate matches: %d' % self.cnt_matches
+        if self.merge_filename:
+            print 'Merges written to %s: %d' % (self.merge_filename, self.cnt_merges)
+        print '------------------------------------------------------'
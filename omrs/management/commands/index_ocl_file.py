@@ -0,0 +1,66 @@
+"""
+Command to build byte-offset indexes for OCL JSON-lines concept and mapping files.
+
+    manage.py index_ocl_file --concept_file=concepts.json --mapping_file=mappings.json
+
+Each index is written next to its data file with an '.idx' suffix. When a concept or mapping
+file has an up-to-date index, sync_bahmni_db --concept_ids reads only the lines of the
+selected concepts instead of parsing the whole file. Rebuild the index whenever the data file
+changes; a stale index is ignored.
+
+Set verbosity to 0 (e.g. '-v0') to suppress the results summary output.
+"""
+from optparse import make_option
+
+from django.core.management import BaseCommand, CommandError
+from omrs.ocl_index import CONCEPT_FILE, MAPPING_FILE, build_index, index_filename
+
+
+class Command(BaseCommand):
+    """
+    Build byte-offset indexes for OCL concept and mapping files
+    """
+
+    # Command attributes
+    help = 'Build byte-offset indexes for OCL concept and mapping files'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--concept_file',
+                    action='store',
+                    dest='concept_filename',
+                    default=None,
+                    help='OCL concept filename'),
+        make_option('--mapping_file',
+                    action='store',
+                    dest='mapping_filename',
+                    default=None,
+                    help='OCL mapping filename'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options and builds the requested indexes """
+        self.verbosity = int(options['verbosity'])
+        files = []
+        if options['concept_filename']:
+            files.append((options['concept_filename'], CONCEPT_FILE))
+        if options['mapping_filename']:
+            files.append((options['mapping_filename'], MAPPING_FILE))
+        if not files:
+            raise CommandError('ERROR: concept_file or mapping_file is a required option')
+
+        self.line_counts = []
+        for filename, file_type in files:
+            self.line_counts.append((index_filename(filename), build_index(filename, file_type)))
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        for filename, count in self.line_counts:
+            print 'INDEX COUNT: %s: %d lines' % (filename, count)
+        print '------------------------------------------------------'
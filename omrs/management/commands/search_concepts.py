@@ -0,0 +1,114 @@
+"""
+Command to build, update and query the concept name search index.
+
+Build the index from the concept dictionary (one bulk scan of concept_name):
+
+    manage.py search_concepts --build --index=concept_names.idx
+
+Search it for ranked matches, optionally restricted to locales:
+
+    manage.py search_concepts --index=concept_names.idx --query="malaria smear" --locales=en,fr --limit=10
+
+Re-index selected concepts after they changed, e.g. after a sync (sync_bahmni_db does this
+itself when given --search_index):
+
+    manage.py search_concepts --index=concept_names.idx --update --concept_ids=5839,1065
+
+Results are printed one per line as tab-separated concept ID, score and matching name.
+"""
+from optparse import make_option
+import time
+
+from django.core.management import BaseCommand, CommandError
+from omrs.name_search import ConceptNameIndex
+from omrs.management.commands import parse_concept_ids
+
+
+class Command(BaseCommand):
+    """
+    Build, update and query the concept name search index
+    """
+
+    # Command attributes
+    help = 'Build, update and query the concept name search index'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--index',
+                    action='store',
+                    dest='index_filename',
+                    default='concept_names.idx',
+                    help='Search index filename'),
+        make_option('--build',
+                    action='store_true',
+                    dest='build',
+                    default=False,
+                    help='Build the index from the concept dictionary.'),
+        make_option('--update',
+                    action='store_true',
+                    dest='update',
+                    default=False,
+                    help='Re-index the concepts given with --concept_ids.'),
+        make_option('--concept_ids',
+                    action='store',
+                    dest='concept_ids',
+                    default=None,
+                    help='Comma-separated concept IDs, or a file of IDs, to re-index with --update'),
+        make_option('--query',
+                    action='store',
+                    dest='query',
+                    default=None,
+                    help='Concept name search text'),
+        make_option('--locales',
+                    action='store',
+                    dest='locales',
+                    default=None,
+                    help='Comma-separated locales to search, e.g. en,fr. Searches all locales if not set.'),
+        make_option('--limit',
+                    action='store',
+                    dest='limit',
+                    default=20,
+                    help='Maximum number of results'),
+        make_option('--include_retired',
+                    action='store_true',
+                    dest='include_retired',
+                    default=False,
+                    help='Include retired concepts in the results.'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options and builds, updates or queries the index """
+        self.index_filename = options['index_filename']
+        self.verbosity = int(options['verbosity'])
+        if not (options['build'] or options['update'] or options['query']):
+            raise CommandError('ERROR: one of build, update or query is a required option')
+        if options['update'] and not options['concept_ids']:
+            raise CommandError('ERROR: concept_ids is a required option for update')
+
+        start = time.time()
+        if options['build']:
+            index = ConceptNameIndex.build()
+            index.save(self.index_filename)
+            if self.verbosity:
+                print 'Indexed %d names in %.1fs' % (len(index.names), time.time() - start)
+        else:
+            index = ConceptNameIndex.load(self.index_filename)
+
+        if options['update']:
+            try:
+                concept_ids = parse_concept_ids(options['concept_ids'])
+            except ValueError as e:
+                raise CommandError('Invalid concept ID: %s' % e)
+            index.update(concept_ids)
+            index.save(self.index_filename)
+            if self.verbosity:
+                print 'Re-indexed %d concepts' % len(concept_ids)
+
+        if options['query']:
+            locales = options['locales'].split(',') if options['locales'] else None
+            start = time.time()
+            results = index.search(options['query'], locales=locales, limit=int(options['limit']),
+                                   include_retired=options['include_retired'])
+            for concept_id, score, name in results:
+                print (u'%s\t%s\t%s' % (concept_id, score, name)).encode('utf-8')
+            if self.verbosity >= 2:
+                print '%d results in %.1fms' % (len(results), (time.time() - start) * 1000)
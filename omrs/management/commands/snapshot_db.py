@@ -0,0 +1,63 @@
+"""
+Command to copy the OpenMRS concept dictionary tables from MySQL into a local snapshot database.
+
+    manage.py snapshot_db
+
+The snapshot is a SQLite file, set by the 'snapshot' entry of DATABASES in omrs/settings.py
+(override the location with the OMRS_SNAPSHOT_DB environment variable). Read-only commands
+can then run against the snapshot instead of MySQL, e.g.:
+
+    manage.py extract_db --org_id=CIEL --source_id=CIEL --raw -v0 --concepts --snapshot > concepts.json
+    manage.py validate_export --export=EXPORT_FILE_NAME --snapshot
+
+Re-run snapshot_db to refresh the snapshot; existing snapshot tables are replaced.
+
+Set verbosity to 0 (e.g. '-v0') to suppress the results summary output. Set verbosity to 2
+to see all debug output.
+"""
+from optparse import make_option
+
+from django.core.management import BaseCommand
+from omrs.snapshot import create_snapshot, snapshot_filename
+
+
+class Command(BaseCommand):
+    """
+    Copy the concept dictionary tables into the local snapshot database
+    """
+
+    # Command attributes
+    help = 'Copy the concept dictionary tables into the local snapshot database'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--batch_size',
+                    action='store',
+                    dest='batch_size',
+                    default=5000,
+                    help='Number of rows fetched and inserted at a time'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options and creates the snapshot """
+        self.batch_size = int(options['batch_size'])
+        self.verbosity = int(options['verbosity'])
+
+        # Option debug output
+        if self.verbosity >= 2:
+            print 'COMMAND LINE OPTIONS:', options
+
+        self.table_counts = create_snapshot(batch_size=self.batch_size, verbosity=self.verbosity)
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        print 'Snapshot database: %s' % snapshot_filename()
+        for table, count in self.table_counts:
+            print 'SNAPSHOT COUNT: %s: %d' % (table, count)
+        print '------------------------------------------------------'
@@ -5,6 +5,57 @@ Example usage:
 
     manage.py sync_bahmni_db --org_id=CIEL --source_id=CIEL
 
+Mappings are synced after their concepts, using the keys file written by the concept sync:
+
+    manage.py sync_bahmni_db --mapping --keys=keys_new.json --mapping_file=mappings.json
+
+Every concept referenced by the mapping file is checked against the database before any
+mapping is written. Mappings that cannot be resolved are written to a reject file
+(--reject_file, by default the mapping filename with a '.rejected' suffix) and the remaining
+mappings are applied in batches of --batch_size, one transaction per batch.
+
+To sync a selection of concepts in one run, pass a comma-separated list of IDs or the name of a
+file of IDs with --concept_ids. Only the matching records of the concept file (and, with
+--mapping, the mappings from those concepts) are kept in memory. When --keys is given with
+--concept, the keys file is updated in place so that repeated batch syncs accumulate.
+To merge incoming concepts into near-duplicates already in the dictionary, pass the merge file
+written by find_duplicates with --merge_file. A listed concept that has no exact name match is
+not created; its names are added as synonyms of the matched concept instead.
+With --workers N, concepts and then mappings are split by concept ID across N processes, each
+with its own database connection and a reserved range of new IDs. Concepts that share a name
+are synced by the same worker, so they match each other as in a sequential sync. Mappings are
+synced only after all concepts, so a mapping can target a concept created by any worker.
+If the concept or mapping file has been indexed with index_ocl_file, only the lines of the
+selected concepts are read from it:
+
+    manage.py sync_bahmni_db --concept --concept_file=concepts.json --keys=keys.json --concept_ids=ids.txt
+    manage.py sync_bahmni_db --mapping --mapping_file=mappings.json --keys=keys.json --concept_ids=ids.txt
+
+The progress of a long sync (records processed per phase, rate, ETA, query count and memory
+use) is written to a JSON file with --status_file and to a Prometheus textfile with
+--metrics_file.
+
+Transient MySQL errors (lost connections, lock wait timeouts and deadlocks) are retried up to
+--max_retries times on a new connection. The batch being synced was rolled back with its
+transaction and is replayed from the start; concepts and mappings are matched against existing
+rows, so replaying a batch never creates duplicates.
+
+To populate an empty dictionary, --bulk_load writes the concepts and mappings as one TSV file
+per table, with pre-assigned IDs and UUIDs, and loads them with LOAD DATA LOCAL INFILE in one
+transaction. Foreign key and unique checks are deferred to a verification of the loaded rows
+that rolls the load back if it fails. Incoming concepts are not matched to existing ones by
+name, so this is only meant for an initial load:
+
+    manage.py sync_bahmni_db --concept --mapping --concept_file=concepts.json --mapping_file=mappings.json --keys=keys.json --bulk_load=bulk
+
+The concept and mapping files may be compressed (.gz, .bz2 or .xz) or name several files: a
+glob pattern, a comma-separated list, or a shard directory written by extract_db --output_dir:
+
+    manage.py sync_bahmni_db --concept --concept_file='concepts/*.json.gz' --keys=keys.json
+
+They may also be an OCL source version export, ocl://OWNER/SOURCE/VERSION, downloaded into
+the export cache as it is read (see fetch_ocl_export).
+
 Set verbosity to 0 (e.g. '-v0') to suppress the results summary output. Set verbosity to 2
 to see all debug output.
 
@@ -17,16 +68,27 @@ BUGS:
 
 import json
 from optparse import make_option
+from django.db import connections, transaction
 from django.db.models import Max
 from django.db.utils import IntegrityError
 from django.db.models import ObjectDoesNotExist
 import datetime
+import multiprocessing
+import os
+import Queue
+import traceback
 import uuid
-import iso8601
-import requests
 
 from django.core.management import BaseCommand, CommandError
-from omrs.management.commands import (OclOpenmrsHelper, UnrecognizedSourceException)
+from omrs.bulk_load import BULK_LOAD_MODELS, BulkLoadError, TableFile, load_table_files
+from omrs.management.commands import (OclOpenmrsHelper, UnrecognizedSourceException, chunks,
+                                      parse_concept_ids)
+from omrs.name_search import ConceptNameIndex
+from omrs.ocl_files import is_concept, is_mapping, iter_records
+from omrs.ocl_schema import OclFileValidator
+from omrs.progress import ProgressReporter
+from omrs.retry import DEFAULT_MAX_RETRIES, Retrier
+from omrs.ocl_index import CONCEPT_FILE, MAPPING_FILE, OclFileIndex, get_record_concept_id, has_index
 from omrs.models import ConceptReferenceSource, Concept, ConceptAnswer, ConceptClass, ConceptDatatype, ConceptName, ConceptReferenceMap, ConceptReferenceSource, ConceptSet, ConceptReferenceTerm, ConceptMapType, ConceptNumeric, ConceptDescription
 
 
@@ -39,6 +101,7 @@ class Command(BaseCommand):
 
     # Command attributes
     help = 'Synchronize Bahmni/OpenMRS DB with concepts and mappping'
+    requires_model_validation = False
     option_list = BaseCommand.option_list + (
         make_option('--concept_file',
                     action='store',
@@ -65,11 +128,66 @@ class Command(BaseCommand):
                     dest='mapping_filename',
                     default=None,
                     help='OCL mapping filename'),
+        make_option('--reject_file',
+                    action='store',
+                    dest='reject_filename',
+                    default=None,
+                    help='File for mappings that cannot be resolved, defaults to MAPPING_FILE.rejected'),
+        make_option('--batch_size',
+                    action='store',
+                    dest='batch_size',
+                    default=1000,
+                    help='Number of mappings synced per transaction'),
+        make_option('--preflight',
+                    action='store_true',
+                    dest='preflight',
+                    default=False,
+                    help='Check the concept and mapping files with check_ocl_files before writing anything'),
+        make_option('--workers',
+                    action='store',
+                    dest='workers',
+                    default=1,
+                    help='Number of worker processes syncing concepts and mappings in parallel'),
+        make_option('--status_file',
+                    action='store',
+                    dest='status_filename',
+                    default=None,
+                    help='JSON file updated with the progress of the sync'),
+        make_option('--metrics_file',
+                    action='store',
+                    dest='metrics_filename',
+                    default=None,
+                    help='Prometheus textfile (*.prom) updated with the progress of the sync'),
+        make_option('--max_retries',
+                    action='store',
+                    dest='max_retries',
+                    default=DEFAULT_MAX_RETRIES,
+                    help='Number of times to replay a batch after a transient database error'),
+        make_option('--bulk_load',
+                    action='store',
+                    dest='bulk_load_dir',
+                    default=None,
+                    help='Initial load: write TSV files per table to this directory and load them with LOAD DATA'),
+        make_option('--search_index',
+                    action='store',
+                    dest='search_index',
+                    default=None,
+                    help='Concept name search index (see search_concepts) to update with the synced concepts'),
+        make_option('--merge_file',
+                    action='store',
+                    dest='merge_filename',
+                    default=None,
+                    help='Merge file written by find_duplicates; listed concepts are merged into their match'),
         make_option('--concept_id',
                     action='store',
                     dest='concept_id',
                     default=None,
                     help='ID for concept to sync, if specified only sync this one. e.g. 5839'),
+        make_option('--concept_ids',
+                    action='store',
+                    dest='concept_ids',
+                    default=None,
+                    help='Comma-separated concept IDs, or a file of IDs, to sync. e.g. 5839,1065'),
         make_option('--retired',
                     action='store_true',
                     dest='retire_sw',
@@ -102,11 +220,7 @@ class Command(BaseCommand):
                     help='OCL API token to validate OpenMRS reference sources'),
     )
 
-    OCL_API_URL = {
-        'dev': 'http://api.dev.openconceptlab.com/',
-        'staging': 'http://api.staging.openconceptlab.com/',
-        'production': 'http://api.openconceptlab.com/',
-    }
+    OCL_API_URL = OclOpenmrsHelper.OCL_API_URL
 
     ## EXTRACT_DB COMMAND LINE HANDLER AND VALIDATION
 
@@ -122,18 +236,41 @@ class Command(BaseCommand):
         self.org_id = options['org_id']
         self.concept=options['concept']
         self.mapping = options['mapping']
+        self.keys = options['keys']
         if self.mapping:
-            self.keys = options['keys']
             self.mapping_filename = options['mapping_filename']
+            self.reject_filename = options['reject_filename']
+        self.batch_size = int(options['batch_size'])
+        self.workers = int(options['workers'])
+        if self.workers < 1:
+            raise CommandError('ERROR: workers must be at least 1')
+        self.search_index = options['search_index']
+        self.bulk_load_dir = options['bulk_load_dir']
         self.source_id = options['source_id']
         if self.concept:
-            self.concept_id = options['concept_id']
             self.concept_filename = options['concept_filename']
+        self.merge_ids = {}
+        if options['merge_filename']:
+            with open(options['merge_filename'], 'r') as fp:
+                self.merge_ids = json.load(fp)
+        self.concept_id = options['concept_id']
+        self.concept_ids = None
+        try:
+            if options['concept_ids'] is not None:
+                self.concept_ids = set(parse_concept_ids(options['concept_ids']))
+            elif self.concept_id is not None:
+                self.concept_ids = set([int(self.concept_id)])
+        except ValueError as e:
+            raise CommandError('Invalid concept ID: %s' % e)
 
 
         self.do_retire = options['retire_sw']
 
         self.verbosity = int(options['verbosity'])
+        self.retrier = Retrier(max_retries=int(options['max_retries']), verbosity=self.verbosity)
+        self.progress = ProgressReporter('sync_bahmni_db', status_filename=options['status_filename'],
+                                         metrics_filename=options['metrics_filename'])
+        self.progress_queue = None
         self.ocl_api_token = options['token']
         if options['ocl_api_env']:
             self.ocl_api_env = options['ocl_api_env'].lower()
@@ -144,6 +281,28 @@ class Command(BaseCommand):
 
         # Validate the options
         self.validate_options()
+        if self.mapping and not self.reject_filename:
+            self.reject_filename = self.mapping_filename + '.rejected'
+
+        # Check the input files before anything is written
+        if options['preflight']:
+            self.check_files()
+
+        # Initialize counters and mapping resolution state
+        self.cnt_total_concepts_processed = 0
+        self.cnt_concepts_merged = 0
+        self.cnt_mappings_processed = 0
+        self.cnt_mappings_synced = 0
+        self.cnt_mappings_existing = 0
+        self.cnt_mappings_rejected = 0
+        self.rejected_mappings = []
+        self.map_types = None
+        self.sources = None
+        self.next_ids = {}
+        self.id_ranges = {}
+        self.id_limits = {}
+        self.terms = {}
+        self.bulk_rows_loaded = {}
 
         # Load the concepts and mapping file into memory
         # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
@@ -151,24 +310,77 @@ class Command(BaseCommand):
 
 
 
-        if self.concept:
+        if self.bulk_load_dir:
             self.concepts_id_added = {}
-            concepts = []
-            for line in open(self.concept_filename, 'r'):
-                concepts.append(json.loads(line))
-            self.sync_db(concepts=concepts)
-        if self.mapping:
-            mappings = []
-            with open(self.keys, 'r') as fp:
-                self.concepts_id_added = json.load(fp)
-            for line in open(self.mapping_filename, 'r'):
-                mappings.append(json.loads(line))
-            self.sync_db(mappings=mappings)
+            if os.path.exists(self.keys):
+                with open(self.keys, 'r') as fp:
+                    self.concepts_id_added = json.load(fp)
+            concepts = self.load_records(self.concept_filename, CONCEPT_FILE) if self.concept else []
+            mappings = self.load_records(self.mapping_filename, MAPPING_FILE) if self.mapping else []
+            self.bulk_load(concepts, mappings)
+        else:
+            if self.concept:
+                self.concepts_id_added = {}
+                if self.keys and os.path.exists(self.keys):
+                    with open(self.keys, 'r') as fp:
+                        self.concepts_id_added = json.load(fp)
+                concepts = self.load_records(self.concept_filename, CONCEPT_FILE)
+                self.sync_db(concepts=concepts)
+            if self.mapping:
+                with open(self.keys, 'r') as fp:
+                    self.concepts_id_added = json.load(fp)
+                mappings = self.load_records(self.mapping_filename, MAPPING_FILE)
+                self.sync_db(mappings=mappings)
+        self.progress.finish()
 
         # Display final counts
         if self.verbosity:
             self.print_debug_summary()
 
+    def check_files(self):
+        """ Validates the concept and mapping files and raises CommandError if there are problems """
+        known_concept_ids = []
+        if self.keys and os.path.exists(self.keys):
+            with open(self.keys, 'r') as fp:
+                known_concept_ids = [int(concept_id) for concept_id in json.load(fp)]
+        # A batch sync with 'concept_ids' may legitimately leave other concepts' mappings unresolved
+        validator = OclFileValidator(known_concept_ids=known_concept_ids,
+                                     check_references=self.concept_ids is None)
+        errors = []
+        if self.concept:
+            errors.extend(validator.validate_concept_file(self.concept_filename))
+        if self.mapping:
+            errors.extend(validator.validate_mapping_file(self.mapping_filename))
+        if errors:
+            for error in errors[:20]:
+                print json.dumps(error)
+            raise CommandError('%d problems found in the OCL files, see check_ocl_files for a full report' % len(errors))
+
+    def load_records(self, filename, file_type):
+        """
+        Returns the records of an OCL JSON-lines file or export, restricted to 'concept_ids' if set.
+        Records of the other type are skipped, so the same shards can be given as concept
+        and mapping files.
+
+        With 'concept_ids' set and an up-to-date index (see index_ocl_file), only the lines of
+        the selected concepts are read; otherwise the whole file is parsed.
+        """
+        if self.concept_ids is not None and has_index(filename):
+            index = OclFileIndex(filename)
+            try:
+                return list(index.records_for(sorted(self.concept_ids)))
+            finally:
+                index.close()
+        records = []
+        for record in iter_records(filename):
+            # Shards written by extract_db --output_dir hold both concepts and mappings
+            other_type = is_mapping(record) if file_type == CONCEPT_FILE else is_concept(record)
+            if other_type:
+                continue
+            if self.concept_ids is None or get_record_concept_id(record, file_type) in self.concept_ids:
+                records.append(record)
+        return records
+
     def validate_options(self):
         """
         Returns true if command line options are valid, false otherwise.
@@ -180,12 +392,16 @@ class Command(BaseCommand):
         if (not self.concept and not self.mapping):
             raise CommandError(
                 ("ERROR: concept and mapping  are required options "))
-        if (self.mapping and not self.keys and not self.mapping_filename):
+        if (self.mapping and (not self.keys or not self.mapping_filename)):
             raise CommandError(
                 ("ERROR:  mapping json file and keys file names are required options "))
         if (self.concept and not self.concept_filename):
             raise CommandError(
                 ("ERROR: concept  json file name is required option "))
+        if self.bulk_load_dir and (not self.keys or self.workers > 1 or self.merge_ids or self.search_index):
+            raise CommandError(
+                ("ERROR: 'bulk_load' requires the 'keys' option and cannot be combined with "
+                 "'workers', 'merge_file' or 'search_index'"))
         if self.ocl_api_env not in self.OCL_API_URL:
             raise CommandError('Invalid "env" option provided: %s' % self.ocl_api_env)
         return True
@@ -195,29 +411,29 @@ class Command(BaseCommand):
         print '------------------------------------------------------'
         print 'SUMMARY'
         print '------------------------------------------------------'
-        print 'Total concepts processed: %d' % self.cnt_total_concepts_processed
-        if self.do_concept:
-            print 'EXPORT COUNT: Concepts: %d' % self.cnt_concepts_exported
-        if self.do_mapping:
-            print 'EXPORT COUNT: All Mappings: %d' % (self.cnt_internal_mappings_exported +
-                                                      self.cnt_external_mappings_exported +
-                                                      self.cnt_answers_exported +
-                                                      self.cnt_set_members_exported)
-            print 'EXPORT COUNT: Internal Mappings: %d' % self.cnt_internal_mappings_exported
-            print 'EXPORT COUNT: External Mappings: %d' % self.cnt_external_mappings_exported
-            print 'EXPORT COUNT: Linked Answer Mappings: %d' % self.cnt_answers_exported
-            print 'EXPORT COUNT: Set Member Mappings: %d' % self.cnt_concepts_exported
-            print 'Questions Processed: %d' % self.cnt_questions_exported
-            print 'Concept Sets Processed: %d' % self.cnt_concept_sets_exported
-            print 'Ignored Self Mappings: %d' % self.cnt_ignored_self_mappings
-        if self.do_retire:
-            print 'EXPORT COUNT: Retired Concept IDs: %d' % self.cnt_retired_concepts_exported
+        if self.concept:
+            print 'Total concepts processed: %d' % self.cnt_total_concepts_processed
+            if self.merge_ids:
+                print 'Concepts merged into near-duplicates: %d' % self.cnt_concepts_merged
+        if self.mapping:
+            print 'Total mappings processed: %d' % self.cnt_mappings_processed
+            print 'SYNC COUNT: Mappings created: %d' % self.cnt_mappings_synced
+            print 'Mappings already present: %d' % self.cnt_mappings_existing
+            print 'Mappings rejected: %d' % self.cnt_mappings_rejected
+            if self.cnt_mappings_rejected:
+                print 'Rejected mappings written to %s' % self.reject_filename
+        if self.retrier.counts:
+            print 'Transient database errors retried: %s' % self.retrier.summary()
+        for model in BULK_LOAD_MODELS:
+            if self.bulk_rows_loaded.get(model._meta.db_table):
+                print 'BULK LOAD: %s rows: %d' % (model._meta.db_table, self.bulk_rows_loaded[model._meta.db_table])
         print '------------------------------------------------------'
 
     ## REFERENCE SOURCE VALIDATOR
 
     def check_sources(self):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
+        import requests
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
         reference_sources = ConceptReferenceSource.objects.all()
@@ -256,32 +472,291 @@ class Command(BaseCommand):
         Note that the retired status of concepts is not handled here.
         """
         output_indent = None
-        # Create the concept enumerator, applying 'concept_id'
+        # 'concept_ids' has already been applied when loading
         if self.concept:
-            if self.concept_id is not None:
-                # If 'concept_id' option set, fetch a single concept and convert to enumerator
-                for i in range(len(concepts)):
-                    if concepts[i]['id'] == int(self.concept_id):
-                        concept_enumerator = enumerate([concepts[i]])
-                        break
-
+            self.sync_concepts(concepts)
 
-            else:
-                # Fetch all concepts
-                concept_enumerator = enumerate(concepts)
-            # Iterate concept enumerator and process the export
-            for num, concept in concept_enumerator:
-                self.sync_concept(concept)
+            # Re-index the names of the synced concepts in the search index
+            if self.search_index:
+                synced_ids = [int(self.concepts_id_added[str(concept['id'])]) for concept in concepts
+                              if str(concept['id']) in self.concepts_id_added]
+                index = ConceptNameIndex.load(self.search_index)
+                index.update(synced_ids)
+                index.save(self.search_index)
 
             data = self.concepts_id_added
-            with open('/home/rishabh/Developer/ccbd_internship/OCL/omrs/keys_new.json', 'w') as fp:
+            keys_filename = self.keys or '/home/rishabh/Developer/ccbd_internship/OCL/omrs/keys_new.json'
+            with open(keys_filename, 'w') as fp:
                 json.dump(data, fp)
 
         if self.mapping:
-            external_mapping = self.generate_external_mapping(mappings)
-            internal_mapping = self.generate_internal_mapping(mappings)
-            self.sync_external_mapping(external_mapping)
-            self.sync_internal_mapping(internal_mapping)
+            # Resolve all referenced concepts up front, then sync external before internal mappings
+            external_mapping = self.resolve_mappings(self.generate_external_mapping(mappings))
+            internal_mapping = self.resolve_mappings(self.generate_internal_mapping(mappings))
+            self.load_terms(external_mapping + internal_mapping)
+            self.sync_mappings(external_mapping, internal_mapping)
+            self.write_rejected_mappings()
+
+    def sync_concepts(self, concepts):
+        """
+        Syncs the concepts, split by concept ID across the worker processes.
+
+        New concept IDs are allocated from ranges reserved above both the largest concept_id in
+        the database and the largest incoming concept ID, so that the incoming IDs that are
+        kept never collide with allocated ones. Concept classes and datatypes are created up
+        front so that workers never race to create the same one. Incoming concepts are matched to
+        existing ones by name, so concepts sharing a name are synced by the same worker, in file
+        order, and match each other as in a sequential sync.
+        """
+        if not concepts:
+            return
+        self.progress.start_phase('concepts', total=len(concepts))
+        self.create_concept_classes_and_datatypes(concepts)
+        group_ids = self.get_name_group_ids(concepts)
+        partitions = self.partition(range(len(concepts)), lambda index: group_ids[index])
+        partitions = [[concepts[index] for index in partition] for partition in partitions]
+        self.reserve_id_ranges(Concept, 'concept_id', max(len(partition) for partition in partitions),
+                               floor=max(int(concept['id']) for concept in concepts))
+        self.run_partitions(self.sync_concept_partition, partitions)
+
+    def sync_concept_partition(self, partition):
+        """ Syncs a partition of the concepts in batches, one transaction per batch """
+        for batch in chunks(partition, self.batch_size):
+            self.run_batch(self.sync_concept_batch, batch)
+            self.report_progress(len(batch))
+
+    def sync_concept_batch(self, batch):
+        for concept in batch:
+            self.cnt_total_concepts_processed += 1
+            self.sync_concept(concept)
+
+    def create_concept_classes_and_datatypes(self, concepts):
+        """ Creates the concept classes and datatypes used by concepts that are not in the database """
+        for class_name in set(concept['concept_class'] for concept in concepts):
+            if not ConceptClass.objects.filter(name=class_name).exists():
+                ConceptClass(name=class_name, retired=False, creator=1, date_created=datetime.datetime.now(),
+                             uuid=uuid.uuid1()).save()
+        for datatype_name in set(concept['datatype'] for concept in concepts):
+            if not ConceptDatatype.objects.filter(name=datatype_name).exists():
+                ConceptDatatype(name=datatype_name, creator=1, date_created=datetime.datetime.now()).save()
+
+    def sync_mappings(self, external_mapping, internal_mapping):
+        """
+        Syncs the resolved mappings, split by from concept across the worker processes.
+
+        Runs after the concept sync has finished, so mappings can target concepts created by
+        any worker. Every (set owner, member), (question, answer) and (concept, term, map type)
+        belongs to the partition of its from concept, so workers never write the same row.
+        """
+        self.progress.start_phase('mappings', total=len(external_mapping) + len(internal_mapping))
+        partitions = self.partition(external_mapping + internal_mapping, lambda resolved: resolved[1])
+        size = max(len(partition) for partition in partitions)
+        external_map_ids = [int(i['concept_map_id']) for i, new_con_id, new_to_con_id in external_mapping
+                            if i.get('concept_map_id') is not None]
+        self.reserve_id_ranges(ConceptReferenceMap, 'concept_map_id', size, floor=max(external_map_ids or [0]))
+        self.reserve_id_ranges(ConceptSet, 'concept_set_id', size)
+        self.reserve_id_ranges(ConceptAnswer, 'concept_answer_id', size)
+        self.run_partitions(self.sync_mapping_partition, partitions)
+
+    def sync_mapping_partition(self, partition):
+        """ Syncs a partition of the resolved mappings, external mappings first """
+        self.sync_external_mapping([resolved for resolved in partition if 'to_source_url' in resolved[0]])
+        self.sync_internal_mapping([resolved for resolved in partition if 'to_source_url' not in resolved[0]])
+
+    ## PARALLEL WORKERS
+
+    # Counters summed over the worker processes
+    WORKER_COUNTERS = (
+        'cnt_total_concepts_processed',
+        'cnt_concepts_merged',
+        'cnt_mappings_processed',
+        'cnt_mappings_synced',
+        'cnt_mappings_existing',
+        'cnt_mappings_rejected',
+    )
+
+    # Seconds the parent waits for a worker message before checking that the workers are alive
+    WORKER_POLL_INTERVAL = 5
+
+    def partition(self, items, get_concept_id):
+        """ Splits items into one list per worker by concept ID """
+        partitions = [[] for _ in range(self.workers)]
+        for item in items:
+            partitions[get_concept_id(item) % self.workers].append(item)
+        return partitions
+
+    def get_name_group_ids(self, concepts):
+        """
+        Returns, for each concept, the ID of the first concept linked to it by shared names: a
+        concept shares a name with the next, which shares another name with the next, and so on.
+        Names are compared case-insensitively and without trailing spaces, as MySQL compares them.
+        """
+        # Union-find over concept indexes and names
+        parents = {}
+
+        def find(node):
+            root = node
+            while parents.get(root, root) != root:
+                root = parents[root]
+            while node != root:
+                parents[node], node = root, parents[node]
+            return root
+
+        for index, concept in enumerate(concepts):
+            for cname in concept['names']:
+                name_root, concept_root = find(('name', unicode(cname['name']).rstrip(u' ').lower())), find(index)
+                if name_root != concept_root:
+                    # The concept that comes first in the file stays the root of the group
+                    if isinstance(name_root, tuple) or name_root > concept_root:
+                        parents[name_root] = concept_root
+                    else:
+                        parents[concept_root] = name_root
+        return [int(concepts[find(index)]['id']) for index in range(len(concepts))]
+
+    def reserve_id_ranges(self, model, id_field, size, floor=0):
+        """
+        Reserves a disjoint range of size primary keys of model for each worker, starting above
+        the larger of the table's MAX(id_field) and floor.
+        """
+        max_id = max(model.objects.aggregate(Max(id_field))[id_field + '__max'] or 0, floor)
+        self.id_ranges[model] = [(max_id + 1 + num * size, max_id + 1 + (num + 1) * size)
+                                 for num in range(self.workers)]
+
+    def claim_id_ranges(self, num):
+        """ Makes allocate_id() hand out the IDs reserved for worker num """
+        for model, ranges in self.id_ranges.iteritems():
+            self.next_ids[model], self.id_limits[model] = ranges[num]
+
+    def run_partitions(self, target, partitions):
+        """
+        Runs target(partition) for each partition, in this process for a single worker or in one
+        process per partition otherwise, and merges the workers' counters and keys.
+        """
+        if self.workers == 1:
+            self.claim_id_ranges(0)
+            target(partitions[0])
+            return
+
+        # Forked workers must open their own database connections
+        for connection in connections.all():
+            connection.close()
+        queue = multiprocessing.Queue()
+        processes = []
+        for num, partition in enumerate(partitions):
+            process = multiprocessing.Process(target=self.run_worker, args=(queue, target, num, partition))
+            process.start()
+            processes.append(process)
+        results = {}
+        while len(results) < len(processes):
+            try:
+                result = queue.get(timeout=self.WORKER_POLL_INTERVAL)
+            except Queue.Empty:
+                # A worker killed by a signal or os._exit() never posts its result
+                dead = [num for num, process in enumerate(processes)
+                        if num not in results and not process.is_alive()]
+                if dead:
+                    # Take the results a worker posted just before it exited
+                    self.drain_worker_results(queue, results)
+                    dead = [num for num in dead if num not in results]
+                if dead:
+                    for process in processes:
+                        if process.is_alive():
+                            process.terminate()
+                    raise CommandError('ERROR: Sync worker for partition %d exited with code %s without a result' % (
+                        dead[0], processes[dead[0]].exitcode))
+                continue
+            self.add_worker_result(result, results)
+        for process in processes:
+            process.join()
+        results = [results[num] for num in sorted(results)]
+
+        errors = [result['error'] for result in results if 'error' in result]
+        if errors:
+            raise CommandError('Sync worker failed:\n%s' % errors[0])
+        for result in results:
+            for counter, value in result['counters'].iteritems():
+                setattr(self, counter, getattr(self, counter) + value)
+            self.concepts_id_added.update(result['concepts_id_added'])
+            self.rejected_mappings.extend(result['rejected_mappings'])
+            self.retrier.merge(result['retries'])
+
+    def add_worker_result(self, result, results):
+        """ Reports a worker's progress message, or stores its final result in results by worker number """
+        if 'progress' in result:
+            self.progress.advance(result['progress'])
+        else:
+            results[result['num']] = result
+
+    def drain_worker_results(self, queue, results):
+        """ Handles the messages still queued by workers that have exited """
+        while True:
+            try:
+                result = queue.get(timeout=0.1)
+            except Queue.Empty:
+                return
+            self.add_worker_result(result, results)
+
+    def report_progress(self, count):
+        """ Counts synced records, reporting them to the parent process from a worker """
+        if self.progress_queue is not None:
+            self.progress_queue.put({'progress': count})
+        else:
+            self.progress.advance(count)
+
+    def run_worker(self, queue, target, num, partition):
+        """ Entry point of a worker process: syncs a partition and sends its results to the parent """
+        try:
+            for counter in self.WORKER_COUNTERS:
+                setattr(self, counter, 0)
+            self.rejected_mappings = []
+            self.retrier.counts = {}
+            self.progress_queue = queue
+            self.claim_id_ranges(num)
+            target(partition)
+            queue.put({
+                'num': num,
+                'counters': dict((counter, getattr(self, counter)) for counter in self.WORKER_COUNTERS),
+                'concepts_id_added': self.concepts_id_added,
+                'rejected_mappings': self.rejected_mappings,
+                'retries': self.retrier.counts,
+            })
+        except Exception:
+            queue.put({'num': num, 'error': traceback.format_exc()})
+        finally:
+            for connection in connections.all():
+                connection.close()
+
+    ## BATCH REPLAY
+
+    def run_batch(self, function, *args):
+        """
+        Runs function(*args) in one transaction, replaying it after a transient database error.
+
+        The failed transaction has been rolled back, so the counters, keys, reject list, term
+        cache and allocated IDs are restored to their state before the batch and the whole
+        batch is run again on a new connection.
+        """
+        state = self.save_batch_state()
+
+        def attempt():
+            self.restore_batch_state(state)
+            with transaction.atomic():
+                function(*args)
+        self.retrier.run(attempt)
+
+    def save_batch_state(self):
+        return (dict((counter, getattr(self, counter)) for counter in self.WORKER_COUNTERS),
+                dict(getattr(self, 'concepts_id_added', {})), len(self.rejected_mappings), dict(self.terms),
+                dict(self.next_ids))
+
+    def restore_batch_state(self, state):
+        counters, concepts_id_added, rejected_count, terms, next_ids = state
+        for counter, value in counters.iteritems():
+            setattr(self, counter, value)
+        self.concepts_id_added = dict(concepts_id_added)
+        del self.rejected_mappings[rejected_count:]
+        self.terms = dict(terms)
+        self.next_ids = dict(next_ids)
 
     def sync_concept(self, concept):
         """
@@ -361,30 +836,43 @@ class Command(BaseCommand):
                                 #print(cname['name'])
                                 #print(id)
 
-                        self.concepts_id_added[concept['id']] = con_id
+                        self.concepts_id_added[str(concept['id'])] = con_id
+            merged = False
+            if at_lst_one == 0 and self.merge_ids.get(str(concept['id'])) is not None:
+                # near-duplicate found by find_duplicates, add the names to the existing concept
+                merge_id = self.merge_ids[str(concept['id'])]
+                if Concept.objects.filter(concept_id=merge_id).exists():
+                    con_id = merge_id
+                    merged = True
+                    at_lst_one = 1
+                    self.cnt_concepts_merged += 1
+                    self.concepts_id_added[str(concept['id'])] = con_id
             if at_lst_one == 0:
                 #all concept names have to be inserted
                 conc = Concept.objects.filter(concept_id=con_id)
                 if len(conc) != 0:# that id exists
                     #generate new id that is not in openmrs
-                    cconc = Concept.objects.aggregate(Max('concept_id'))
-                    con_id = cconc['concept_id__max']+1
+                    con_id = self.allocate_id(Concept, 'concept_id')
 
                 conc = Concept(concept_id=con_id, retired=concept['retired'], datatype=datatype, creator = 1,
                                date_created = datetime.datetime.now(),
                                concept_class=concept_class, uuid=concept['external_id'], is_set=concept['is_set'])
                 conc.save()
-                self.concepts_id_added[concept['id']] = con_id
+                self.concepts_id_added[str(concept['id'])] = con_id
             #print id
             for cname in cnames:
                 concept_name = ConceptName.objects.filter(name=cname['name'], concept_name_type=cname['name_type'],
                                                           locale=cname['locale'], locale_preferred=cname['locale_preferred'])
                 if len(concept_name) == 0:#if concept name not there
                     conc = Concept.objects.get(concept_id=con_id)
+                    name_type, locale_preferred = cname['name_type'], cname['locale_preferred']
+                    if merged:
+                        # the existing concept keeps its own fully specified and preferred names
+                        name_type, locale_preferred = 'SYNONYM', False
                     concept_name = ConceptName(concept=conc, name=cname['name'], uuid=cname['external_id'],
                                                creator = 1, date_created = datetime.datetime.now(),
-                                               concept_name_type=cname['name_type'], locale=cname['locale'],
-                                               locale_preferred=cname['locale_preferred'], voided=cname['voided'])
+                                               concept_name_type=name_type, locale=cname['locale'],
+                                               locale_preferred=locale_preferred, voided=cname['voided'])
                     concept_name.save()
             conc = Concept.objects.get(concept_id=con_id)
             # Concept Descriptions
@@ -443,12 +931,14 @@ class Command(BaseCommand):
 
 
     def segregate_mapping(self, mappings):
+        """ Returns the mappings whose from concept is one of the selected concept_ids, if any """
+        if self.concept_ids is None:
+            return mappings
         mapping = []
-        if self.concept_id is not None:
-            for i in mappings:
-                con_id = int(i['from_concept_url'].split('/')[-2])
-                if con_id == int(self.concept_id):
-                    mapping.append(i)
+        for i in mappings:
+            con_id = OclOpenmrsHelper.get_concept_id_from_url(i['from_concept_url'])
+            if con_id in self.concept_ids:
+                mapping.append(i)
         return mapping
 
 
@@ -478,124 +968,413 @@ class Command(BaseCommand):
                 external_mapping.append(i)
         return external_mapping
 
+    ## MAPPING RESOLUTION
+
+    def resolve_mappings(self, mappings, known_ids=()):
+        """
+        Resolve the Bahmni concept IDs referenced by each mapping before anything is written.
+
+        The from concept of every mapping (and the to concept of Q-AND-A and CONCEPT-SET
+        mappings) is translated through the keys file and then checked against the database
+        with chunked "IN" queries. Mappings that cannot be resolved are rejected instead of
+        aborting the run.
+        :param mappings: List of OCL-formatted mapping dictionaries.
+        :param known_ids: Concept IDs to treat as existing without checking the database, e.g.
+                          the concepts of a bulk load that has not been loaded yet.
+        :returns: List of (mapping, from_concept_id, to_concept_id) tuples that can be synced.
+        """
+        if self.map_types is None:
+            self.map_types = dict((m.name, m) for m in ConceptMapType.objects.all())
+            self.sources = dict((s.name, s) for s in ConceptReferenceSource.objects.all())
+
+        # Translate the OCL concept IDs using the keys file
+        pending = []
+        referenced_ids = set()
+        for i in mappings:
+            new_con_id = self.lookup_concept_id(i['from_concept_url'])
+            if new_con_id is None:
+                self.reject_mapping(i, 'from concept not found in keys file')
+                continue
+            new_to_con_id = None
+            if self.mapping_requires_to_concept(i):
+                new_to_con_id = self.lookup_concept_id(i['to_concept_url'])
+                if new_to_con_id is None:
+                    self.reject_mapping(i, 'to concept not found in keys file')
+                    continue
+                referenced_ids.add(new_to_con_id)
+            elif i['map_type'] not in self.map_types:
+                self.reject_mapping(i, 'map type "%s" not found in database' % i['map_type'])
+                continue
+            elif self.get_mapping_source(i) is None:
+                self.reject_mapping(i, 'reference source not found in database')
+                continue
+            referenced_ids.add(new_con_id)
+            pending.append((i, new_con_id, new_to_con_id))
+
+        # Check that every referenced concept exists in the target database
+        known_ids = set(known_ids)
+        existing_ids = self.fetch_existing_concept_ids(referenced_ids - known_ids) | (referenced_ids & known_ids)
+        resolved = []
+        for i, new_con_id, new_to_con_id in pending:
+            if new_con_id not in existing_ids:
+                self.reject_mapping(i, 'from concept %d not found in database' % new_con_id)
+            elif new_to_con_id is not None and new_to_con_id not in existing_ids:
+                self.reject_mapping(i, 'to concept %d not found in database' % new_to_con_id)
+            else:
+                resolved.append((i, new_con_id, new_to_con_id))
+        return resolved
+
+    def lookup_concept_id(self, concept_url):
+        """ Returns the Bahmni concept ID synced for an OCL concept URL, or None if it was not synced """
+        new_con_id = self.concepts_id_added.get(str(OclOpenmrsHelper.get_concept_id_from_url(concept_url)))
+        if new_con_id is None:
+            return None
+        return int(new_con_id)
+
+    def mapping_requires_to_concept(self, mapping):
+        """ Q-AND-A and CONCEPT-SET mappings link two concepts that must both exist in Bahmni """
+        return 'to_concept_url' in mapping and mapping['map_type'] in (
+            OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET, OclOpenmrsHelper.MAP_TYPE_Q_AND_A)
+
+    def get_mapping_source(self, mapping):
+        """ Returns the ConceptReferenceSource targeted by a reference mapping, or None if unknown """
+        if 'to_source_url' in mapping:
+            source_id = mapping['to_source_url'].split('/')[-2]
+        else:
+            source_id = mapping['from_concept_url'].split('/')[-4]
+        try:
+            omrs_source_id = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(ocl_source_id=source_id)
+        except UnrecognizedSourceException:
+            return None
+        return self.sources.get(omrs_source_id)
+
+    def fetch_existing_concept_ids(self, concept_ids):
+        """ Returns the subset of concept_ids present in the concept table, using chunked IN queries """
+        existing_ids = set()
+        for chunk in chunks(sorted(concept_ids)):
+            existing_ids.update(self.retrier.run(
+                list, Concept.objects.filter(concept_id__in=chunk).values_list('concept_id', flat=True)))
+        return existing_ids
+
+    def reject_mapping(self, mapping, reason):
+        """ Sets aside a mapping that cannot be synced so that it is written to the reject file """
+        self.cnt_mappings_rejected += 1
+        self.rejected_mappings.append({'reason': reason, 'mapping': mapping})
+        if self.verbosity >= 2:
+            print 'Rejected mapping (%s): %s' % (reason, mapping)
+
+    def write_rejected_mappings(self):
+        """ Writes the rejected mappings to the reject file, one JSON record per line """
+        if not self.rejected_mappings:
+            return
+        with open(self.reject_filename, 'w') as fp:
+            for rejected in self.rejected_mappings:
+                fp.write(json.dumps(rejected) + '\n')
+
+    def allocate_id(self, model, id_field):
+        """
+        Returns the next free primary key for model.
+
+        IDs are handed out locally from the range reserved by reserve_id_ranges(), or from
+        MAX() + 1, queried on first use, for tables without a reserved range.
+        """
+        if model not in self.next_ids:
+            max_id = model.objects.aggregate(Max(id_field))[id_field + '__max']
+            self.next_ids[model] = (max_id or 0) + 1
+        new_id = self.next_ids[model]
+        if model in self.id_limits and new_id >= self.id_limits[model]:
+            raise CommandError('Reserved range of %s IDs is exhausted' % model._meta.db_table)
+        self.next_ids[model] += 1
+        return new_id
+
+    def get_term_code(self, mapping):
+        """ Returns the code of the reference term targeted by a reference mapping """
+        if 'to_source_url' in mapping:
+            return mapping['to_concept_code']
+        # Internal reference maps target a term in the dictionary's own source, coded by the OCL concept ID
+        return str(OclOpenmrsHelper.get_concept_id_from_url(mapping['to_concept_url']))
+
+    def load_terms(self, resolved_mappings):
+        """
+        Loads the reference terms targeted by the resolved reference mappings with chunked IN
+        queries per source, and creates the missing ones in batches before any mapping is synced.
+        """
+        wanted = {}
+        for i, new_con_id, new_to_con_id in resolved_mappings:
+            if new_to_con_id is None:
+                source = self.get_mapping_source(i)
+                wanted.setdefault(source.concept_source_id, (source, {}))[1].setdefault(self.get_term_code(i), i)
+
+        for source_id, (source, codes) in wanted.iteritems():
+            for chunk in chunks(sorted(codes)):
+                for term in ConceptReferenceTerm.objects.filter(concept_source=source, code__in=chunk):
+                    self.terms.setdefault((source_id, term.code), term)
+            missing = [code for code in sorted(codes) if (source_id, code) not in self.terms]
+            for batch in chunks(missing, self.batch_size):
+                self.run_batch(self.create_term_batch, source, batch, codes)
+
+    def create_term_batch(self, source, batch, codes):
+        for code in batch:
+            self.get_or_create_term(source, code, codes[code])
+
+    def get_or_create_term(self, source, code, mapping):
+        """ Returns the reference term for code in source, creating it if it does not exist """
+        key = (source.concept_source_id, code)
+        if key in self.terms:
+            return self.terms[key]
+        try:
+            term = ConceptReferenceTerm.objects.get(code=code, concept_source=source)
+        except ObjectDoesNotExist:
+            term = ConceptReferenceTerm(
+                concept_reference_term_id=self.allocate_id(ConceptReferenceTerm, 'concept_reference_term_id'),
+                concept_source=source, code=code, creator=mapping['creator'],
+                date_created=datetime.datetime.now(), retired=mapping['retired'], uuid=str(uuid.uuid4()))
+            term.save()
+        self.terms[key] = term
+        return term
+
+    ## MAPPING SYNC
+
     def sync_internal_mapping(self, internal_mapping):
-        for i in internal_mapping:
+        """ Syncs resolved internal mappings in batches, one transaction per batch """
+        for batch in chunks(internal_mapping, self.batch_size):
+            self.run_batch(self.sync_internal_mapping_batch, batch)
+            self.report_progress(len(batch))
+
+    def sync_internal_mapping_batch(self, batch):
+        for i, new_con_id, new_to_con_id in batch:
+            self.cnt_mappings_processed += 1
             if i['map_type'] == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET:
-                from_concept_url = i["from_concept_url"] # Concept Set Owner
-                to_concept_url = i['to_concept_url'] # Concept Set Member
-                list_concept_url = from_concept_url.split("/")
-                list_to_concept_url = to_concept_url.split("/")
-                con_id = int(list_concept_url[-2])
-                to_con_id = int(list_to_concept_url[-2])
-                new_con_id = int(self.concepts_id_added[str(con_id)])
-                new_to_con_id = int(self.concepts_id_added[str(to_con_id)])
-                concept_own = Concept.objects.get(concept_id=new_con_id)
-                concept_mem = Concept.objects.get(concept_id=new_to_con_id)
-                mapping = ConceptSet.objects.filter(concept_set_owner=concept_own, concept=concept_mem)
+                # from concept is the set owner, to concept is the set member
+                mapping = ConceptSet.objects.filter(concept_set_owner_id=new_con_id, concept_id=new_to_con_id)
                 if len(mapping) == 0:
-                    new_set_id = ConceptSet.objects.all().aggregate(Max('concept_set_id'))[
-                                      'concept_set_id__max'] + 1
-                    concept_set_to_save = ConceptSet(concept_set_id=new_set_id, concept=concept_mem,
-                                                     concept_set_owner=concept_own,
-                                                     creator=i['creator'],
-                                                     date_created=datetime.datetime.now(),
-                                                     uuid=str(uuid.uuid4()))
+                    concept_set_to_save = ConceptSet(
+                        concept_set_id=self.allocate_id(ConceptSet, 'concept_set_id'),
+                        concept_id=new_to_con_id, concept_set_owner_id=new_con_id,
+                        creator=i['creator'], date_created=datetime.datetime.now(),
+                        uuid=str(uuid.uuid4()))
                     concept_set_to_save.save()
-                # else:
-                #
-                #     from_concept = mapping[0].concept_set_owner
-                #     to_concept = mapping[0].concept_id
-                #     if not (new_con_id == from_concept and new_to_con_id == to_concept):
-                #         new_id = self.generate_id(concept_set=True)
-                #         concept = Concept.objects.filter(concept_id=new_con_id)
-                #         concept_to = Concept.objects.filter(concept_id=new_to_con_id)
-                #         concept_set_to_save = ConceptSet(concept_set_id=new_id, concept=concept[0], concept_set_owner=concept_to[0],
-                #                                          creator=i['creator'], date_created=iso8601.parse_date(i['date_created']),
-                #                                          uuid=i['external_id'])
-                #         concept_set_to_save.save()
+                    self.cnt_mappings_synced += 1
+                else:
+                    self.cnt_mappings_existing += 1
             elif i['map_type'] == OclOpenmrsHelper.MAP_TYPE_Q_AND_A:
-                from_concept_url = i["from_concept_url"] # concept_id
-                to_concept_url = i['to_concept_url']    #concept_answer
-                list_concept_url = from_concept_url.split("/")
-                list_to_concept_url = to_concept_url.split("/")
-                con_id = int(list_concept_url[-2])
-                to_con_id = int(list_to_concept_url[-2])
-                new_con_id = int(self.concepts_id_added[str(con_id)])
-                new_to_con_id = int(self.concepts_id_added[str(to_con_id)])
-                concept_from = Concept.objects.get(concept_id=new_con_id)
-                concept_to = Concept.objects.get(concept_id=new_to_con_id)
-                mapping = ConceptAnswer.objects.filter(question_concept=concept_from, answer_concept=concept_to)
+                # from concept is the question, to concept is the answer
+                mapping = ConceptAnswer.objects.filter(question_concept_id=new_con_id,
+                                                       answer_concept_id=new_to_con_id)
                 if len(mapping) == 0:
-                    new_ans_id = ConceptAnswer.objects.all().aggregate(Max('concept_answer_id'))['concept_answer_id__max'] + 1
-                    concept_answer_to_save = ConceptAnswer(concept_answer_id=new_ans_id, question_concept=concept_from,
-                                                           answer_concept=concept_to, creator=i['creator'], uuid=str(uuid.uuid4()),
-                                                           date_created=datetime.datetime.now())
+                    concept_answer_to_save = ConceptAnswer(
+                        concept_answer_id=self.allocate_id(ConceptAnswer, 'concept_answer_id'),
+                        question_concept_id=new_con_id, answer_concept_id=new_to_con_id,
+                        creator=i['creator'], uuid=str(uuid.uuid4()),
+                        date_created=datetime.datetime.now())
                     concept_answer_to_save.save()
+                    self.cnt_mappings_synced += 1
+                else:
+                    self.cnt_mappings_existing += 1
             else:
-                from_concept_url = i["from_concept_url"]
-                to_concept_url = i['to_concept_url']
-                list_concept_url = from_concept_url.split("/")
-                list_to_concept_url = to_concept_url.split("/")
-                con_id = int(list_concept_url[-2])
-                to_con_id = int(list_to_concept_url[-2])
-                new_con_id = int(self.concepts_id_added[str(con_id)])
-                new_to_con_id = int(self.concepts_id_added[str(to_con_id)])
-                concept_map_type = ConceptMapType.objects.filter(name=i['map_type'])
-                concept = Concept.objects.get(concept_id=new_con_id)
-
-                src = list_concept_url[-4]
-                omrs_source_id = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(ocl_source_id=src)
-                source = ConceptReferenceSource.objects.get(name=omrs_source_id)
-                try:
-                    term = ConceptReferenceTerm.objects.get(code=str(to_con_id), concept_source=source)
-                except ObjectDoesNotExist:
-                    new_term_id = ConceptReferenceTerm.objects.all().aggregate(Max('concept_reference_term_id'))[
-                                      'concept_reference_term_id__max'] + 1
-                    term = ConceptReferenceTerm(concept_reference_term_id=new_term_id, concept_source=source,
-                                                code=str(to_con_id),
-                                                creator=i['creator'], date_created=datetime.datetime.now(), retired=i['retired'],
-                                                uuid=str(uuid.uuid4()))
-                    term.save()
-                    term = ConceptReferenceTerm.objects.get(code=str(to_con_id), concept_source=source)
-                mapping = ConceptReferenceMap.objects.filter(concept_reference_term=term, concept_id=concept,
-                                                             map_type=concept_map_type[0])
-                if len(mapping) == 0:
-                        new_map_id = ConceptReferenceMap.objects.all().aggregate(Max('concept_map_id'))[
-                                      'concept_map_id__max'] + 1
-                        concept_map_to_save = ConceptReferenceMap(concept_map_id=new_map_id, creator=i['creator'],
-                                                                  date_created=datetime.datetime.now(), concept=concept, uuid=str(uuid.uuid4()),
-                                                                  concept_reference_term=term, map_type=concept_map_type[0])
-                        concept_map_to_save.save()
+                # Reference map to a term in the dictionary's own source, coded by the OCL concept ID
+                term = self.get_or_create_term(self.get_mapping_source(i), self.get_term_code(i), i)
+                self.sync_reference_map(i, new_con_id, term)
 
     def sync_external_mapping(self, external_mapping):
-        for i in external_mapping:
-            from_concept_url = i["from_concept_url"]
-            to_source_url = i['to_source_url']
-            to_concept_code = i['to_concept_code']
-            list_concept_url = from_concept_url.split("/")
-            list_source_url = to_source_url.split("/")
-            con_id = int(list_concept_url[-2])
-            source_id = list_source_url[-2]
-            omrs_source_id = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(ocl_source_id=source_id)
-            source = ConceptReferenceSource.objects.filter(name=omrs_source_id)
-            new_con_id = int(self.concepts_id_added[str(con_id)])
-            concept = Concept.objects.filter(concept_id=new_con_id)
-            concept_map_type = ConceptMapType.objects.filter(name=i['map_type'])
-            try:
-                term = ConceptReferenceTerm.objects.get(code=i['to_concept_code'], concept_source=source)
-            except ObjectDoesNotExist:
-                new_term_id = ConceptReferenceTerm.objects.all().aggregate(Max('concept_reference_term_id'))['concept_reference_term_id__max'] + 1
-                term = ConceptReferenceTerm(concept_reference_term_id=new_term_id, concept_source=source[0],
-                                                    code=to_concept_code,
-                                                    creator=i['creator'], date_created=datetime.datetime.now(), retired=i['retired'],
-                                                    uuid=str(uuid.uuid4()))
-                term.save()
-                term = ConceptReferenceTerm.objects.get(code=i['to_concept_code'], concept_source=source)
-            mapping = ConceptReferenceMap.objects.filter(concept_reference_term=term, concept_id=concept[0],
-                                                         map_type=concept_map_type[0])
-            if len(mapping) == 0:
-                concept_map = ConceptReferenceMap(concept_map_id=i['concept_map_id'], creator=i['creator'],
-                                                  date_created=datetime.datetime.now(),
-                                                  concept=concept[0], uuid=str(uuid.uuid4()),
-                                                  concept_reference_term=term, map_type=concept_map_type[0])
-                concept_map.save()
+        """ Syncs resolved external mappings in batches, one transaction per batch """
+        for batch in chunks(external_mapping, self.batch_size):
+            self.run_batch(self.sync_external_mapping_batch, batch)
+            self.report_progress(len(batch))
+
+    def sync_external_mapping_batch(self, batch):
+        for i, new_con_id, new_to_con_id in batch:
+            self.cnt_mappings_processed += 1
+            term = self.get_or_create_term(self.get_mapping_source(i), self.get_term_code(i), i)
+            # External mappings keep their OCL concept_map_id
+            self.sync_reference_map(i, new_con_id, term, concept_map_id=i['concept_map_id'])
+
+    def sync_reference_map(self, mapping, new_con_id, term, concept_map_id=None):
+        """ Creates the reference map from the concept to the term unless it already exists """
+        map_type = self.map_types[mapping['map_type']]
+        existing = ConceptReferenceMap.objects.filter(concept_reference_term=term, concept_id=new_con_id,
+                                                      map_type=map_type)
+        if len(existing) != 0:
+            self.cnt_mappings_existing += 1
+            return
+        if concept_map_id is None:
+            concept_map_id = self.allocate_id(ConceptReferenceMap, 'concept_map_id')
+        concept_map = ConceptReferenceMap(concept_map_id=concept_map_id, creator=mapping['creator'],
+                                          date_created=datetime.datetime.now(), concept_id=new_con_id,
+                                          uuid=str(uuid.uuid4()), concept_reference_term=term, map_type=map_type)
+        concept_map.save()
+        self.cnt_mappings_synced += 1
+
+    ## BULK LOAD
+
+    def bulk_load(self, concepts, mappings):
+        """
+        Initial load of the concepts and mappings with LOAD DATA LOCAL INFILE.
+
+        The rows of every table are written to TSV files in 'bulk_load' with pre-assigned IDs
+        and UUIDs and loaded in one transaction, which is verified before it commits (see
+        omrs.bulk_load). The keys and reject files are written only once the load succeeds.
+        Incoming concepts and mappings are not matched to existing rows, so this is meant for an
+        empty or nearly empty dictionary.
+        """
+        if not os.path.isdir(self.bulk_load_dir):
+            os.makedirs(self.bulk_load_dir)
+        table_files = [TableFile(self.bulk_load_dir, model) for model in BULK_LOAD_MODELS]
+        files_by_model = dict((table_file.model, table_file) for table_file in table_files)
+        now = datetime.datetime.now()
+        self.progress.start_phase('bulk_write', total=len(concepts) + len(mappings))
+        try:
+            loaded_ids = self.write_bulk_concepts(concepts, files_by_model, now)
+            if mappings:
+                self.write_bulk_mappings(mappings, files_by_model, loaded_ids, now)
+        finally:
+            for table_file in table_files:
+                table_file.close()
+
+        self.progress.start_phase('bulk_load', total=sum(table_file.count for table_file in table_files))
+        try:
+            # A failed load is rolled back as a whole, so it can be replayed from the same files
+            self.bulk_rows_loaded = self.retrier.run(load_table_files, table_files)
+        except BulkLoadError as e:
+            raise CommandError(str(e))
+        self.progress.advance(sum(self.bulk_rows_loaded.itervalues()))
+        if self.concept:
+            with open(self.keys, 'w') as fp:
+                json.dump(self.concepts_id_added, fp)
+        if self.mapping:
+            self.write_rejected_mappings()
+
+    def set_id_floor(self, model, id_field, floor):
+        """ Makes allocate_id() hand out IDs above both the table's MAX(id_field) and floor """
+        max_id = model.objects.aggregate(Max(id_field))[id_field + '__max'] or 0
+        self.next_ids[model] = max(max_id, floor) + 1
+
+    def write_bulk_concepts(self, concepts, table_files, now):
+        """
+        Writes the concept, name, description and numeric rows of concepts and returns the set
+        of concept IDs assigned. Incoming concept IDs are kept unless already taken.
+        """
+        loaded_ids = set()
+        if not concepts:
+            return loaded_ids
+        self.create_concept_classes_and_datatypes(concepts)
+        class_ids = dict(ConceptClass.objects.values_list('name', 'concept_class_id'))
+        datatype_ids = dict(ConceptDatatype.objects.values_list('name', 'concept_datatype_id'))
+        incoming_ids = [int(concept['id']) for concept in concepts]
+        existing_ids = self.fetch_existing_concept_ids(incoming_ids)
+        self.set_id_floor(Concept, 'concept_id', max(incoming_ids))
+        self.set_id_floor(ConceptName, 'concept_name_id', 0)
+        self.set_id_floor(ConceptDescription, 'concept_description_id', 0)
+
+        for concept in concepts:
+            self.cnt_total_concepts_processed += 1
+            con_id = int(concept['id'])
+            if con_id in existing_ids or con_id in loaded_ids:
+                con_id = self.allocate_id(Concept, 'concept_id')
+            extras = concept.get('extras') or {}
+            table_files[Concept].write(
+                concept_id=con_id, retired=concept['retired'], datatype_id=datatype_ids[concept['datatype']],
+                concept_class_id=class_ids[concept['concept_class']], is_set=extras.get('is_set', 0),
+                creator=1, date_created=now, uuid=concept['external_id'] or str(uuid.uuid4()))
+            for cname in concept['names']:
+                table_files[ConceptName].write(
+                    concept_name_id=self.allocate_id(ConceptName, 'concept_name_id'), concept_id=con_id,
+                    name=cname['name'], locale=cname['locale'], creator=1, date_created=now,
+                    voided=cname['voided'], uuid=cname['external_id'] or str(uuid.uuid4()),
+                    concept_name_type=cname['name_type'], locale_preferred=cname['locale_preferred'])
+            for cdescription in concept.get('descriptions') or []:
+                table_files[ConceptDescription].write(
+                    concept_description_id=self.allocate_id(ConceptDescription, 'concept_description_id'),
+                    concept_id=con_id, description=cdescription['description'], locale=cdescription['locale'],
+                    creator=1, date_created=now, uuid=cdescription['external_id'] or str(uuid.uuid4()))
+            if concept['datatype'] == 'Numeric':
+                table_files[ConceptNumeric].write(
+                    concept_id=con_id, hi_absolute=extras.get('hi_absolute'), hi_critical=extras.get('hi_critical'),
+                    hi_normal=extras.get('hi_normal'), low_absolute=extras.get('low_absolute'),
+                    low_critical=extras.get('low_critical'), low_normal=extras.get('low_normal'),
+                    units=extras.get('units'), precise=extras.get('precise'))
+            self.concepts_id_added[str(concept['id'])] = con_id
+            loaded_ids.add(con_id)
+            self.progress.advance()
+        return loaded_ids
+
+    def write_bulk_mappings(self, mappings, table_files, loaded_ids, now):
+        """
+        Writes the reference term, reference map, answer and set rows of the resolved mappings.
+
+        Mappings are resolved as for a sync, treating the concepts of this load as existing.
+        Reference terms already in the database are reused; duplicate mappings in the file are
+        written once and counted as existing.
+        """
+        resolved = (self.resolve_mappings(self.generate_external_mapping(mappings), known_ids=loaded_ids) +
+                    self.resolve_mappings(self.generate_internal_mapping(mappings), known_ids=loaded_ids))
+
+        # Reuse the existing reference terms, and write the missing ones
+        wanted = {}
+        for i, new_con_id, new_to_con_id in resolved:
+            if new_to_con_id is None:
+                wanted.setdefault(self.get_mapping_source(i).concept_source_id, {}).setdefault(self.get_term_code(i), i)
+        term_ids = {}
+        self.set_id_floor(ConceptReferenceTerm, 'concept_reference_term_id', 0)
+        for source_id, codes in sorted(wanted.iteritems()):
+            for chunk in chunks(sorted(codes)):
+                for code, term_id in ConceptReferenceTerm.objects.filter(
+                        concept_source_id=source_id, code__in=chunk).values_list('code', 'concept_reference_term_id'):
+                    term_ids.setdefault((source_id, code), term_id)
+            for code in sorted(codes):
+                if (source_id, code) not in term_ids:
+                    term_ids[(source_id, code)] = self.allocate_id(ConceptReferenceTerm, 'concept_reference_term_id')
+                    table_files[ConceptReferenceTerm].write(
+                        concept_reference_term_id=term_ids[(source_id, code)], concept_source_id=source_id,
+                        code=code, creator=codes[code]['creator'], date_created=now,
+                        retired=codes[code]['retired'], uuid=str(uuid.uuid4()))
+
+        # External mappings keep their OCL concept_map_id unless it is already taken
+        external_map_ids = set(int(i['concept_map_id']) for i, new_con_id, new_to_con_id in resolved
+                               if 'to_source_url' in i and i.get('concept_map_id') is not None)
+        taken_map_ids = set()
+        for chunk in chunks(sorted(external_map_ids)):
+            taken_map_ids.update(ConceptReferenceMap.objects.filter(
+                concept_map_id__in=chunk).values_list('concept_map_id', flat=True))
+        self.set_id_floor(ConceptReferenceMap, 'concept_map_id', max(external_map_ids or [0]))
+        self.set_id_floor(ConceptSet, 'concept_set_id', 0)
+        self.set_id_floor(ConceptAnswer, 'concept_answer_id', 0)
+
+        # Rejected mappings are not written
+        self.progress.advance(len(mappings) - len(resolved))
+        written = set()
+        for i, new_con_id, new_to_con_id in resolved:
+            self.cnt_mappings_processed += 1
+            self.progress.advance()
+            if i['map_type'] in (OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET, OclOpenmrsHelper.MAP_TYPE_Q_AND_A):
+                key = (i['map_type'], new_con_id, new_to_con_id)
+            else:
+                term_id = term_ids[(self.get_mapping_source(i).concept_source_id, self.get_term_code(i))]
+                key = (i['map_type'], new_con_id, term_id)
+            if key in written:
+                self.cnt_mappings_existing += 1
+                continue
+            written.add(key)
+            self.cnt_mappings_synced += 1
+
+            if i['map_type'] == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET:
+                # from concept is the set owner, to concept is the set member
+                table_files[ConceptSet].write(
+                    concept_set_id=self.allocate_id(ConceptSet, 'concept_set_id'), concept_id=new_to_con_id,
+                    concept_set_owner_id=new_con_id, creator=i['creator'], date_created=now,
+                    uuid=str(uuid.uuid4()))
+            elif i['map_type'] == OclOpenmrsHelper.MAP_TYPE_Q_AND_A:
+                # from concept is the question, to concept is the answer
+                table_files[ConceptAnswer].write(
+                    concept_answer_id=self.allocate_id(ConceptAnswer, 'concept_answer_id'),
+                    question_concept_id=new_con_id, answer_concept_id=new_to_con_id, creator=i['creator'],
+                    date_created=now, uuid=str(uuid.uuid4()))
+            else:
+                concept_map_id = i.get('concept_map_id') if 'to_source_url' in i else None
+                if concept_map_id is None or int(concept_map_id) in taken_map_ids:
+                    concept_map_id = self.allocate_id(ConceptReferenceMap, 'concept_map_id')
+                taken_map_ids.add(int(concept_map_id))
+                table_files[ConceptReferenceMap].write(
+                    concept_map_id=int(concept_map_id), creator=i['creator'], date_created=now,
+                    concept_id=new_con_id, uuid=str(uuid.uuid4()), concept_reference_term_id=term_id,
+                    map_type_id=self.map_types[i['map_type']].concept_map_type_id)
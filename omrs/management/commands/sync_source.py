@@ -1,13 +1,13 @@
 """
-Command to sync the source and all the reference term in bahmni openmrs .
-python manage.py --raw -v0 --source_file=source.json --term_file=term.json
-This will read the source and reference term file and for a particular source it will check if source exists and if it doesnot exists then it
+Command to sync the reference sources in bahmni openmrs .
+python manage.py sync_source --raw -v0 --source_file=source.json
+This will read the source file and for a particular source it will check if source exists and if it doesnot exists then it
 creates that particular source.
-Also it collects all the terms that are related to the source we are working on and then checks if it exists on the basis of code because the
-concept_reference_term_id may  not be unique but the code to which the concept is mapped in that source will be unique. Hence we can query for
-reference term on the basis of code and then on running it syncs the database.
-Another example to just sync one particular id of the source and all the terms is:
-python manage.py --raw -v0 --source_file=source.json --term_file=term.json --source_id=1
+Another example to just sync one particular id of the source is:
+python manage.py sync_source --raw -v0 --source_file=source.json --source_id=1
+The reference terms of the sources, and the maps between them, are synced afterwards with sync_terms, from a
+file written by extract_terms.
+The source file may be compressed (.gz, .bz2 or .xz), a glob pattern or a comma-separated list of files.
 """
 import uuid
 from optparse import make_option
@@ -18,7 +18,7 @@ import datetime
 from django.core.management import BaseCommand, CommandError
 from omrs.models import Concept, ConceptReferenceSource, ConceptReferenceTerm
 from omrs.management.commands import OclOpenmrsHelper, UnrecognizedSourceException
-import requests
+from omrs.ocl_files import iter_lines
 
 
 
@@ -29,6 +29,7 @@ class Command(BaseCommand):
 
     # Command attributes
     help = 'Extract concepts from OpenMRS database in the form of json'
+    requires_model_validation = False
     option_list = BaseCommand.option_list + (
         make_option('--raw',
                     action='store_true',
@@ -57,11 +58,7 @@ class Command(BaseCommand):
                     help='OCL API token to validate OpenMRS reference sources'),
     )
 
-    OCL_API_URL = {
-        'dev': 'http://api.dev.openconceptlab.com/',
-        'staging': 'http://api.staging.openconceptlab.com/',
-        'production': 'http://api.openconceptlab.com/',
-    }
+    OCL_API_URL = OclOpenmrsHelper.OCL_API_URL
 
 
 
@@ -95,8 +92,9 @@ class Command(BaseCommand):
 
         sources = []
 
-        for line in open(self.source_file, 'r'):
-            sources.append(json.loads(line))
+        for filename, line_number, line in iter_lines(self.source_file):
+            if line.strip():
+                sources.append(json.loads(line))
 
 
         self.sync_source(sources)
@@ -134,6 +132,7 @@ class Command(BaseCommand):
 
     def check_sources(self):
         """ Validates that all reference sources in OpenMRS have been defined in OCL. """
+        import requests
         url_base = self.OCL_API_URL[self.ocl_api_env]
         headers = {'Authorization': 'Token %s' % self.ocl_api_token}
         reference_sources = ConceptReferenceSource.objects.all()
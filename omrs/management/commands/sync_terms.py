@@ -0,0 +1,162 @@
+"""
+Command to sync reference terms and term-to-term maps exported by extract_terms into an OpenMRS dictionary.
+
+    manage.py sync_terms --term_file=terms.json
+    manage.py sync_terms --term_file=terms.json.gz --sources=ICD-10-WHO --batch_size=5000
+
+The terms of each reference source are compared with the dictionary by code, using one scan
+of the source's existing terms, and the missing ones are inserted --batch_size at a time with
+multi-row INSERTs, one transaction per batch. Term maps are then matched by their two terms
+and map type, and the missing ones inserted the same way. Existing terms and term maps are not
+changed, so the command can be run again to pick up new terms. Reference sources must already
+exist (see sync_source); terms of unknown sources are skipped and counted in the summary.
+
+The term file is read twice, first for the terms and then for the term maps, which may map to
+terms of sources later in the file. Only the terms or term maps of one source are held in memory.
+
+Transient MySQL errors are retried up to --max_retries times, and progress can be followed in
+a JSON status file (--status_file) and a Prometheus textfile (--metrics_file).
+
+Set verbosity to 0 (e.g. '-v0') to suppress the results summary output.
+"""
+from collections import OrderedDict
+from itertools import groupby
+from operator import itemgetter
+from optparse import make_option
+
+from django.core.management import BaseCommand, CommandError
+from omrs.ocl_files import iter_records
+from omrs.progress import ProgressReporter
+from omrs.reference_terms import DEFAULT_BATCH_SIZE, DEFAULT_CREATOR, TERM_MAP_TYPE, TERM_TYPE, TermSync
+from omrs.retry import DEFAULT_MAX_RETRIES, Retrier
+
+
+class Command(BaseCommand):
+    """
+    Sync reference terms and term maps into an OpenMRS dictionary
+    """
+
+    # Command attributes
+    help = 'Sync reference terms and term maps into an OpenMRS dictionary'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--term_file',
+                    action='store',
+                    dest='term_filename',
+                    default=None,
+                    help='Reference term file written by extract_terms'),
+        make_option('--sources',
+                    action='store',
+                    dest='source_names',
+                    default=None,
+                    help='Comma-separated names of the reference sources to sync, otherwise all in the file'),
+        make_option('--batch_size',
+                    action='store',
+                    dest='batch_size',
+                    type='int',
+                    default=DEFAULT_BATCH_SIZE,
+                    help='Number of terms or term maps inserted per transaction'),
+        make_option('--creator',
+                    action='store',
+                    dest='creator',
+                    type='int',
+                    default=DEFAULT_CREATOR,
+                    help='User ID recorded as the creator of terms that do not name one'),
+        make_option('--max_retries',
+                    action='store',
+                    dest='max_retries',
+                    type='int',
+                    default=DEFAULT_MAX_RETRIES,
+                    help='Number of times to replay a batch after a transient database error'),
+        make_option('--status_file',
+                    action='store',
+                    dest='status_filename',
+                    default=None,
+                    help='JSON file updated with the progress of the sync'),
+        make_option('--metrics_file',
+                    action='store',
+                    dest='metrics_filename',
+                    default=None,
+                    help='Prometheus textfile (*.prom) updated with the progress of the sync'),
+    )
+
+    def handle(self, *args, **options):
+        """ Handles options and syncs the terms of each source, then the term maps, reading the term file twice """
+        self.verbosity = int(options['verbosity'])
+        if not options['term_filename']:
+            raise CommandError("ERROR: the 'term_file' option is required")
+        if options['batch_size'] < 1:
+            raise CommandError("ERROR: 'batch_size' must be at least 1")
+        source_names = None
+        if options['source_names']:
+            source_names = set(name.strip() for name in options['source_names'].split(',') if name.strip())
+
+        self.term_filename = options['term_filename']
+        self.progress = ProgressReporter('sync_terms', status_filename=options['status_filename'],
+                                         metrics_filename=options['metrics_filename'])
+        self.sync = TermSync(Retrier(max_retries=options['max_retries'], verbosity=self.verbosity),
+                             batch_size=options['batch_size'], creator=options['creator'], progress=self.progress)
+
+        # All terms are synced before the term maps, which may map to terms of any source, so the
+        # term maps are read in a second pass over the file. Only the terms or term maps of one
+        # source are held in memory at a time.
+        self.progress.start_phase('terms')
+        cnt_term_map_records = 0
+        for (record_type, source_name), records in self.iter_source_groups(source_names):
+            if record_type == TERM_MAP_TYPE:
+                cnt_term_map_records += sum(1 for record in records)
+                continue
+            source_terms = OrderedDict()
+            for record in records:
+                source_terms.setdefault(record['code'], record)
+            if self.verbosity >= 2:
+                print 'Syncing %d terms of %s' % (len(source_terms), source_name)
+            self.sync.sync_terms(source_name, source_terms)
+        self.progress.start_phase('term_maps', total=cnt_term_map_records)
+        for (record_type, source_name), records in self.iter_source_groups(source_names):
+            if record_type != TERM_MAP_TYPE:
+                continue
+            source_term_maps = list(records)
+            if self.verbosity >= 2:
+                print 'Syncing %d term maps from %s' % (len(source_term_maps), source_name)
+            self.sync.sync_term_maps(source_name, source_term_maps)
+        self.progress.finish()
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+
+    def iter_source_groups(self, source_names):
+        """
+        Reads the term file and yields ((record type, source name), records) for each run of terms
+        of one source, or of term maps from one source, optionally limited to source_names
+        """
+        def iter_selected_records():
+            for record in iter_records(self.term_filename):
+                if record.get('type') == TERM_TYPE:
+                    source_name = record['source']
+                elif record.get('type') == TERM_MAP_TYPE:
+                    source_name = record['from_source']
+                else:
+                    raise CommandError('ERROR: %s is not a reference term file written by extract_terms' %
+                                       self.term_filename)
+                if source_names is None or source_name in source_names:
+                    yield (record['type'], source_name), record
+
+        for key, items in groupby(iter_selected_records(), itemgetter(0)):
+            yield key, (record for group_key, record in items)
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        print 'SYNC COUNT: Reference Terms created: %d' % self.sync.cnt_terms_created
+        print 'Reference Terms already in the dictionary: %d' % self.sync.cnt_terms_existing
+        print 'SYNC COUNT: Term Maps created: %d' % self.sync.cnt_term_maps_created
+        print 'Term Maps already in the dictionary: %d' % self.sync.cnt_term_maps_existing
+        for reason, count in sorted(self.sync.skipped.iteritems()):
+            print 'Skipped, %s: %d' % (reason, count)
+        if self.sync.retrier.counts:
+            print 'Transient database errors retried: %s' % self.sync.retrier.summary()
+        print '------------------------------------------------------'
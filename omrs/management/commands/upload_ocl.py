@@ -0,0 +1,222 @@
+"""
+Command to upload OCL JSON-lines files, such as those written by extract_db, to the OCL bulk
+import API.
+
+    manage.py upload_ocl --file=concepts.json,mappings.json --env=staging --token=...
+
+The files are read as a stream and posted in chunks of --chunk_size records, with
+--concurrency chunks in flight at a time. Each chunk becomes an OCL bulk import task, which is
+polled every --poll_interval seconds until it finishes. All concept chunks are imported before
+the first mapping chunk is posted. Inputs may be compressed, a glob pattern or a shard
+directory written by extract_db --output_dir:
+
+    manage.py upload_ocl --file=export/ --env=staging --token=... --state_file=upload.json
+
+With --state_file, the task and outcome of each chunk are saved as the upload goes. Running the
+same command again skips the chunks that were imported, waits for the tasks that were still
+running and posts the failed chunks again. The command fails if any chunk failed.
+
+Use --api_url instead of --env to upload to another OCL server. Without either, the upload goes
+to the OCL_API_URL setting, and without --token the OCL_API_TOKEN setting is used (both can be
+set as environment variables). Progress can be followed in a JSON status file (--status_file)
+and a Prometheus textfile (--metrics_file).
+
+Set verbosity to 0 (e.g. '-v0') to suppress the results summary output. Set verbosity to 2
+to see each chunk as it finishes.
+"""
+from optparse import make_option
+from multiprocessing.pool import ThreadPool
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from omrs.management.commands import OclOpenmrsHelper
+from omrs.ocl_upload import (CONCEPT_PHASE, DEFAULT_CHUNK_SIZE, DEFAULT_CONCURRENCY, DEFAULT_MAX_RETRIES,
+                             DEFAULT_POLL_INTERVAL, MAPPING_PHASE, SUCCESS, BulkImporter, UploadState,
+                             iter_chunks)
+from omrs.pipeline import run_pipeline
+from omrs.progress import ProgressReporter
+
+
+class Command(BaseCommand):
+    """
+    Upload OCL JSON-lines files to the OCL bulk import API
+    """
+
+    # Command attributes
+    help = 'Upload OCL JSON-lines files to the OCL bulk import API'
+    requires_model_validation = False
+    option_list = BaseCommand.option_list + (
+        make_option('--file',
+                    action='store',
+                    dest='upload_filename',
+                    default=None,
+                    help='OCL JSON-lines file(s) to upload: a filename, glob, comma-separated list or shard directory'),
+        make_option('--env',
+                    action='store',
+                    dest='ocl_api_env',
+                    default=None,
+                    help='Upload to "dev", "staging", or "production", otherwise to the OCL_API_URL setting'),
+        make_option('--api_url',
+                    action='store',
+                    dest='api_url',
+                    default=None,
+                    help='Base URL of the OCL API to upload to, instead of the "env" option'),
+        make_option('--token',
+                    action='store',
+                    dest='token',
+                    default=None,
+                    help='OCL API token, otherwise the OCL_API_TOKEN setting'),
+        make_option('--update_if_exists',
+                    action='store_true',
+                    dest='update_if_exists',
+                    default=False,
+                    help='Update concepts and mappings that already exist in OCL, otherwise they are skipped'),
+        make_option('--queue',
+                    action='store',
+                    dest='queue',
+                    default=None,
+                    help='OCL bulk import queue to post the chunks to'),
+        make_option('--chunk_size',
+                    action='store',
+                    dest='chunk_size',
+                    type='int',
+                    default=DEFAULT_CHUNK_SIZE,
+                    help='Maximum number of records per bulk import task'),
+        make_option('--chunk_bytes',
+                    action='store',
+                    dest='chunk_bytes',
+                    type='int',
+                    default=None,
+                    help='Maximum size of a bulk import task in bytes'),
+        make_option('--concurrency',
+                    action='store',
+                    dest='concurrency',
+                    type='int',
+                    default=DEFAULT_CONCURRENCY,
+                    help='Number of chunks uploaded and polled at the same time'),
+        make_option('--poll_interval',
+                    action='store',
+                    dest='poll_interval',
+                    type='float',
+                    default=DEFAULT_POLL_INTERVAL,
+                    help='Seconds between checks of the status of a bulk import task'),
+        make_option('--max_retries',
+                    action='store',
+                    dest='max_retries',
+                    type='int',
+                    default=DEFAULT_MAX_RETRIES,
+                    help='Times a request is repeated after a connection or server error'),
+        make_option('--state_file',
+                    action='store',
+                    dest='state_filename',
+                    default=None,
+                    help='JSON file recording the outcome of each chunk, used to resume the upload'),
+        make_option('--status_file',
+                    action='store',
+                    dest='status_filename',
+                    default=None,
+                    help='JSON file updated with the progress of the upload.'),
+        make_option('--metrics_file',
+                    action='store',
+                    dest='metrics_filename',
+                    default=None,
+                    help='Prometheus textfile (*.prom) updated with the progress of the upload.'),
+    )
+
+    OCL_API_URL = OclOpenmrsHelper.OCL_API_URL
+
+
+
+    ## UPLOAD_OCL COMMAND LINE HANDLER AND VALIDATION
+
+    def handle(self, *args, **options):
+        """ Handles options, uploads the concept chunks and then the mapping chunks """
+        self.upload_filename = options['upload_filename']
+        self.ocl_api_env = options['ocl_api_env']
+        self.api_url = options['api_url']
+        self.token = options['token'] or settings.OCL_API_TOKEN
+        self.chunk_size = options['chunk_size']
+        self.chunk_bytes = options['chunk_bytes']
+        self.concurrency = options['concurrency']
+        self.verbosity = int(options['verbosity'])
+        self.validate_options()
+
+        self.importer = BulkImporter(
+            OclOpenmrsHelper.get_api_url(self.ocl_api_env, self.api_url), self.token,
+            UploadState(options['state_filename']), update_if_exists=options['update_if_exists'],
+            queue=options['queue'], poll_interval=options['poll_interval'],
+            max_retries=options['max_retries'], verbosity=self.verbosity)
+        self.progress = ProgressReporter('upload_ocl', status_filename=options['status_filename'],
+                                         metrics_filename=options['metrics_filename'])
+
+        # Initialize counters
+        self.cnt_chunks = {SUCCESS: 0, 'skipped': 0, 'failed': 0}
+        self.cnt_records_uploaded = 0
+        self.cnt_bytes_uploaded = 0
+        self.failed_chunks = []
+        self.started = time.time()
+
+        pool = ThreadPool(self.concurrency)
+        try:
+            for phase in (CONCEPT_PHASE, MAPPING_PHASE):
+                self.progress.start_phase(phase)
+                run_pipeline(iter_chunks(self.upload_filename, phase, self.chunk_size, self.chunk_bytes),
+                             self.importer.upload, self.record_outcome, queue_size=self.concurrency, pool=pool)
+                # Mappings may reference any concept, so they wait for every concept chunk
+                if self.failed_chunks:
+                    break
+        finally:
+            pool.close()
+            pool.join()
+        self.progress.finish()
+
+        # Display final counts
+        if self.verbosity:
+            self.print_debug_summary()
+        if self.failed_chunks:
+            raise CommandError('%d chunks failed to upload: %s' % (
+                len(self.failed_chunks), ', '.join(self.failed_chunks)))
+
+    def validate_options(self):
+        """ Raises CommandError if the command line options are invalid """
+        if not self.upload_filename:
+            raise CommandError("ERROR: the 'file' option is required")
+        if not self.token:
+            raise CommandError("ERROR: the 'token' option or the OCL_API_TOKEN setting is required")
+        if self.ocl_api_env and self.ocl_api_env not in self.OCL_API_URL:
+            raise CommandError('Invalid "env" option provided: %s' % self.ocl_api_env)
+        if self.chunk_size < 1 or self.concurrency < 1:
+            raise CommandError("ERROR: 'chunk_size' and 'concurrency' must be at least 1")
+
+    def record_outcome(self, outcome):
+        """ Counts a finished chunk """
+        self.progress.advance(outcome['records'])
+        if outcome['skipped']:
+            self.cnt_chunks['skipped'] += 1
+        elif outcome['state'] == SUCCESS:
+            self.cnt_chunks[SUCCESS] += 1
+            self.cnt_records_uploaded += outcome['records']
+            self.cnt_bytes_uploaded += outcome['bytes']
+        else:
+            self.cnt_chunks['failed'] += 1
+            self.failed_chunks.append(outcome['key'])
+        if self.verbosity >= 2 or (self.verbosity and outcome['error']):
+            print '%s: %s (%d records)%s' % (outcome['key'], 'SKIPPED' if outcome['skipped'] else outcome['state'],
+                                             outcome['records'], ': ' + outcome['error'] if outcome['error'] else '')
+
+    def print_debug_summary(self):
+        """ Outputs a summary of the results """
+        elapsed = time.time() - self.started
+        print '------------------------------------------------------'
+        print 'SUMMARY'
+        print '------------------------------------------------------'
+        print 'Chunks imported: %d' % self.cnt_chunks[SUCCESS]
+        print 'Chunks skipped (imported by an earlier run): %d' % self.cnt_chunks['skipped']
+        print 'Chunks failed: %d' % self.cnt_chunks['failed']
+        print 'Records uploaded: %d' % self.cnt_records_uploaded
+        print 'Throughput: %.1f records/s, %.1f KB/s over %.1f s' % (
+            self.cnt_records_uploaded / elapsed, self.cnt_bytes_uploaded / 1024.0 / elapsed, elapsed)
+        if self.importer.cnt_retries:
+            print 'Requests retried: %d' % self.importer.cnt_retries
+        print '------------------------------------------------------'
@@ -1,14 +1,31 @@
 """
 Command to validate an OCL source version export against an OpenMRS dictionary stored in Mysql.
 
+The export may be a compressed (.gz, .bz2 or .xz) export document or JSON-lines file, or a
+shard directory written by extract_db --output_dir:
+
+    manage.py validate_export --export=export.json.gz
+
+An OCL source version export can be validated as it downloads (see fetch_ocl_export):
+
+    manage.py validate_export --export=ocl://CIEL/CIEL/v2019-07-01
+
+Progress can be followed in a JSON status file (--status_file) and a Prometheus textfile
+(--metrics_file), updated while the concepts and mappings are validated.
+
 TODO: Implement "deep" comparison for both concepts and mappings -- start with checking only active status
 
 """
-import json
 from django.core.management import BaseCommand
 from optparse import make_option
+from omrs.id_sets import IdBitmap, RangeIdSet, parse_id
 from omrs.models import (Concept, ConceptReferenceMap, ConceptAnswer, ConceptSet)
-from omrs.management.commands import OclOpenmrsHelper
+from omrs.ocl_files import is_mapping, iter_records
+from omrs.progress import ProgressReporter
+from omrs.snapshot import enable_snapshot
+from omrs.rows import ConceptAnswerRow, ConceptReferenceMapRow, ConceptSetRow, query_rows
+from omrs.streaming import stream_values
+from omrs.management.commands import OclOpenmrsHelper, chunks
 
 
 class Command(BaseCommand):
@@ -22,6 +39,7 @@ class Command(BaseCommand):
 
     # Command attributes
     help = 'Validate an OCL export against an OpenMRS dictionary stored in Mysql.'
+    requires_model_validation = False
     option_list = BaseCommand.option_list + (
         make_option('--export',
                     action='store',
@@ -33,6 +51,21 @@ class Command(BaseCommand):
                     dest='ignore_retired_mappings',
                     default=False,
                     help='Retired mappings in OCL are not included in the comparison if set to True'),
+        make_option('--snapshot',
+                    action='store_true',
+                    dest='snapshot',
+                    default=False,
+                    help='Read from the local snapshot database created by snapshot_db instead of MySQL.'),
+        make_option('--status_file',
+                    action='store',
+                    dest='status_filename',
+                    default=None,
+                    help='JSON file updated with the progress of the validation.'),
+        make_option('--metrics_file',
+                    action='store',
+                    dest='metrics_filename',
+                    default=None,
+                    help='Prometheus textfile (*.prom) updated with the progress of the validation.'),
     )
 
 
@@ -48,23 +81,26 @@ class Command(BaseCommand):
         self.ocl_export_filename = options['ocl_export_filename']
         self.ignore_retired_mappings = options['ignore_retired_mappings']
         self.verbosity = int(options['verbosity'])
+        self.progress = ProgressReporter('validate_export', status_filename=options['status_filename'],
+                                         metrics_filename=options['metrics_filename'])
 
         # Option debug output
         if self.verbosity >= 2:
             print 'COMMAND LINE OPTIONS:\n', options
 
-        # Load the OCL export file into memory
-        # NOTE: This will only work if it can fit into memory -- explore streaming partial loads
-        export_text = open(self.ocl_export_filename).read()
-        loaded_json = json.loads(export_text)
-        export_text = None
-        if 'concepts' not in loaded_json:
-            loaded_json['concepts'] = []
-        if 'mappings' not in loaded_json:
-            loaded_json['mappings'] = []
+        # Read from the local snapshot if requested
+        if options['snapshot']:
+            enable_snapshot()
+
+        # Load the records of the OCL export into memory, reading compressed or sharded exports directly
+        # NOTE: This will only work if the records fit into memory
+        loaded_json = {'concepts': [], 'mappings': []}
+        for record in iter_records(self.ocl_export_filename):
+            loaded_json['mappings' if is_mapping(record) else 'concepts'].append(record)
 
         # Validate the concepts and mappings in the file
         self.validate_export(loaded_json)
+        self.progress.finish()
 
     def validate_export(self, data):
         self.validate_concepts(data)
@@ -72,14 +108,16 @@ class Command(BaseCommand):
 
     def validate_concepts(self, data):
 
-        # Create an array of concept IDs that are in the mysql db
+        # Create a bitmap of the concept IDs that are in the mysql db. OCL IDs missing in the mysql db
+        # can be anything, so only those within the range of the mysql IDs are kept in a bitmap.
         print '\nCONCEPT COUNT COMPARISON:'
+        mysql_ids = IdBitmap(concept_id for (concept_id,) in stream_values(Concept.objects.all(), 'concept_id'))
         id_comparison = {
-            self.MISSING_IN_OCL:{},
-            self.MISSING_IN_MYSQL:{},
+            self.MISSING_IN_OCL:mysql_ids,
+            self.MISSING_IN_MYSQL:RangeIdSet(mysql_ids.bounds()),
         }
-        for c_mysql in Concept.objects.raw('SELECT concept_id FROM concept'):
-            id_comparison[self.MISSING_IN_OCL][str(c_mysql.concept_id)] = 0
+        # OCL concept IDs that are not integers cannot be in the mysql db
+        other_missing_in_mysql = set()
         count_mysql = len(id_comparison[self.MISSING_IN_OCL])
 
         # Perform count comparison
@@ -91,33 +129,46 @@ class Command(BaseCommand):
 
         # Perform an ID comparison
         print '\nVALIDATING CONCEPTS:'
+        self.progress.start_phase('concepts', total=count_ocl)
         cnt = 0
         for c_ocl in data['concepts']:
             # Display progress bar
             cnt += 1
+            self.progress.advance()
             if (cnt % 1000) == 1:
                 print 'Validating %s to %s of %s concepts...' % (cnt, cnt - 1 + 1000, count_ocl)
 
             # Do the comparison
-            if c_ocl['id'] in id_comparison[self.MISSING_IN_OCL]:
-                del id_comparison[self.MISSING_IN_OCL][c_ocl['id']]
+            concept_id = parse_id(c_ocl['id'])
+            if concept_id is not None and concept_id in id_comparison[self.MISSING_IN_OCL]:
+                id_comparison[self.MISSING_IN_OCL].discard(concept_id)
             else:
-                id_comparison[self.MISSING_IN_MYSQL][c_ocl['id']] = 0
+                if concept_id is not None:
+                    id_comparison[self.MISSING_IN_MYSQL].add(concept_id)
+                else:
+                    other_missing_in_mysql.add(c_ocl['id'])
                 if self.verbosity >= 2: print 'Concept %s exists in OCL but is missing in Mysql: %s' % (c_ocl['id'], c_ocl)
 
         # Output summary of results
         print '\n\nCONCEPT VALIDATION SUMMARY:'
         print '\n%s concept IDs missing in OCL:\n' % len(id_comparison[self.MISSING_IN_OCL])
-        print id_comparison[self.MISSING_IN_OCL]
-        print '\n%s concept IDs missing in MySQL:\n' % len(id_comparison[self.MISSING_IN_MYSQL])
-        print id_comparison[self.MISSING_IN_MYSQL]
+        print list(id_comparison[self.MISSING_IN_OCL])
+        print '\n%s concept IDs missing in MySQL:\n' % (
+            len(id_comparison[self.MISSING_IN_MYSQL]) + len(other_missing_in_mysql))
+        print [str(c_id) for c_id in id_comparison[self.MISSING_IN_MYSQL]] + sorted(
+            c_id.encode('utf-8') if isinstance(c_id, unicode) else str(c_id) for c_id in other_missing_in_mysql)
 
         # For IDs missing in MySQL, check if they are duplicated in the export
-        missing_ids = id_comparison[self.MISSING_IN_MYSQL].copy()
+        # Keyed like the comparison: by integer ID, or by the OCL ID if it is not an integer
+        missing_ids = dict((c_id, 0) for c_id in id_comparison[self.MISSING_IN_MYSQL])
+        missing_ids.update((c_id, 0) for c_id in other_missing_in_mysql)
         if missing_ids:
             for c_ocl in data['concepts']:
-                if c_ocl['id'] in missing_ids:
-                    missing_ids[c_ocl['id']] += 1
+                concept_id = parse_id(c_ocl['id'])
+                if concept_id is None:
+                    concept_id = c_ocl['id']
+                if concept_id in missing_ids:
+                    missing_ids[concept_id] += 1
                     print c_ocl
             print '\nChecking for duplicate IDs in export:\n'
             num_duplicates = 0
@@ -187,119 +238,134 @@ class Command(BaseCommand):
         else:
             print 'Count comparison of Concept Sets: OCL %s != MYSQL %s' % (cnt_ocl_conceptset, cnt_mysql_conceptset)
 
-        # Create an array of key comparison data from mappings in Mysql
+        # Create bitmaps of the MySQL mapping IDs, and lists of the OCL mappings missing in Mysql
         self.qanda_comparison = {
-            self.MISSING_IN_OCL:[],
+            self.MISSING_IN_OCL:IdBitmap(),
             self.MISSING_IN_MYSQL:[],
         }
         self.conceptset_comparison = {
-            self.MISSING_IN_OCL:[],
+            self.MISSING_IN_OCL:IdBitmap(),
             self.MISSING_IN_MYSQL:[],
         }
         self.refmap_comparison = {
-            self.MISSING_IN_OCL:[],
+            self.MISSING_IN_OCL:IdBitmap(),
             self.MISSING_IN_MYSQL:[],
         }
 
-        # Populate "missing_in_ocl" arrays with everything from omrs
-        for refmap_mysql in ConceptReferenceMap.objects.exclude(concept_reference_term__concept_source__name='CIEL'):
-            self.refmap_comparison[self.MISSING_IN_OCL].append(refmap_mysql.concept_map_id)
-        for qanda_mysql in ConceptAnswer.objects.raw('SELECT concept_answer_id FROM concept_answer'):
-            self.qanda_comparison[self.MISSING_IN_OCL].append(qanda_mysql.concept_answer_id)
-        for conceptset_mysql in ConceptSet.objects.raw('select concept_set_id from concept_set'):
-            self.conceptset_comparison[self.MISSING_IN_OCL].append(conceptset_mysql.concept_set_id)
-
-        # Iterate through OCL data and directly compare
+        # Populate "missing_in_ocl" bitmaps with the IDs of everything from omrs
+        refmaps_mysql = ConceptReferenceMap.objects.exclude(concept_reference_term__concept_source__name='CIEL')
+        for (concept_map_id,) in stream_values(refmaps_mysql, 'concept_map_id'):
+            self.refmap_comparison[self.MISSING_IN_OCL].add(concept_map_id)
+        for (concept_answer_id,) in stream_values(ConceptAnswer.objects.all(), 'concept_answer_id'):
+            self.qanda_comparison[self.MISSING_IN_OCL].add(concept_answer_id)
+        for (concept_set_id,) in stream_values(ConceptSet.objects.all(), 'concept_set_id'):
+            self.conceptset_comparison[self.MISSING_IN_OCL].add(concept_set_id)
+
+        # Iterate through OCL data in chunks, and directly compare each chunk to the MySQL mappings
+        # of its from concepts, loaded with one query per table
         print '\nVALIDATING MAPPINGS:'
+        self.progress.start_phase('mappings', total=cnt_ocl_total)
         cnt = 0
-        for m_ocl in data['mappings']:
-
-            # Skip retired mappings entirely if flag is set
-            if self.ignore_retired_mappings and m_ocl['retired']:
-                continue
-
-            # Display progress info
-            cnt += 1
-            if (cnt % 1000) == 1: print 'Validating %s to %s of %s mappings...' % (cnt, cnt - 1 + 1000, cnt_ocl_total)
-
-            # Determine the type of comparison to perform, compare, and handle results
-            ocl_map_type = str(m_ocl['map_type'])
-            if ocl_map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and m_ocl['to_source_name'] == 'CIEL':
-                mysql_matching_qanda_id = self.validate_qanda(m_ocl)
-                if mysql_matching_qanda_id:
-                    self.qanda_comparison[self.MISSING_IN_OCL].remove(mysql_matching_qanda_id)
-                else:
-                    self.qanda_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing qanda in MySQL: %s\n' % m_ocl
-            elif ocl_map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and m_ocl['to_source_name'] == 'CIEL':
-                mysql_matching_conceptset_id = self.validate_concept_set(m_ocl)
-                if mysql_matching_conceptset_id:
-                    self.conceptset_comparison[self.MISSING_IN_OCL].remove(mysql_matching_conceptset_id)
+        # Skip retired mappings entirely if flag is set
+        mappings = (m_ocl for m_ocl in data['mappings'] if not (self.ignore_retired_mappings and m_ocl['retired']))
+        for chunk in chunks(mappings):
+            self.index_mysql_mappings(chunk)
+            for m_ocl in chunk:
+                # Display progress info
+                cnt += 1
+                self.progress.advance()
+                if (cnt % 1000) == 1: print 'Validating %s to %s of %s mappings...' % (cnt, cnt - 1 + 1000, cnt_ocl_total)
+
+                # Determine the type of comparison to perform, compare, and handle results
+                ocl_map_type = str(m_ocl['map_type'])
+                if ocl_map_type == OclOpenmrsHelper.MAP_TYPE_Q_AND_A and m_ocl['to_source_name'] == 'CIEL':
+                    mysql_matching_qanda_id = self.validate_qanda(m_ocl)
+                    if mysql_matching_qanda_id:
+                        self.qanda_comparison[self.MISSING_IN_OCL].discard(mysql_matching_qanda_id)
+                    else:
+                        self.qanda_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                        if self.verbosity >= 2: print 'Missing qanda in MySQL: %s\n' % m_ocl
+                elif ocl_map_type == OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET and m_ocl['to_source_name'] == 'CIEL':
+                    mysql_matching_conceptset_id = self.validate_concept_set(m_ocl)
+                    if mysql_matching_conceptset_id:
+                        self.conceptset_comparison[self.MISSING_IN_OCL].discard(mysql_matching_conceptset_id)
+                    else:
+                        self.conceptset_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                        if self.verbosity >= 2: print 'Missing concept set in MySQL: %s\n' % m_ocl
                 else:
-                    self.conceptset_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing concept set in MySQL: %s\n' % m_ocl
-            else:
-                mysql_matching_refmap_id = self.validate_reference_map(m_ocl)
-                if mysql_matching_refmap_id:
-                    self.refmap_comparison[self.MISSING_IN_OCL].remove(mysql_matching_refmap_id)
-                else:
-                    self.refmap_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
-                    if self.verbosity >= 2: print 'Missing reference map in MySQL: %s\n' % m_ocl
+                    mysql_matching_refmap_id = self.validate_reference_map(m_ocl)
+                    if mysql_matching_refmap_id:
+                        self.refmap_comparison[self.MISSING_IN_OCL].discard(mysql_matching_refmap_id)
+                    else:
+                        self.refmap_comparison[self.MISSING_IN_MYSQL].append(m_ocl['id'])
+                        if self.verbosity >= 2: print 'Missing reference map in MySQL: %s\n' % m_ocl
 
         # Display results of comparison
         print '\n\nMAPPING VALIDATION SUMMARY:'
         print '%s Q/A mapping(s) missing in OCL Export:\n' % len(self.qanda_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.qanda_comparison[self.MISSING_IN_OCL]
+        if self.verbosity >= 1: print list(self.qanda_comparison[self.MISSING_IN_OCL])
         print '\n%s Q/A mapping(s) missing in MySQL:\n' % len(self.qanda_comparison[self.MISSING_IN_MYSQL])
         if self.verbosity >= 1: print self.qanda_comparison[self.MISSING_IN_MYSQL]
         print '\n%s Concept Set(s) mappings missing in OCL Export:\n' % len(self.conceptset_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.conceptset_comparison[self.MISSING_IN_OCL]
+        if self.verbosity >= 1: print list(self.conceptset_comparison[self.MISSING_IN_OCL])
         print '\n%s Concept Set(s) mappings missing in MySQL:\n' % len(self.conceptset_comparison[self.MISSING_IN_MYSQL])
         if self.verbosity >= 1: print self.conceptset_comparison[self.MISSING_IN_MYSQL]
         print '\n%s Reference Map(s) missing in OCL Export:\n' % len(self.refmap_comparison[self.MISSING_IN_OCL])
-        if self.verbosity >= 1: print self.refmap_comparison[self.MISSING_IN_OCL]
+        if self.verbosity >= 1: print list(self.refmap_comparison[self.MISSING_IN_OCL])
         print '\n%s Reference Map(s) missing in MySQL:\n' % len(self.refmap_comparison[self.MISSING_IN_MYSQL])
         if self.verbosity >= 1: print self.refmap_comparison[self.MISSING_IN_MYSQL]
 
-    def validate_reference_map(self, m_ocl):
-        map_type = m_ocl['map_type']
-        from_concept_id = m_ocl['from_concept_code']
-        to_concept_code = m_ocl['to_concept_code']
-        to_source_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m_ocl['to_source_name'])
-        try:
-            m_omrs = ConceptReferenceMap.objects.get(map_type__name=map_type,
-                                                     concept_reference_term__code=to_concept_code,
-                                                     concept_id=from_concept_id,
-                                                     concept_reference_term__concept_source__name=to_source_name)
-            return m_omrs.concept_map_id
-        except ConceptReferenceMap.DoesNotExist:
+    def index_mysql_mappings(self, chunk):
+        """
+        Indexes the MySQL reference maps, Q-AND-A and concept sets of the from concepts of a
+        chunk of OCL mappings by the keys that the OCL mappings are matched on.
+        """
+        from_concept_ids = set(parse_id(m_ocl['from_concept_code']) for m_ocl in chunk)
+        from_concept_ids.discard(None)
+        self.refmap_index = {}
+        self.qanda_index = {}
+        self.conceptset_index = {}
+        for refmap in query_rows(ConceptReferenceMapRow, ConceptReferenceMap.objects.filter(
+                concept_id__in=from_concept_ids)):
+            key = (match_text(refmap.map_type_name), match_text(refmap.term_code), refmap.concept_id,
+                   match_text(refmap.source_name))
+            self.refmap_index.setdefault(key, []).append(refmap.concept_map_id)
+        for qanda in query_rows(ConceptAnswerRow, ConceptAnswer.objects.filter(
+                question_concept_id__in=from_concept_ids)):
+            key = (qanda.question_concept_id, qanda.answer_concept_id)
+            self.qanda_index.setdefault(key, []).append(qanda.concept_answer_id)
+        for conceptset in query_rows(ConceptSetRow, ConceptSet.objects.filter(
+                concept_set_owner_id__in=from_concept_ids)):
+            key = (conceptset.concept_set_owner_id, conceptset.concept_id)
+            self.conceptset_index.setdefault(key, []).append(conceptset.concept_set_id)
+
+    def find_unique(self, index, key, description, m_ocl):
+        """ Returns the only MySQL ID indexed under key, or False if there is none or more than one """
+        matching_ids = index.get(key)
+        if not matching_ids:
             return False
-        except ConceptReferenceMap.MultipleObjectsReturned:
-            print 'Multiple objects returned from MySQL for reference mapping: %s\n' % m_ocl
+        if len(matching_ids) > 1:
+            print 'Multiple objects returned from MySQL for %s: %s\n' % (description, m_ocl)
             return False
+        return matching_ids[0]
+
+    def validate_reference_map(self, m_ocl):
+        to_source_name = OclOpenmrsHelper.get_omrs_source_id_from_ocl_id(m_ocl['to_source_name'])
+        key = (match_text(m_ocl['map_type']), match_text(m_ocl['to_concept_code']),
+               parse_id(m_ocl['from_concept_code']), match_text(to_source_name))
+        return self.find_unique(self.refmap_index, key, 'reference mapping', m_ocl)
 
     def validate_qanda(self, m_ocl):
-        question_concept_id = m_ocl['from_concept_code']
-        answer_concept_id = m_ocl['to_concept_code']
-        try:
-            qa_omrs = ConceptAnswer.objects.get(question_concept_id=question_concept_id,
-                                                answer_concept_id=answer_concept_id)
-            return qa_omrs.concept_answer_id
-        except ConceptAnswer.DoesNotExist:
-            return False
-        except ConceptAnswer.MultipleObjectsReturned:
-            print 'Multiple objects returned for qanda: %s\n' % m_ocl
-            return False
+        key = (parse_id(m_ocl['from_concept_code']), parse_id(m_ocl['to_concept_code']))
+        return self.find_unique(self.qanda_index, key, 'qanda', m_ocl)
 
     def validate_concept_set(self, m_ocl):
-        set_owner_id = m_ocl['from_concept_code']
-        set_member_id = m_ocl['to_concept_code']
-        try:
-            cs_omrs = ConceptSet.objects.get(concept_set_owner_id=set_owner_id,
-                                             concept_id=set_member_id)
-            return cs_omrs.concept_set_id
-        except ConceptSet.DoesNotExist:
-            return False
-        except ConceptSet.MultipleObjectsReturned:
-            print 'Multiple objects returned for concept set: %s\n' % m_ocl
-            return False
+        key = (parse_id(m_ocl['from_concept_code']), parse_id(m_ocl['to_concept_code']))
+        return self.find_unique(self.conceptset_index, key, 'concept set', m_ocl)
+
+
+def match_text(value):
+    """ Returns a code or name as MySQL's case-insensitive collation compares it, so 'A00.0 ' matches 'a00.0' """
+    if value is None:
+        return None
+    return unicode(value).rstrip(u' ').lower()
@@ -0,0 +1,179 @@
+"""
+Inverted-index search over concept names.
+
+ConceptNameIndex is built from one bulk scan of the non-voided rows of concept_name. Names
+are tokenized per locale (lower-cased, accents folded), words listed in concept_stop_word for
+the name's locale are dropped, and each token gets, per locale, a sorted array of the
+concept_name_ids that contain it. The index is pickled to disk, answers ranked queries
+without touching the database, and can be updated for a set of concepts after a sync.
+
+The concept_word table is not used: OpenMRS stopped maintaining it in 1.11, so the words
+are derived from concept_name directly.
+"""
+from array import array
+import bisect
+import cPickle
+import math
+import re
+import unicodedata
+
+from omrs.models import Concept, ConceptName, ConceptStopWord
+from omrs.management.commands import chunks
+from omrs.streaming import stream_values
+
+
+INDEX_FORMAT_VERSION = 1
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    """ Returns the lower-cased, accent-folded word tokens of text """
+    if not isinstance(text, unicode):
+        text = text.decode('utf-8')
+    folded = u''.join(c for c in unicodedata.normalize('NFKD', text.lower()) if not unicodedata.combining(c))
+    return TOKEN_RE.findall(folded)
+
+
+def locale_matches(locale, requested_locales):
+    """ Returns True if locale is one of requested_locales or a region of one, e.g. en_GB for en """
+    if not requested_locales:
+        return True
+    for requested in requested_locales:
+        if locale == requested or locale.startswith(requested + '_'):
+            return True
+    return False
+
+
+class ConceptNameIndex(object):
+    """ Inverted index from token and locale to the concept names containing the token """
+
+    def __init__(self):
+        # token -> locale -> sorted array of concept_name_id
+        self.postings = {}
+        # concept_name_id -> (concept_id, locale, name, number of indexed tokens)
+        self.names = {}
+        # locale -> set of stop words
+        self.stop_words = {}
+        self.retired_concept_ids = set()
+
+    ## BUILD AND UPDATE
+
+    @classmethod
+    def build(cls):
+        """ Returns a new index built from the concept_name and concept_stop_word tables """
+        index = cls()
+        index.load_stop_words()
+        index.retired_concept_ids = set(Concept.objects.filter(retired=True).values_list('concept_id', flat=True))
+        names = stream_values(ConceptName.objects.filter(voided=False),
+                              'concept_name_id', 'concept_id', 'locale', 'name')
+        for concept_name_id, concept_id, locale, name in names:
+            for token in index.add_name(concept_name_id, concept_id, locale, name):
+                index.postings.setdefault(token, {}).setdefault(locale, []).append(concept_name_id)
+        for by_locale in index.postings.itervalues():
+            for locale, name_ids in by_locale.iteritems():
+                by_locale[locale] = array('l', sorted(name_ids))
+        return index
+
+    def load_stop_words(self):
+        self.stop_words = {}
+        for word, locale in ConceptStopWord.objects.values_list('word', 'locale'):
+            self.stop_words.setdefault(locale, set()).update(tokenize(word))
+
+    def index_tokens(self, locale, text):
+        """ Returns the distinct tokens of text that are indexed for locale """
+        stop_words = self.stop_words.get(locale) or self.stop_words.get(locale.split('_')[0]) or ()
+        tokens = []
+        for token in tokenize(text):
+            if token not in stop_words and token not in tokens:
+                tokens.append(token)
+        return tokens
+
+    def add_name(self, concept_name_id, concept_id, locale, name):
+        """ Records a name and returns the tokens it is indexed under """
+        tokens = self.index_tokens(locale, name)
+        self.names[concept_name_id] = (concept_id, locale, name, len(tokens))
+        return tokens
+
+    def remove_name(self, concept_name_id):
+        concept_id, locale, name, token_count = self.names.pop(concept_name_id)
+        for token in self.index_tokens(locale, name):
+            name_ids = self.postings.get(token, {}).get(locale)
+            if name_ids is None:
+                continue
+            position = bisect.bisect_left(name_ids, concept_name_id)
+            if position < len(name_ids) and name_ids[position] == concept_name_id:
+                name_ids.pop(position)
+            if not name_ids:
+                del self.postings[token][locale]
+                if not self.postings[token]:
+                    del self.postings[token]
+
+    def update(self, concept_ids):
+        """ Re-indexes the names of concept_ids from the database, e.g. after a sync """
+        concept_ids = set(concept_ids)
+        for concept_name_id in [name_id for name_id, name in self.names.iteritems() if name[0] in concept_ids]:
+            self.remove_name(concept_name_id)
+        for chunk in chunks(sorted(concept_ids)):
+            for concept_id, retired in Concept.objects.filter(concept_id__in=chunk).values_list('concept_id', 'retired'):
+                if retired:
+                    self.retired_concept_ids.add(concept_id)
+                else:
+                    self.retired_concept_ids.discard(concept_id)
+            names = ConceptName.objects.filter(concept_id__in=chunk, voided=False).values_list(
+                'concept_name_id', 'concept_id', 'locale', 'name')
+            for concept_name_id, concept_id, locale, name in names:
+                for token in self.add_name(concept_name_id, concept_id, locale, name):
+                    name_ids = self.postings.setdefault(token, {}).setdefault(locale, array('l'))
+                    name_ids.insert(bisect.bisect_left(name_ids, concept_name_id), concept_name_id)
+
+    ## SEARCH
+
+    def search(self, query, locales=None, limit=20, include_retired=False):
+        """
+        Returns up to limit (concept_id, score, name) tuples for the concepts best matching query.
+
+        Each name is scored by the summed inverse document frequency of the query tokens it
+        contains, divided by its number of indexed tokens. Concepts are ranked first by the
+        number of query tokens matched by their best name, then by that name's score.
+        """
+        query_tokens = []
+        for token in tokenize(query):
+            if token not in query_tokens:
+                query_tokens.append(token)
+        name_count = float(len(self.names) or 1)
+        matched = {}
+        for token in query_tokens:
+            for locale, name_ids in self.postings.get(token, {}).iteritems():
+                if not locale_matches(locale, locales):
+                    continue
+                idf = math.log(1 + name_count / len(name_ids))
+                for concept_name_id in name_ids:
+                    hits, weight = matched.get(concept_name_id, (0, 0.0))
+                    matched[concept_name_id] = (hits + 1, weight + idf)
+
+        best = {}
+        for concept_name_id, (hits, weight) in matched.iteritems():
+            concept_id, locale, name, token_count = self.names[concept_name_id]
+            if not include_retired and concept_id in self.retired_concept_ids:
+                continue
+            rank = (hits, weight / max(token_count, 1))
+            if concept_id not in best or rank > best[concept_id][0]:
+                best[concept_id] = (rank, name)
+        ranked = sorted(best.iteritems(), key=lambda item: item[1][0], reverse=True)[:limit]
+        return [(concept_id, round(rank[1], 4), name) for concept_id, (rank, name) in ranked]
+
+    ## PERSISTENCE
+
+    def save(self, filename):
+        with open(filename, 'wb') as fp:
+            cPickle.dump((INDEX_FORMAT_VERSION, self.postings, self.names, self.stop_words,
+                          self.retired_concept_ids), fp, cPickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, filename):
+        index = cls()
+        with open(filename, 'rb') as fp:
+            version, index.postings, index.names, index.stop_words, index.retired_concept_ids = cPickle.load(fp)
+        if version != INDEX_FORMAT_VERSION:
+            raise ValueError('%s was built by an incompatible version, rebuild it' % filename)
+        return index
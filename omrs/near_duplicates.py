@@ -0,0 +1,129 @@
+"""
+Near-duplicate concept detection with MinHash signatures and locality-sensitive hashing.
+
+Each concept is reduced to the set of character 3-grams of its names and descriptions
+(normalized with the name search tokenizer) and summarized by a MinHash signature. Signatures
+are split into bands; two concepts whose signatures agree on all rows of any band land in the
+same LSH bucket and become a candidate pair. Only candidate pairs are compared, so matching an
+incoming file against the whole target dictionary costs close to one pass over each side.
+"""
+import random
+import zlib
+
+from omrs.models import Concept, ConceptDescription, ConceptName
+from omrs.name_search import tokenize
+from omrs.streaming import stream_values
+
+
+NUM_PERMUTATIONS = 32
+NUM_BANDS = 8
+SHINGLE_SIZE = 3
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def shingles(texts, size=SHINGLE_SIZE):
+    """ Returns the set of character n-grams of the normalized texts """
+    result = set()
+    for text in texts:
+        padded = u' %s ' % u' '.join(tokenize(text))
+        for start in range(len(padded) - size + 1):
+            result.add(padded[start:start + size])
+    return result
+
+
+def estimate_similarity(signature_a, signature_b):
+    """ Returns the estimated Jaccard similarity of two MinHash signatures """
+    agreeing = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+    return float(agreeing) / len(signature_a)
+
+
+class MinHasher(object):
+    """ Computes MinHash signatures with a fixed, seeded family of hash functions """
+
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, seed=1):
+        rng = random.Random(seed)
+        self.permutations = [(rng.randint(1, MERSENNE_PRIME - 1), rng.randint(0, MERSENNE_PRIME - 1))
+                             for _ in range(num_permutations)]
+
+    def signature(self, texts):
+        """ Returns the MinHash signature of texts, or None if they contain no words """
+        hashes = [zlib.crc32(shingle.encode('utf-8')) & 0xffffffff for shingle in shingles(texts)]
+        if not hashes:
+            return None
+        return tuple(min([(a * h + b) % MERSENNE_PRIME for h in hashes]) for a, b in self.permutations)
+
+
+class LshIndex(object):
+    """ Buckets MinHash signatures by band so that similar signatures share a bucket """
+
+    def __init__(self, num_bands=NUM_BANDS):
+        self.num_bands = num_bands
+        self.buckets = {}
+        self.signatures = {}
+
+    def bands(self, signature):
+        rows = len(signature) // self.num_bands
+        return [(band, signature[band * rows:(band + 1) * rows]) for band in range(self.num_bands)]
+
+    def add(self, key, signature):
+        self.signatures[key] = signature
+        for band in self.bands(signature):
+            self.buckets.setdefault(band, []).append(key)
+
+    def candidates(self, signature):
+        """ Returns the keys sharing at least one band bucket with signature """
+        keys = set()
+        for band in self.bands(signature):
+            keys.update(self.buckets.get(band, ()))
+        return keys
+
+
+def load_target_texts(include_retired=False):
+    """
+    Returns a dictionary of concept_id to the list of names and descriptions of each concept
+    in the database, using one bulk scan of concept_name and one of concept_description.
+    """
+    texts = {}
+    for concept_id, name in stream_values(ConceptName.objects.filter(voided=False), 'concept_id', 'name'):
+        texts.setdefault(concept_id, []).append(name)
+    for concept_id, description in stream_values(ConceptDescription.objects.all(), 'concept_id', 'description'):
+        if concept_id in texts:
+            texts[concept_id].append(description)
+    if not include_retired:
+        for concept_id in Concept.objects.filter(retired=True).values_list('concept_id', flat=True):
+            texts.pop(concept_id, None)
+    return texts
+
+
+def get_ocl_concept_texts(concept):
+    """ Returns the names and descriptions of an OCL-formatted concept """
+    return ([cname['name'] for cname in concept['names']] +
+            [cdescription['description'] for cdescription in concept.get('descriptions') or []])
+
+
+def find_near_duplicates(incoming_texts, target_texts, threshold, hasher=None, num_bands=NUM_BANDS):
+    """
+    Yields (incoming_id, target_id, similarity) for every incoming concept and target concept
+    whose estimated similarity is at least threshold, best match first for each incoming concept.
+
+    :param incoming_texts: Iterable of (concept_id, list of texts) for the incoming concepts.
+    :param target_texts: Dictionary of concept_id to list of texts for the target dictionary.
+    """
+    hasher = hasher or MinHasher()
+    index = LshIndex(num_bands=num_bands)
+    for target_id, texts in target_texts.iteritems():
+        signature = hasher.signature(texts)
+        if signature is not None:
+            index.add(target_id, signature)
+
+    for incoming_id, texts in incoming_texts:
+        signature = hasher.signature(texts)
+        if signature is None:
+            continue
+        matches = []
+        for target_id in index.candidates(signature):
+            similarity = estimate_similarity(signature, index.signatures[target_id])
+            if similarity >= threshold:
+                matches.append((similarity, target_id))
+        for similarity, target_id in sorted(matches, reverse=True):
+            yield incoming_id, target_id, similarity
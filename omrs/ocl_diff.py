@@ -0,0 +1,121 @@
+"""
+Diff of two OCL exports with an external sort-merge.
+
+Each file's records are keyed (concepts by id, mappings by from concept, to concept and map
+type), sorted in runs of at most run_size records that are written to temporary files, and
+the runs are merged back in key order with heapq.merge. The two sorted streams are then walked
+side by side, so memory use is bounded by run_size regardless of the size of the exports.
+"""
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+
+from omrs.ocl_files import is_mapping, iter_records
+
+
+RUN_SIZE = 100000
+
+CONCEPT = 'concept'
+MAPPING = 'mapping'
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+
+def record_key(record):
+    """ Returns the sort key of a record as a JSON string: [type, id] or [type, from, to, map_type] """
+    if is_mapping(record):
+        to_concept = record.get('to_concept_url') or '%s%s' % (record.get('to_source_url') or '',
+                                                                record.get('to_concept_code') or '')
+        return json.dumps([MAPPING, record.get('from_concept_url'), to_concept, record['map_type']])
+    return json.dumps([CONCEPT, record['id']])
+
+
+def record_digest(record, ignore_fields=()):
+    """ Returns a digest of the record's content, leaving out ignore_fields """
+    if ignore_fields:
+        record = dict((field, value) for field, value in record.iteritems() if field not in ignore_fields)
+    return hashlib.md5(json.dumps(record, sort_keys=True)).hexdigest()
+
+
+def write_run(entries, directory):
+    """ Sorts (key, digest, record JSON) entries and writes them to a new run file """
+    entries.sort()
+    fd, filename = tempfile.mkstemp(suffix='.run', dir=directory)
+    with os.fdopen(fd, 'wb') as fp:
+        for entry in entries:
+            fp.write('%s\t%s\t%s\n' % entry)
+    return filename
+
+
+def read_run(filename):
+    with open(filename, 'rb') as fp:
+        for line in fp:
+            yield tuple(line.rstrip('\n').split('\t', 2))
+
+
+def external_sort(records, directory, run_size=RUN_SIZE, ignore_fields=()):
+    """
+    Returns an iterator of (key, digest, record JSON) over records in key order, holding at most
+    run_size records in memory. Run files are created in directory, which the caller removes.
+    """
+    runs = []
+    entries = []
+    for record in records:
+        entries.append((record_key(record), record_digest(record, ignore_fields), json.dumps(record)))
+        if len(entries) >= run_size:
+            runs.append(write_run(entries, directory))
+            entries = []
+    if not runs:
+        entries.sort()
+        return iter(entries)
+    if entries:
+        runs.append(write_run(entries, directory))
+    return heapq.merge(*[read_run(run) for run in runs])
+
+
+class OclExportDiff(object):
+    """ Diffs two OCL export files, counting duplicate keys found in either file """
+
+    def __init__(self, old_filename, new_filename, directory, run_size=RUN_SIZE, ignore_fields=()):
+        self.old_filename = old_filename
+        self.new_filename = new_filename
+        self.directory = directory
+        self.run_size = run_size
+        self.ignore_fields = ignore_fields
+        self.cnt_duplicates = 0
+
+    def sorted_entries(self, filename):
+        """ Yields the sorted entries of a file, keeping only the first entry for each key """
+        previous_key = None
+        for entry in external_sort(iter_records(filename), self.directory, self.run_size, self.ignore_fields):
+            if entry[0] == previous_key:
+                self.cnt_duplicates += 1
+                continue
+            previous_key = entry[0]
+            yield entry
+
+    def changes(self):
+        """
+        Yields (change, key, old record JSON, new record JSON) for every added, removed or changed
+        record, in key order; the record JSON is None on the side where the record is absent.
+        """
+        old_entries = self.sorted_entries(self.old_filename)
+        new_entries = self.sorted_entries(self.new_filename)
+        old = next(old_entries, None)
+        new = next(new_entries, None)
+        while old is not None or new is not None:
+            if new is None or (old is not None and old[0] < new[0]):
+                yield REMOVED, old[0], old[2], None
+                old = next(old_entries, None)
+            elif old is None or new[0] < old[0]:
+                yield ADDED, new[0], None, new[2]
+                new = next(new_entries, None)
+            else:
+                if old[1] != new[1]:
+                    yield CHANGED, old[0], old[2], new[2]
+                old = next(old_entries, None)
+                new = next(new_entries, None)
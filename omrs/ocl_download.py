@@ -0,0 +1,364 @@
+"""
+Downloads of OCL source version exports into a local content-addressed cache.
+
+An export is named by its owner organization, source and version, written as an input URL
+ocl://OWNER/SOURCE/VERSION (optionally with ?sha256=CHECKSUM) wherever the commands accept
+an OCL file. ExportCache keeps each downloaded export once, under the SHA-256 of its contents
+(objects/), with a reference from the owner, source and version to the checksum (refs/).
+Versions are immutable, so a cached export is never downloaded again.
+
+ExportStream is a read-only file object over an export that is being downloaded: the bytes
+returned by read() are also appended to a partial file in the cache and hashed. A dropped
+connection is resumed with an HTTP range request from the end of the partial file, and a later
+download of the same export continues from there too, as long as the server reports the same
+ETag. Once the whole export has been read, its size, SHA-256 (if known in advance) and MD5
+(if the ETag is a plain MD5 digest, as for single-part S3 objects) are verified before it is
+moved into the cache. Reading the stream to the end is all it takes to cache the export, so an
+export can be validated or synced while it downloads.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+import urllib
+import urlparse
+
+from omrs.ocl_files import CHUNK_SIZE, OCL_EXPORT_SCHEME
+
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_DELAY = 1.0
+DEFAULT_TIMEOUT = 300
+
+MD5_ETAG_RE = re.compile(r'^"?([0-9a-f]{32})"?$')
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+class DownloadError(Exception):
+    """ DownloadError """
+    pass
+
+
+def parse_export_url(url):
+    """
+    Returns (owner, source, version, sha256 or None) for an export URL of the form
+    ocl://OWNER/SOURCE/VERSION[?sha256=CHECKSUM]
+    """
+    parsed = urlparse.urlparse(url)
+    parts = (parsed.netloc + parsed.path).strip('/').split('/')
+    if not url.startswith(OCL_EXPORT_SCHEME) or len(parts) != 3 or not all(parts):
+        raise DownloadError('OCL export URLs have the form %sOWNER/SOURCE/VERSION: %s' % (OCL_EXPORT_SCHEME, url))
+    sha256 = urlparse.parse_qs(parsed.query).get('sha256', [None])[0]
+    return parts[0], parts[1], parts[2], sha256
+
+
+def export_api_url(api_url, owner, source, version):
+    """ Returns the OCL API URL of a source version export """
+    return api_url.rstrip('/') + '/orgs/%s/sources/%s/%s/export/' % tuple(
+        urllib.quote(part, safe='') for part in (owner, source, version))
+
+
+class ExportCache(object):
+    """ Content-addressed store of downloaded exports, referenced by owner, source and version """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def ref_filename(self, owner, source, version):
+        return os.path.join(self.directory, 'refs', owner, source, version + '.json')
+
+    def object_filename(self, sha256):
+        return os.path.join(self.directory, 'objects', sha256[:2], sha256)
+
+    def partial_filename(self, owner, source, version):
+        return os.path.join(self.directory, 'partial', '%s--%s--%s' % (owner, source, version))
+
+    def lookup(self, owner, source, version):
+        """ Returns the cached file of an export, or None if it has not been downloaded """
+        ref_filename = self.ref_filename(owner, source, version)
+        if not os.path.exists(ref_filename):
+            return None
+        with open(ref_filename, 'r') as fp:
+            ref = json.load(fp)
+        filename = self.object_filename(ref['sha256'])
+        if not os.path.exists(filename) or os.path.getsize(filename) != ref['size']:
+            return None
+        return filename
+
+    def store(self, owner, source, version, partial_filename, sha256, metadata):
+        """ Moves a completed download into the store and returns its cached file """
+        filename = self.object_filename(sha256)
+        make_parent_directory(filename)
+        os.rename(partial_filename, filename)
+        ref_filename = self.ref_filename(owner, source, version)
+        make_parent_directory(ref_filename)
+        ref = dict(metadata, owner=owner, source=source, version=version, sha256=sha256,
+                   size=os.path.getsize(filename), downloaded=time.time())
+        with open(ref_filename + '.tmp', 'w') as fp:
+            json.dump(ref, fp, indent=2)
+        os.rename(ref_filename + '.tmp', ref_filename)
+        return filename
+
+
+def make_parent_directory(filename):
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+class ExportStream(object):
+    """ Read-only file object over an export, downloaded into the cache as it is read """
+
+    def __init__(self, downloader, owner, source, version, sha256=None):
+        self.downloader = downloader
+        self.cache = downloader.cache
+        self.owner, self.source, self.version = owner, source, version
+        self.expected_sha256 = sha256
+        self.name = '%s%s/%s/%s' % (OCL_EXPORT_SCHEME, owner, source, version)
+        self.url = export_api_url(downloader.api_url, owner, source, version)
+        self.partial_filename = self.cache.partial_filename(owner, source, version)
+        self.meta_filename = self.partial_filename + '.json'
+        self.filename = None
+        self.closed = False
+        self.started = False
+        self.finished = False
+        self.response = None
+        self.content = None
+        self.total_size = None
+        # Bytes at the start of a full response that are already in the partial file
+        self.skip = 0
+        self.retries = 0
+        self.sha256 = hashlib.sha256()
+        self.md5 = hashlib.md5()
+        # Bytes returned by read(), which can no longer be replaced if the export has changed
+        self.delivered = 0
+
+        # The bytes of an earlier, interrupted download are returned first
+        self.etag = None
+        if os.path.exists(self.partial_filename) and os.path.exists(self.meta_filename):
+            with open(self.meta_filename, 'r') as fp:
+                self.etag = json.load(fp).get('etag')
+        if self.etag is None:
+            make_parent_directory(self.partial_filename)
+            open(self.partial_filename, 'wb').close()
+        self.size = os.path.getsize(self.partial_filename)
+        self.earlier = open(self.partial_filename, 'rb')
+        self.earlier_remaining = self.size
+        self.partial = open(self.partial_filename, 'ab')
+
+    def read(self, size=-1):
+        if size < 0:
+            return ''.join(iter(lambda: self.read(CHUNK_SIZE), ''))
+        if not self.started:
+            # Check that the export has not changed before returning any of an earlier download
+            self.started = True
+            self.retrying(self.request)
+        data = ''
+        if self.earlier_remaining:
+            data = self.earlier.read(min(size, self.earlier_remaining))
+            self.earlier_remaining -= len(data)
+        if not data:
+            data = self.retrying(self.download)
+        self.sha256.update(data)
+        self.md5.update(data)
+        self.delivered += len(data)
+        return data
+
+    def retrying(self, function):
+        """ Returns function(), repeating it on a new request after a dropped connection """
+        import requests
+        while True:
+            try:
+                return function()
+            except (requests.RequestException, IOError) as e:
+                self.close_response()
+                if self.retries >= self.downloader.max_retries:
+                    raise DownloadError('Download of %s failed after %d retries: %s' % (self.url, self.retries, e))
+                self.retries += 1
+                if self.downloader.verbosity >= 2:
+                    print 'Resuming %s at byte %d: %s' % (self.name, self.size, e)
+                time.sleep(self.downloader.retry_delay * 2 ** (self.retries - 1))
+
+    def download(self):
+        """ Returns the next bytes of the export from the API, or '' once it is complete and cached """
+        import requests
+        while not self.finished:
+            if self.content is None:
+                self.request()
+                continue
+            data = next(self.content, '')
+            if not data:
+                if self.total_size is not None and self.size < self.total_size:
+                    raise requests.ConnectionError('Connection closed after %d of %d bytes' % (
+                        self.size, self.total_size))
+                self.finished = True
+                break
+            if self.skip:
+                skipped = min(self.skip, len(data))
+                self.skip -= skipped
+                data = data[skipped:]
+            if data:
+                self.partial.write(data)
+                self.size += len(data)
+                return data
+        self.complete()
+        return ''
+
+    def request(self):
+        """ Starts a request for the rest of the export, or sets 'finished' if nothing is left """
+        import requests
+        self.close_response()
+        headers = dict(self.downloader.headers)
+        if self.size:
+            headers['Range'] = 'bytes=%d-' % self.size
+            if self.etag:
+                headers['If-Range'] = self.etag
+        response = self.downloader.session.get(self.url, headers=headers, stream=True,
+                                               timeout=self.downloader.timeout)
+        if response.status_code == 416 and self.size:
+            # The partial file already holds the whole export
+            response.close()
+            self.finished = True
+            return
+        if response.status_code >= 500 or response.status_code == 429:
+            response.close()
+            raise requests.ConnectionError('HTTP %d' % response.status_code)
+        if response.status_code not in (200, 206):
+            response.close()
+            raise DownloadError('%s: HTTP %d, the export may not exist or may still be being generated' % (
+                self.url, response.status_code))
+
+        if response.status_code == 206:
+            match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+            if not match or int(match.group(1)) != self.size:
+                response.close()
+                raise DownloadError('%s: unexpected Content-Range %r' % (
+                    self.url, response.headers.get('Content-Range')))
+            if match.group(3) != '*':
+                self.total_size = int(match.group(3))
+        else:
+            # The whole export is sent, either because the server ignores ranges or because the
+            # export has changed since the partial download and no longer matches If-Range
+            length = int(response.headers['Content-Length']) if response.headers.get('Content-Length') else None
+            if self.etag:
+                unchanged = response.headers.get('ETag') == self.etag
+            else:
+                unchanged = self.total_size is not None and length == self.total_size
+            if self.size and unchanged:
+                self.skip = self.size
+            elif self.size:
+                response.close()
+                # restart() makes the request for the whole export again
+                self.restart()
+                return
+            self.total_size = length
+        self.etag = response.headers.get('ETag') or self.etag
+        with open(self.meta_filename, 'w') as fp:
+            json.dump({'url': self.url, 'etag': self.etag}, fp)
+        self.response = response
+        self.content = response.iter_content(CHUNK_SIZE)
+
+    def restart(self):
+        """ Discards the partial download of an export that has changed, and requests it again """
+        if self.delivered:
+            raise DownloadError('%s changed on the server while it was being read' % self.url)
+        self.partial.close()
+        self.partial = open(self.partial_filename, 'wb')
+        self.earlier_remaining = 0
+        self.size = 0
+        self.etag = None
+        self.request()
+
+    def complete(self):
+        """ Verifies the downloaded export and moves it into the cache """
+        if self.filename is not None:
+            return
+        self.partial.close()
+        self.close_response()
+        sha256 = self.sha256.hexdigest()
+        problems = []
+        if self.total_size is not None and self.size != self.total_size:
+            problems.append('%d bytes downloaded, %d expected' % (self.size, self.total_size))
+        if self.expected_sha256 and sha256 != self.expected_sha256.lower():
+            problems.append('SHA-256 %s, %s expected' % (sha256, self.expected_sha256))
+        match = MD5_ETAG_RE.match(self.etag or '')
+        if match and self.md5.hexdigest() != match.group(1):
+            problems.append('MD5 %s does not match the ETag %s' % (self.md5.hexdigest(), self.etag))
+        if problems:
+            # Start from scratch next time rather than resuming a corrupt download
+            for filename in (self.partial_filename, self.meta_filename):
+                if os.path.exists(filename):
+                    os.remove(filename)
+            raise DownloadError('Download of %s failed verification: %s' % (self.url, '; '.join(problems)))
+        self.filename = self.cache.store(self.owner, self.source, self.version, self.partial_filename, sha256,
+                                         {'url': self.url, 'etag': self.etag})
+        if os.path.exists(self.meta_filename):
+            os.remove(self.meta_filename)
+
+    def close_response(self):
+        if self.response is not None:
+            self.response.close()
+        self.response = None
+        self.content = None
+        self.skip = 0
+
+    def close(self):
+        """ Stops the download; an unfinished download is kept to be resumed later """
+        if self.closed:
+            return
+        self.closed = True
+        self.close_response()
+        self.earlier.close()
+        if not self.partial.closed:
+            self.partial.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ExportDownloader(object):
+    """ Opens and downloads OCL source version exports through an ExportCache """
+
+    def __init__(self, api_url, token, cache_directory, max_retries=DEFAULT_MAX_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY, timeout=DEFAULT_TIMEOUT, verbosity=1):
+        import requests
+        self.api_url = api_url
+        self.headers = {'Authorization': 'Token %s' % token} if token else {}
+        self.cache = ExportCache(cache_directory)
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.verbosity = verbosity
+        self.session = requests.Session()
+
+    def open(self, owner, source, version, sha256=None):
+        """ Returns a file object over an export: the cached file, or an ExportStream """
+        filename = self.cache.lookup(owner, source, version)
+        if filename is not None:
+            return open(filename, 'rb')
+        return ExportStream(self, owner, source, version, sha256)
+
+    def fetch(self, owner, source, version, sha256=None):
+        """ Downloads an export unless it is cached, and returns its cached file """
+        filename = self.cache.lookup(owner, source, version)
+        if filename is not None:
+            return filename
+        with ExportStream(self, owner, source, version, sha256) as stream:
+            while stream.read(CHUNK_SIZE):
+                pass
+            return stream.filename
+
+
+def open_export(url):
+    """
+    Opens an export URL (ocl://OWNER/SOURCE/VERSION) with the OCL API and export cache given
+    by the OCL_API_URL, OCL_API_TOKEN and OCL_EXPORT_CACHE settings
+    """
+    from django.conf import settings
+    owner, source, version, sha256 = parse_export_url(url)
+    downloader = ExportDownloader(settings.OCL_API_URL, settings.OCL_API_TOKEN, settings.OCL_EXPORT_CACHE)
+    return downloader.open(owner, source, version, sha256)
@@ -0,0 +1,462 @@
+"""
+Streaming readers for OCL concept and mapping files.
+
+iter_records() yields the concept and mapping records of either a JSON-lines file (one record
+per line, as written by extract_db --raw) or an OCL source version export document (a JSON
+object with 'concepts' and 'mappings' arrays). Export documents are decoded one array element
+at a time, so neither format is read into memory as a whole.
+
+Inputs may be compressed (.gz, .bz2 or .xz) and are then decompressed as they are read, in a
+background thread that runs ahead of the parser. An input can also name several files: a glob
+pattern, a comma-separated list, or a shard directory or manifest.json written by extract_db
+--output_dir. The files are read one after the other as if they were one file. An input of the
+form ocl://OWNER/SOURCE/VERSION is an OCL source version export, read from the local export
+cache or parsed while it downloads (see omrs.ocl_download); its format and compression are
+detected from its first bytes.
+"""
+import bz2
+import glob
+import itertools
+import json
+import os
+import Queue
+import struct
+import sys
+import threading
+import zlib
+
+from omrs.shards import MANIFEST_FILENAME
+
+
+CHUNK_SIZE = 1 << 16
+WHITESPACE = ' \t\r\n'
+# Longest first line read when detecting the JSON-lines format
+FIRST_LINE_LIMIT = 1 << 20
+# Arrays of an export document whose elements are yielded as records
+RECORD_ARRAYS = ('concepts', 'mappings')
+# Decompressed chunks buffered ahead of the reader
+DECOMPRESS_QUEUE_SIZE = 16
+# Seconds between checks for a closed reader while the decompression thread waits
+POLL_INTERVAL = 0.1
+# Prefix of inputs naming an OCL source version export, downloaded by omrs.ocl_download
+OCL_EXPORT_SCHEME = 'ocl://'
+
+
+## INPUT FILES
+
+def lzma_decompressor():
+    """ Returns an xz decompressor from the lzma module, or its Python 2 backport """
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise IOError('Reading .xz files requires the backports.lzma package')
+    return lzma.LZMADecompressor()
+
+
+# File extension -> function returning a new decompressor for one compressed stream
+DECOMPRESSORS = {
+    '.gz': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    '.bz2': bz2.BZ2Decompressor,
+    '.xz': lzma_decompressor,
+}
+
+
+class ZipMemberDecompressor(object):
+    """
+    Decompressor for the first member of a zip archive, such as an OCL export, read as a
+    stream: the local file header is skipped and the deflated data inflated. Anything after
+    the first member is ignored.
+    """
+    # Signature, compression method, file name length and extra field length
+    LOCAL_HEADER = struct.Struct('<4s4xH16xHH')
+    LOCAL_HEADER_SIGNATURE = 'PK\x03\x04'
+    DEFLATED = 8
+
+    def __init__(self):
+        self.header = ''
+        self.inflater = None
+        self.done = False
+
+    def decompress(self, data):
+        if self.done:
+            return ''
+        if self.inflater is None:
+            self.header += data
+            if len(self.header) < self.LOCAL_HEADER.size:
+                return ''
+            signature, method, name_length, extra_length = self.LOCAL_HEADER.unpack_from(self.header)
+            if signature != self.LOCAL_HEADER_SIGNATURE:
+                raise IOError('Not a zip archive')
+            if method != self.DEFLATED:
+                raise IOError('Unsupported zip compression method %d' % method)
+            start = self.LOCAL_HEADER.size + name_length + extra_length
+            if len(self.header) < start:
+                return ''
+            self.inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+            data, self.header = self.header[start:], ''
+        output = self.inflater.decompress(data)
+        if self.inflater.unused_data:
+            self.done = True
+        return output
+
+
+class PassThroughDecompressor(object):
+    """ Decompressor for uncompressed data, so that a download is still read ahead in a thread """
+
+    def decompress(self, data):
+        return data
+
+
+def sniff_decompressor(data):
+    """ Returns a decompressor for data that starts with data, chosen by its magic number """
+    if data.startswith('\x1f\x8b'):
+        return DECOMPRESSORS['.gz']()
+    if data.startswith('BZh'):
+        return DECOMPRESSORS['.bz2']()
+    if data.startswith('\xfd7zXZ\x00'):
+        return DECOMPRESSORS['.xz']()
+    if data.startswith(ZipMemberDecompressor.LOCAL_HEADER_SIGNATURE):
+        return ZipMemberDecompressor()
+    return PassThroughDecompressor()
+
+
+class SniffingDecompressor(object):
+    """ Decompressor for data of unknown format, e.g. a download, chosen from its first bytes """
+
+    def __init__(self):
+        self.decompressor = None
+
+    @property
+    def unused_data(self):
+        return getattr(self.decompressor, 'unused_data', '')
+
+    def decompress(self, data):
+        if self.decompressor is None:
+            self.decompressor = sniff_decompressor(data)
+        return self.decompressor.decompress(data)
+
+
+class DecompressingReader(object):
+    """
+    Read-only file object over a compressed file, decompressed by a background thread.
+
+    zlib, bz2 and lzma release the interpreter lock while they work, so decompression overlaps
+    with the parsing done by the reading thread. Concatenated streams, e.g. multi-member gzip
+    files, are read as one.
+    """
+
+    def __init__(self, filename, make_decompressor, queue_size=DECOMPRESS_QUEUE_SIZE, raw=None):
+        self.name = filename
+        # raw is an already open source of compressed data, e.g. a download in progress
+        self.raw = raw if raw is not None else open(filename, 'rb')
+        self.queue = Queue.Queue(queue_size)
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.decompress, args=(make_decompressor,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, item):
+        while not self.closed:
+            try:
+                self.queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except Queue.Full:
+                pass
+
+    def decompress(self, make_decompressor):
+        try:
+            decompressor = make_decompressor()
+            while not self.closed:
+                data = self.raw.read(CHUNK_SIZE)
+                if not data:
+                    break
+                while data:
+                    try:
+                        output = decompressor.decompress(data)
+                    except EOFError:
+                        # The previous stream ended exactly at the end of the last chunk
+                        decompressor = make_decompressor()
+                        continue
+                    if output:
+                        self.put(output)
+                    # Data after the end of a stream starts the next stream
+                    data = getattr(decompressor, 'unused_data', '')
+                    if data:
+                        decompressor = make_decompressor()
+            self.put('')
+        except Exception:
+            self.put(sys.exc_info())
+
+    def fill(self):
+        """ Appends the next decompressed chunk to the buffer; returns False at the end of the file """
+        if self.eof:
+            return False
+        chunk = self.queue.get()
+        if isinstance(chunk, tuple):
+            raise chunk[0], chunk[1], chunk[2]
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def read(self, size=-1):
+        while (size < 0 or len(self.buffer) - self.position < size) and self.fill():
+            pass
+        end = len(self.buffer) if size < 0 else self.position + size
+        data = self.buffer[self.position:end]
+        self.position += len(data)
+        return data
+
+    def readline(self, limit=-1):
+        while True:
+            end = self.buffer.find('\n', self.position)
+            if end >= 0:
+                end += 1
+                break
+            if limit >= 0 and len(self.buffer) - self.position >= limit:
+                end = len(self.buffer)
+                break
+            if not self.fill():
+                end = len(self.buffer)
+                break
+        if limit >= 0:
+            end = min(end, self.position + limit)
+        line = self.buffer[self.position:end]
+        self.position = end
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.thread.join()
+            self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_input(filename):
+    """
+    Opens an input file for reading, decompressing it if its extension is .gz, .bz2 or .xz.
+    An OCL export URL (see omrs.ocl_download) is read from the export cache, or streamed from
+    the OCL API while it is downloaded into the cache.
+    """
+    if filename.startswith(OCL_EXPORT_SCHEME):
+        from omrs.ocl_download import open_export
+        return DecompressingReader(filename, SniffingDecompressor, raw=open_export(filename))
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in DECOMPRESSORS:
+        return DecompressingReader(filename, DECOMPRESSORS[extension])
+    return open(filename, 'rb')
+
+
+def expand_inputs(spec):
+    """
+    Returns the files named by an input: a filename, a glob pattern (matches in sorted order), a
+    shard directory or manifest.json (shards in manifest order), an OCL export URL
+    (ocl://OWNER/SOURCE/VERSION), or a comma-separated list of these.
+    """
+    filenames = []
+    for part in spec.split(','):
+        if part.startswith(OCL_EXPORT_SCHEME):
+            filenames.append(part)
+            continue
+        if os.path.isdir(part):
+            part = os.path.join(part, MANIFEST_FILENAME)
+        if os.path.basename(part) == MANIFEST_FILENAME:
+            with open(part, 'r') as fp:
+                manifest = json.load(fp)
+            filenames.extend(os.path.join(os.path.dirname(part), shard['filename']) for shard in manifest['shards'])
+        elif glob.has_magic(part):
+            matches = sorted(glob.glob(part))
+            if not matches:
+                raise IOError('No files match %s' % part)
+            filenames.extend(matches)
+        else:
+            filenames.append(part)
+    return filenames
+
+
+def iter_lines(spec):
+    """ Yields (filename, line number, line) for the lines of every file named by an input """
+    for filename in expand_inputs(spec):
+        with open_input(filename) as fp:
+            for line_number, line in enumerate(fp, 1):
+                yield filename, line_number, line
+
+
+## RECORDS
+
+
+class JsonStreamReader(object):
+    """ Decodes a JSON document piece by piece from a file, reading it in chunks """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        """ Appends the next chunk of the file to the buffer; returns False at the end of the file """
+        chunk = self.fp.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    def peek(self):
+        """ Returns the next non-whitespace character, or '' at the end of the file """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self.fill():
+                return ''
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError('Expected %r but found %r' % (char, found or 'end of file'))
+        self.position += 1
+
+    def decode(self):
+        """ Decodes and returns the next complete JSON value """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.position)
+                # A value ending at the end of the buffer, e.g. a number, may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.fill()
+
+
+def is_export_document(value):
+    """ Returns True if a decoded JSON object is an export document rather than a record """
+    if not isinstance(value, dict) or 'concepts' in value:
+        return isinstance(value, dict)
+    return 'mappings' in value and 'map_type' not in value and 'concept_class' not in value
+
+
+def iter_document_records(reader):
+    """ Yields the elements of the record arrays of the export document being read by reader """
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.decode()
+        reader.expect(':')
+        if key in RECORD_ARRAYS and reader.peek() == '[':
+            reader.expect('[')
+            if reader.peek() != ']':
+                while True:
+                    yield reader.decode()
+                    if reader.peek() != ',':
+                        break
+                    reader.expect(',')
+            reader.expect(']')
+        else:
+            # Export metadata, e.g. the source version's id and description
+            reader.decode()
+        if reader.peek() != ',':
+            break
+        reader.expect(',')
+    reader.expect('}')
+
+
+def iter_records(spec):
+    """
+    Yields the concept and mapping records of every file named by an input (see
+    expand_inputs), each a JSON-lines file or an OCL export document, compressed or not.
+    """
+    for filename in expand_inputs(spec):
+        for record in iter_file_records(filename):
+            yield record
+
+
+def iter_file_records(filename):
+    """ Yields the concept and mapping records of a JSON-lines file or an OCL export document """
+    for number, record, error in iter_numbered_records(filename):
+        if error is not None:
+            raise ValueError('%s line %d: %s' % (filename, number, error))
+        yield record
+
+
+def starts_document(first_line, first_record):
+    """ Returns True if the first line of a file starts an export document rather than a JSON-lines file """
+    if first_record is not None:
+        return is_export_document(first_record)
+    # A pretty-printed document, or one too long for the first line limit, does not parse as a line
+    return first_line.lstrip().startswith('{') and not first_line.rstrip().endswith('}')
+
+
+def iter_numbered_records(filename):
+    """
+    Yields (number, record, parse error) for a JSON-lines file or an OCL export document:
+    the line number and record (or None and the error) of each non-blank line of a JSON-lines
+    file, or the position and record of each record of an export document.
+    """
+    with open_input(filename) as fp:
+        # The first line is kept rather than seeking back, as compressed input cannot seek
+        first_line = fp.readline(FIRST_LINE_LIMIT)
+        try:
+            first_record = json.loads(first_line)
+        except ValueError:
+            first_record = None
+
+        if starts_document(first_line, first_record):
+            reader = JsonStreamReader(fp)
+            reader.buffer = first_line
+            if reader.peek():
+                for number, record in enumerate(iter_document_records(reader), 1):
+                    yield number, record, None
+            return
+
+        lines = itertools.chain([first_line], fp)
+        for line_number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                record, error = json.loads(line), None
+            except ValueError as e:
+                record, error = None, 'invalid JSON: %s' % e
+            yield line_number, record, error
+
+
+def is_mapping(record):
+    """ Returns True if an OCL record is a mapping, False if it is a concept """
+    return 'map_type' in record
+
+
+def is_concept(record):
+    """ Returns True if an OCL record is a concept, e.g. to skip concepts in a shard read for its mappings """
+    return 'concept_class' in record and not is_mapping(record)
@@ -0,0 +1,141 @@
+"""
+Byte-offset index over OCL JSON-lines concept and mapping files.
+
+build_index() writes a sidecar file (FILENAME.idx) holding one fixed-width record per line of
+the data file: the concept ID the line belongs to (the concept's 'id' for concept files, the
+concept in 'from_concept_url' for mapping files), the byte offset of the line and its length.
+Records are sorted by concept ID, so OclFileIndex can binary search the memory-mapped index
+and read only the matching lines of the memory-mapped data file.
+"""
+import json
+import mmap
+import os
+import struct
+
+from omrs.management.commands import OclOpenmrsHelper
+
+
+INDEX_MAGIC = 'OCLIDX01'
+INDEX_SUFFIX = '.idx'
+# Header: magic, size and modification time of the indexed data file
+HEADER = struct.Struct('<8sQQ')
+# Record: concept ID, byte offset of the line, length of the line
+RECORD = struct.Struct('<qQI')
+
+CONCEPT_FILE = 'concept'
+MAPPING_FILE = 'mapping'
+
+
+class IndexStaleException(Exception):
+    """ IndexStaleException """
+    pass
+
+
+def index_filename(filename):
+    """ Returns the sidecar index filename for a data file """
+    return filename + INDEX_SUFFIX
+
+
+def data_file_signature(filename):
+    """ Returns the (size, mtime) pair recorded in an index to detect changes to its data file """
+    stat = os.stat(filename)
+    return stat.st_size, int(stat.st_mtime)
+
+
+def get_record_concept_id(record, file_type):
+    """ Returns the concept ID that a record of a concept or mapping file belongs to """
+    if file_type == MAPPING_FILE:
+        return OclOpenmrsHelper.get_concept_id_from_url(record['from_concept_url'])
+    return int(record['id'])
+
+
+def build_index(filename, file_type):
+    """
+    Builds the sidecar index for a concept or mapping JSON-lines file.
+
+    :param filename: OCL JSON-lines file to index.
+    :param file_type: CONCEPT_FILE or MAPPING_FILE.
+    :returns: Number of lines indexed.
+    """
+    records = []
+    offset = 0
+    with open(filename, 'rb') as fp:
+        for line in fp:
+            if line.strip():
+                records.append((get_record_concept_id(json.loads(line), file_type), offset, len(line)))
+            offset += len(line)
+    records.sort()
+
+    size, mtime = data_file_signature(filename)
+    with open(index_filename(filename), 'wb') as fp:
+        fp.write(HEADER.pack(INDEX_MAGIC, size, mtime))
+        for record in records:
+            fp.write(RECORD.pack(*record))
+    return len(records)
+
+
+def has_index(filename):
+    """ Returns True if filename has an index that is up to date with the data file """
+    try:
+        with open(index_filename(filename), 'rb') as fp:
+            magic, size, mtime = HEADER.unpack(fp.read(HEADER.size))
+    except (IOError, struct.error):
+        return False
+    return magic == INDEX_MAGIC and (size, mtime) == data_file_signature(filename)
+
+
+def map_file(fp):
+    """ Returns a read-only mmap of an open file, or an empty string for an empty file """
+    if os.fstat(fp.fileno()).st_size == 0:
+        return ''
+    return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class OclFileIndex(object):
+    """ Random access by concept ID to the lines of an indexed OCL JSON-lines file """
+
+    def __init__(self, filename):
+        if not has_index(filename):
+            raise IndexStaleException('Index for %s is missing or out of date, rebuild it with index_ocl_file' % filename)
+        self.data_file = open(filename, 'rb')
+        self.index_file = open(index_filename(filename), 'rb')
+        self.data = map_file(self.data_file)
+        self.index = map_file(self.index_file)
+        self.count = (len(self.index) - HEADER.size) // RECORD.size
+
+    def record_at(self, position):
+        return RECORD.unpack_from(self.index, HEADER.size + position * RECORD.size)
+
+    def find_first(self, concept_id):
+        """ Returns the position of the first index record for concept_id or later """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record_at(middle)[0] < concept_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def lines_for(self, concept_id):
+        """ Yields the raw JSON lines belonging to concept_id, in file order """
+        position = self.find_first(concept_id)
+        while position < self.count:
+            record_concept_id, offset, length = self.record_at(position)
+            if record_concept_id != concept_id:
+                break
+            yield self.data[offset:offset + length]
+            position += 1
+
+    def records_for(self, concept_ids):
+        """ Yields the decoded records belonging to each of concept_ids """
+        for concept_id in concept_ids:
+            for line in self.lines_for(concept_id):
+                yield json.loads(line)
+
+    def close(self):
+        for mapped in (self.data, self.index):
+            if mapped:
+                mapped.close()
+        self.data_file.close()
+        self.index_file.close()
@@ -0,0 +1,198 @@
+"""
+Streaming checks of OCL concept and mapping files against what sync_bahmni_db reads.
+
+OclFileValidator reads JSON-lines files one line at a time and yields an error for every
+missing field, wrong type or malformed URL, plus referential errors: duplicate concept IDs and
+mappings whose from concept (or, for Q-AND-A and CONCEPT-SET mappings, to concept) is neither
+in the concept file nor in the keys file of an earlier sync. Files may be compressed or
+sharded (see omrs.ocl_files); mappings in a concept file and concepts in a mapping file are
+skipped, as both are mixed in the shards written by extract_db --output_dir.
+"""
+import json
+import re
+
+from omrs.management.commands import OclOpenmrsHelper
+from omrs.ocl_files import expand_inputs, is_concept, is_mapping, iter_numbered_records
+
+
+CONCEPT_URL_RE = re.compile(r'^/orgs/[^/]+/sources/[^/]+/concepts/\d+/$')
+SOURCE_URL_RE = re.compile(r'^/orgs/[^/]+/sources/[^/]+/$')
+# Length of the uuid columns that external_ids are written to
+UUID_MAX_LENGTH = 38
+
+
+def is_string(value):
+    return isinstance(value, basestring)
+
+
+def is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def is_flag(value):
+    """ Booleans, or the 0/1 integers of MySQL boolean columns """
+    return isinstance(value, bool) or value in (0, 1)
+
+
+def is_concept_id(value):
+    return is_integer(value) or (is_string(value) and value.isdigit())
+
+
+def is_uuid(value):
+    return is_string(value) and 0 < len(value) <= UUID_MAX_LENGTH
+
+
+def is_optional_string(value):
+    return value is None or is_string(value)
+
+
+def is_number(value):
+    return value is None or (isinstance(value, (int, long, float)) and not isinstance(value, bool))
+
+
+# (field, check, description) for each record type
+CONCEPT_FIELDS = (
+    ('id', is_concept_id, 'a numeric concept ID'),
+    ('concept_class', is_string, 'a string'),
+    ('datatype', is_string, 'a string'),
+    ('retired', is_flag, 'a boolean'),
+    ('external_id', is_uuid, 'a uuid of at most %d characters' % UUID_MAX_LENGTH),
+    ('names', lambda value: isinstance(value, list) and len(value) > 0, 'a non-empty list'),
+    ('descriptions', lambda value: isinstance(value, list), 'a list'),
+    ('extras', lambda value: isinstance(value, dict), 'an object'),
+)
+NAME_FIELDS = (
+    ('name', is_string, 'a string'),
+    ('name_type', is_optional_string, 'a string'),
+    ('locale', is_string, 'a string'),
+    ('locale_preferred', is_flag, 'a boolean'),
+    ('external_id', is_uuid, 'a uuid of at most %d characters' % UUID_MAX_LENGTH),
+    ('voided', is_flag, 'a boolean'),
+)
+DESCRIPTION_FIELDS = (
+    ('description', is_string, 'a string'),
+    ('locale', is_string, 'a string'),
+    ('external_id', is_uuid, 'a uuid of at most %d characters' % UUID_MAX_LENGTH),
+)
+NUMERIC_EXTRAS_FIELDS = (
+    ('units', is_optional_string, 'a string'),
+    ('precise', is_flag, 'a boolean'),
+)
+NUMERIC_OPTIONAL_FIELDS = ('hi_absolute', 'hi_critical', 'hi_normal', 'low_absolute', 'low_critical', 'low_normal')
+MAPPING_FIELDS = (
+    ('map_type', is_string, 'a string'),
+    ('from_concept_url', lambda value: is_string(value) and CONCEPT_URL_RE.match(value), 'a concept URL'),
+    ('creator', is_integer, 'an integer'),
+    ('retired', is_flag, 'a boolean'),
+)
+INTERNAL_MAPPING_FIELDS = (
+    ('to_concept_url', lambda value: is_string(value) and CONCEPT_URL_RE.match(value), 'a concept URL'),
+)
+EXTERNAL_MAPPING_FIELDS = (
+    ('to_source_url', lambda value: is_string(value) and SOURCE_URL_RE.match(value), 'a source URL'),
+    ('to_concept_code', lambda value: is_string(value) or is_integer(value), 'a string'),
+    ('concept_map_id', is_integer, 'an integer'),
+)
+
+
+class OclFileValidator(object):
+    """ Validates OCL concept and mapping JSON-lines files line by line """
+
+    def __init__(self, known_concept_ids=None, check_references=True):
+        # OCL concept IDs that mappings may reference, e.g. from the keys file of an earlier sync
+        self.concept_ids = set(known_concept_ids or ())
+        self.check_references = check_references
+        self.cnt_lines = 0
+
+    def check_fields(self, record, fields, path=''):
+        """ Yields (field path, message) for each field of record that is missing or invalid """
+        for field, check, description in fields:
+            if field not in record:
+                yield path + field, 'missing'
+            elif not check(record[field]):
+                yield path + field, 'must be %s, found %s' % (description, json.dumps(record[field]))
+
+    def iter_lines(self, filename):
+        """
+        Yields (filename, line number, record or None, parse error or None) for the non-blank
+        lines of each file named by filename (see omrs.ocl_files.expand_inputs). The records of
+        an export document are numbered by position instead of line.
+        """
+        for path in expand_inputs(filename):
+            for line_number, record, parse_error in iter_numbered_records(path):
+                self.cnt_lines += 1
+                if parse_error is None and not isinstance(record, dict):
+                    record, parse_error = None, 'must be a JSON object'
+                yield path, line_number, record, parse_error
+
+    def validate_concept_file(self, filename):
+        """ Yields an error dictionary for each problem in a concept file and records its concept IDs """
+        for path, line_number, concept, parse_error in self.iter_lines(filename):
+            if parse_error:
+                yield self.error(path, line_number, None, parse_error)
+                continue
+            if is_mapping(concept):
+                continue
+            for field, message in self.check_concept(concept):
+                yield self.error(path, line_number, field, message)
+            if is_concept_id(concept.get('id')):
+                concept_id = int(concept['id'])
+                if concept_id in self.concept_ids:
+                    yield self.error(path, line_number, 'id', 'duplicate concept ID %d' % concept_id)
+                self.concept_ids.add(concept_id)
+
+    def check_concept(self, concept):
+        for error in self.check_fields(concept, CONCEPT_FIELDS):
+            yield error
+        for num, cname in enumerate(concept.get('names') or []):
+            for error in self.check_fields(cname, NAME_FIELDS, 'names[%d].' % num):
+                yield error
+        for num, cdescription in enumerate(concept.get('descriptions') or []):
+            for error in self.check_fields(cdescription, DESCRIPTION_FIELDS, 'descriptions[%d].' % num):
+                yield error
+        extras = concept.get('extras')
+        if concept.get('datatype') == 'Numeric' and isinstance(extras, dict):
+            for error in self.check_fields(extras, NUMERIC_EXTRAS_FIELDS, 'extras.'):
+                yield error
+            for field in NUMERIC_OPTIONAL_FIELDS:
+                if not is_number(extras.get(field)):
+                    yield 'extras.' + field, 'must be a number, found %s' % json.dumps(extras[field])
+
+    def validate_mapping_file(self, filename):
+        """ Yields an error dictionary for each problem in a mapping file """
+        for path, line_number, mapping, parse_error in self.iter_lines(filename):
+            if parse_error:
+                yield self.error(path, line_number, None, parse_error)
+                continue
+            if is_concept(mapping):
+                continue
+            for field, message in self.check_mapping(mapping):
+                yield self.error(path, line_number, field, message)
+
+    def check_mapping(self, mapping):
+        for error in self.check_fields(mapping, MAPPING_FIELDS):
+            yield error
+        if 'to_concept_url' in mapping:
+            fields = INTERNAL_MAPPING_FIELDS
+        elif 'to_source_url' in mapping:
+            fields = EXTERNAL_MAPPING_FIELDS
+        else:
+            yield 'to_concept_url', 'either to_concept_url or to_source_url is required'
+            return
+        for error in self.check_fields(mapping, fields):
+            yield error
+
+        # Referential checks against the concept file and keys file
+        if not self.check_references:
+            return
+        if is_string(mapping.get('from_concept_url')) and CONCEPT_URL_RE.match(mapping['from_concept_url']):
+            if OclOpenmrsHelper.get_concept_id_from_url(mapping['from_concept_url']) not in self.concept_ids:
+                yield 'from_concept_url', 'from concept is not in the concept file or keys file'
+        if mapping.get('map_type') in (OclOpenmrsHelper.MAP_TYPE_CONCEPT_SET, OclOpenmrsHelper.MAP_TYPE_Q_AND_A):
+            to_concept_url = mapping.get('to_concept_url')
+            if is_string(to_concept_url) and CONCEPT_URL_RE.match(to_concept_url):
+                if OclOpenmrsHelper.get_concept_id_from_url(to_concept_url) not in self.concept_ids:
+                    yield 'to_concept_url', 'to concept is not in the concept file or keys file'
+
+    def error(self, filename, line_number, field, message):
+        return {'file': filename, 'line': line_number, 'field': field, 'error': message}
@@ -0,0 +1,220 @@
+"""
+Concurrent uploads of OCL JSON-lines files to the OCL bulk import API.
+
+The input is read as a stream and cut into chunks of at most a given number of records (or
+bytes). Each chunk is posted to the bulk import endpoint, which queues it as a task, and the
+task is then polled until it succeeds or fails. A thread pool keeps several chunks in flight
+while the bounded pipeline (see omrs.pipeline) holds the reader back, so only a few chunks are
+in memory at a time.
+
+Concepts are uploaded before mappings: the mapping chunks are only posted once every concept
+chunk has been imported, so a mapping never reaches OCL before the concepts it references.
+
+UploadState records the task and outcome of each chunk, with a checksum of its contents, in a
+JSON state file that is rewritten after every change. A run with the same state file skips the
+chunks that were imported, polls the tasks that were still running and posts the rest again.
+"""
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import threading
+import time
+
+from omrs.ocl_files import is_mapping, iter_lines
+from omrs.progress import write_atomically
+
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_CONCURRENCY = 4
+DEFAULT_POLL_INTERVAL = 5.0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_DELAY = 1.0
+DEFAULT_TIMEOUT = 300
+
+BULK_IMPORT_PATH = 'importers/bulk-import/'
+
+CONCEPT_PHASE = 'concepts'
+MAPPING_PHASE = 'mappings'
+
+# Chunk states; the remaining states of an OCL task (PENDING, STARTED, RETRY) mean it is running
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+FAILED_TASK_STATES = (FAILURE, 'REVOKED')
+
+
+class UploadError(Exception):
+    """ UploadError """
+    pass
+
+
+class Chunk(object):
+    """ A run of JSON lines uploaded as one bulk import task """
+
+    def __init__(self, key, lines):
+        self.key = key
+        self.text = ''.join(line if line.endswith('\n') else line + '\n' for line in lines)
+        self.records = len(lines)
+        self.checksum = hashlib.sha1(self.text).hexdigest()
+
+
+def iter_chunks(spec, phase, chunk_size=DEFAULT_CHUNK_SIZE, chunk_bytes=None):
+    """
+    Yields the Chunks of the concept or mapping records (depending on phase) of the files named
+    by spec (see omrs.ocl_files.expand_inputs), keyed by phase and number, e.g. 'concepts-3'
+    """
+    lines = []
+    size = 0
+    number = 0
+    for filename, line_number, line in iter_lines(spec):
+        if not line.strip():
+            continue
+        if is_mapping(json.loads(line)) != (phase == MAPPING_PHASE):
+            continue
+        if lines and (len(lines) >= chunk_size or (chunk_bytes and size + len(line) > chunk_bytes)):
+            number += 1
+            yield Chunk('%s-%d' % (phase, number), lines)
+            lines = []
+            size = 0
+        lines.append(line)
+        size += len(line)
+    if lines:
+        number += 1
+        yield Chunk('%s-%d' % (phase, number), lines)
+
+
+class UploadState(object):
+    """ Task and outcome of each chunk, saved to a state file so that an upload can be resumed """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.chunks = OrderedDict()
+        if filename and os.path.exists(filename):
+            with open(filename, 'r') as fp:
+                self.chunks = json.load(fp, object_pairs_hook=OrderedDict)['chunks']
+
+    def get(self, chunk):
+        """ Returns the saved state of a chunk, or None if it is new or its contents changed """
+        with self.lock:
+            saved = self.chunks.get(chunk.key)
+            if saved is None or saved['checksum'] != chunk.checksum:
+                return None
+            return dict(saved)
+
+    def update(self, chunk, **fields):
+        with self.lock:
+            saved = self.chunks.get(chunk.key)
+            if saved is None or saved['checksum'] != chunk.checksum:
+                saved = self.chunks[chunk.key] = OrderedDict([('checksum', chunk.checksum), ('records', chunk.records)])
+            saved.update(fields)
+            if self.filename:
+                write_atomically(self.filename, json.dumps({'chunks': self.chunks}, indent=2) + '\n')
+
+
+class BulkImporter(object):
+    """ Posts chunks to the OCL bulk import API and polls their tasks until they finish """
+
+    def __init__(self, api_url, token, state, update_if_exists=False, queue=None,
+                 poll_interval=DEFAULT_POLL_INTERVAL, max_retries=DEFAULT_MAX_RETRIES,
+                 retry_delay=DEFAULT_RETRY_DELAY, timeout=DEFAULT_TIMEOUT, verbosity=1):
+        self.url = api_url.rstrip('/') + '/' + BULK_IMPORT_PATH
+        if queue:
+            self.url += queue + '/'
+        self.headers = {'Authorization': 'Token %s' % token, 'Content-Type': 'application/json'}
+        self.state = state
+        self.update_if_exists = update_if_exists
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+        self.verbosity = verbosity
+        # requests sessions are not thread-safe, so each pool thread has its own
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cnt_retries = 0
+
+    def session(self):
+        import requests
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def request(self, method, **kwargs):
+        """
+        Returns the response to an API request, repeating it after connection errors and server
+        errors. Raises UploadError for a client error or once the retries are used up.
+        """
+        import requests
+        attempt = 0
+        while True:
+            try:
+                response = self.session().request(method, self.url, headers=self.headers,
+                                                  timeout=self.timeout, **kwargs)
+                if response.status_code < 500 and response.status_code != 429:
+                    break
+                error = 'HTTP %d: %s' % (response.status_code, response.text[:200])
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt >= self.max_retries:
+                raise UploadError('%s %s failed after %d retries: %s' % (method, self.url, attempt, error))
+            attempt += 1
+            with self.lock:
+                self.cnt_retries += 1
+            time.sleep(self.retry_delay * 2 ** (attempt - 1))
+        if response.status_code >= 400:
+            raise UploadError('%s %s: HTTP %d: %s' % (
+                method, self.url, response.status_code, response.text[:200]))
+        return response
+
+    def submit(self, chunk):
+        """ Posts a chunk and returns the ID of its bulk import task """
+        params = {'update_if_exists': 'true' if self.update_if_exists else 'false'}
+        response = self.request('POST', params=params, data=chunk.text)
+        try:
+            return response.json()['task']
+        except (ValueError, KeyError, TypeError):
+            raise UploadError('No task ID in the bulk import response: %s' % response.text[:200])
+
+    def poll(self, task):
+        """ Waits for a task to finish and returns its final state and result """
+        while True:
+            response = self.request('GET', params={'task': task})
+            try:
+                result = response.json()
+            except ValueError:
+                result = response.text
+            task_state = result.get('state') if isinstance(result, dict) else None
+            if task_state in FAILED_TASK_STATES:
+                return FAILURE, result
+            # A finished task returns its results, with or without a state
+            if task_state == SUCCESS or (response.status_code == 200 and task_state is None):
+                return SUCCESS, result
+            time.sleep(self.poll_interval)
+
+    def upload(self, chunk):
+        """
+        Imports a chunk, unless the state file shows that it was imported already, and returns
+        a dictionary of its key, state, records, bytes and error. Failures are returned rather
+        than raised, so that the other chunks carry on.
+        """
+        started = time.time()
+        saved = self.state.get(chunk)
+        outcome = {'key': chunk.key, 'records': chunk.records, 'bytes': len(chunk.text), 'skipped': False}
+        if saved is not None and saved.get('state') == SUCCESS:
+            outcome.update(state=SUCCESS, skipped=True, error=None)
+            return outcome
+        try:
+            task = saved.get('task') if saved is not None and saved.get('state') != FAILURE else None
+            if task is None:
+                task = self.submit(chunk)
+                self.state.update(chunk, task=task, state='PENDING', error=None)
+            elif self.verbosity >= 2:
+                print 'Resuming task %s of %s' % (task, chunk.key)
+            task_state, result = self.poll(task)
+            error = None if task_state == SUCCESS else json.dumps(result)[:500]
+        except UploadError as e:
+            task_state, error = FAILURE, str(e)
+        self.state.update(chunk, state=task_state, error=error, seconds=round(time.time() - started, 1))
+        outcome.update(state=task_state, error=error)
+        return outcome
@@ -0,0 +1,105 @@
+"""
+Three-stage pipeline with bounded queues.
+
+run_pipeline() overlaps reading, transforming and consuming a sequence of items: a reader
+thread pulls items from the source iterator, a transform thread applies the transform (or
+submits it to a multiprocessing pool), and the calling thread consumes the results in the
+original order. The queues between the stages are bounded, so a slow stage holds the others
+back instead of letting work pile up in memory, and throughput approaches that of the slowest
+stage. An exception in any stage stops the pipeline and is re-raised in the calling thread.
+"""
+import Queue
+import sys
+import threading
+
+
+DEFAULT_QUEUE_SIZE = 4
+# Seconds between checks of the stop flag while a stage waits on a queue
+POLL_INTERVAL = 0.1
+
+DONE = object()
+
+
+class StageFailure(object):
+    """ Carries the exception of a failed stage to the consuming thread """
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def run_pipeline(items, transform, consume, queue_size=DEFAULT_QUEUE_SIZE, pool=None):
+    """
+    Calls consume(transform(item)) for each item in items, in order, with the stages overlapped.
+
+    :param items: Iterable of items, read in a separate thread. A generator is closed in that
+                  thread when reading ends, so it can release resources such as DB connections.
+    :param pool: multiprocessing.Pool to run transform in, instead of a thread. transform must
+                 then be picklable, e.g. a module-level function.
+    """
+    stop = threading.Event()
+    read_queue = Queue.Queue(queue_size)
+    result_queue = Queue.Queue(queue_size)
+
+    def put(queue, entry):
+        while not stop.is_set():
+            try:
+                queue.put(entry, timeout=POLL_INTERVAL)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def get(queue):
+        while not stop.is_set():
+            try:
+                return queue.get(timeout=POLL_INTERVAL)
+            except Queue.Empty:
+                pass
+        return DONE
+
+    def read():
+        iterator = iter(items)
+        try:
+            for item in iterator:
+                if not put(read_queue, item):
+                    return
+            put(read_queue, DONE)
+        except Exception:
+            put(read_queue, StageFailure(sys.exc_info()))
+        finally:
+            if hasattr(iterator, 'close'):
+                iterator.close()
+
+    def transform_items():
+        try:
+            while True:
+                item = get(read_queue)
+                if item is DONE or isinstance(item, StageFailure):
+                    put(result_queue, item)
+                    return
+                if pool is not None:
+                    # Pending results are queued in order; their number bounds the work in flight
+                    result = pool.apply_async(transform, (item,))
+                else:
+                    result = transform(item)
+                if not put(result_queue, result):
+                    return
+        except Exception:
+            put(result_queue, StageFailure(sys.exc_info()))
+
+    threads = [threading.Thread(target=read), threading.Thread(target=transform_items)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            result = result_queue.get()
+            if result is DONE:
+                break
+            if isinstance(result, StageFailure):
+                raise result.exc_info[0], result.exc_info[1], result.exc_info[2]
+            consume(result.get() if pool is not None else result)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
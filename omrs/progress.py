@@ -0,0 +1,168 @@
+"""
+Progress and resource metrics for long-running commands.
+
+ProgressReporter counts the records processed in each phase of a command (e.g. concepts, then
+mappings) and, every few seconds, rewrites a JSON status file and a Prometheus textfile (for
+the node_exporter textfile collector) with the counts, rate, ETA, number of database queries
+and resident memory. Nothing is written to stdout, which carries the JSON output of commands
+such as extract_db. Both files are replaced atomically, so readers never see a partial file.
+"""
+from collections import OrderedDict
+import json
+import os
+import resource
+import time
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+DEFAULT_INTERVAL = 5.0
+METRIC_PREFIX = 'omrs'
+
+
+def get_rss_bytes():
+    """ Returns the resident memory of this process, or its peak where the current size is unavailable """
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        # ru_maxrss is in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def write_atomically(filename, text):
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'w') as fp:
+        fp.write(text)
+    os.rename(temp_filename, filename)
+
+
+class ProgressReporter(object):
+    """ Tracks records processed per phase and writes them to a status file and a metrics file """
+
+    def __init__(self, command, status_filename=None, metrics_filename=None, interval=DEFAULT_INTERVAL,
+                 using=DEFAULT_DB_ALIAS):
+        self.command = command
+        self.status_filename = status_filename
+        self.metrics_filename = metrics_filename
+        self.enabled = bool(status_filename or metrics_filename)
+        self.interval = interval
+        self.using = using
+        self.started = time.time()
+        self.last_write = 0
+        self.done = False
+        self.phase = None
+        # phase name -> {'processed', 'total', 'started', 'finished'}
+        self.phases = OrderedDict()
+
+    def start_phase(self, name, total=None):
+        """ Starts counting a new phase; total is the expected number of records, if known """
+        now = time.time()
+        if self.phase is not None and self.phases[self.phase]['finished'] is None:
+            self.phases[self.phase]['finished'] = now
+        self.phase = name
+        self.phases[name] = {'processed': 0, 'total': total, 'started': now, 'finished': None}
+        self.write()
+
+    def set_total(self, total):
+        if self.phase is not None:
+            self.phases[self.phase]['total'] = total
+
+    def advance(self, count=1):
+        """ Adds count records to the current phase, writing the files if the interval has passed """
+        if not self.enabled or self.phase is None:
+            return
+        self.phases[self.phase]['processed'] += count
+        if time.time() - self.last_write >= self.interval:
+            self.write()
+
+    def finish(self):
+        """ Marks the command as done and writes the final counts """
+        if self.phase is not None and self.phases[self.phase]['finished'] is None:
+            self.phases[self.phase]['finished'] = time.time()
+        self.done = True
+        self.write()
+
+    ## METRICS
+
+    def count_queries(self):
+        """
+        Returns the number of statements run on the command's MySQL connection, or None if the
+        connection is not open or not MySQL. Streams on dedicated connections are not included.
+        """
+        connection = connections[self.using]
+        if connection.vendor != 'mysql' or connection.connection is None:
+            return None
+        cursor = connection.cursor()
+        cursor.execute("SHOW SESSION STATUS LIKE 'Questions'")
+        row = cursor.fetchone()
+        return int(row[1]) if row else None
+
+    def get_status(self):
+        """ Returns the current status as a dictionary """
+        now = time.time()
+        phases = OrderedDict()
+        for name, phase in self.phases.iteritems():
+            elapsed = (phase['finished'] or now) - phase['started']
+            rate = phase['processed'] / elapsed if elapsed > 0 else None
+            eta = None
+            if phase['finished'] is None and phase['total'] is not None and rate:
+                eta = max(phase['total'] - phase['processed'], 0) / rate
+            phases[name] = {
+                'processed': phase['processed'],
+                'total': phase['total'],
+                'elapsed_seconds': round(elapsed, 1),
+                'records_per_second': round(rate, 1) if rate is not None else None,
+                'eta_seconds': round(eta) if eta is not None else None,
+                'finished': phase['finished'] is not None,
+            }
+        return OrderedDict([
+            ('command', self.command),
+            ('pid', os.getpid()),
+            ('started', self.started),
+            ('updated', now),
+            ('done', self.done),
+            ('phase', self.phase),
+            ('phases', phases),
+            ('db_queries', self.count_queries()),
+            ('rss_bytes', get_rss_bytes()),
+        ])
+
+    def format_metrics(self, status):
+        """ Returns the status in the Prometheus text exposition format """
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s_%s %s' % (METRIC_PREFIX, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (METRIC_PREFIX, name, metric_type))
+            for labels, value in samples:
+                if value is not None:
+                    label_text = ','.join('%s="%s"' % label for label in [('command', self.command)] + labels)
+                    lines.append('%s_%s{%s} %s' % (METRIC_PREFIX, name, label_text, value))
+
+        phases = status['phases'].items()
+        metric('records_processed_total', 'counter', 'Records processed in each phase.',
+               [([('phase', name)], phase['processed']) for name, phase in phases])
+        metric('records_expected', 'gauge', 'Records expected in each phase, if known.',
+               [([('phase', name)], phase['total']) for name, phase in phases])
+        metric('records_per_second', 'gauge', 'Processing rate of each phase.',
+               [([('phase', name)], phase['records_per_second']) for name, phase in phases])
+        metric('eta_seconds', 'gauge', 'Estimated seconds until the phase completes.',
+               [([('phase', name)], phase['eta_seconds']) for name, phase in phases])
+        metric('db_queries_total', 'counter', 'Statements run on the main MySQL connection.',
+               [([], status['db_queries'])])
+        metric('resident_memory_bytes', 'gauge', 'Resident memory of the command.', [([], status['rss_bytes'])])
+        metric('done', 'gauge', '1 once the command has finished.', [([], int(status['done']))])
+        metric('last_update_timestamp_seconds', 'gauge', 'Time of the last update.', [([], status['updated'])])
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """ Rewrites the status and metrics files """
+        if not self.enabled:
+            return
+        self.last_write = time.time()
+        status = self.get_status()
+        if self.status_filename:
+            write_atomically(self.status_filename, json.dumps(status, indent=2) + '\n')
+        if self.metrics_filename:
+            write_atomically(self.metrics_filename, self.format_metrics(status))
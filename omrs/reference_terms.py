@@ -0,0 +1,243 @@
+"""
+Bulk export and sync of reference terms and the maps between them.
+
+Terms are exported per reference source, in code order, as JSON lines:
+
+    {"type": "Reference Term", "source": "ICD-10-WHO", "code": "A00.0", "name": ..., ...}
+    {"type": "Reference Term Map", "from_source": "SNOMED CT", "from_code": ..., "to_source": ...,
+     "to_code": ..., "map_type": "SAME-AS", ...}
+
+Both tables are streamed (see omrs.streaming), so a full SNOMED CT or ICD-10 term set is
+never held in memory as model instances.
+
+TermSync diffs the terms of a file against the target dictionary with one scan of the
+(concept_source_id, code) pairs of each source, instead of a query per term, and inserts the
+missing terms and term maps with multi-row INSERTs, one transaction per batch. Existing terms
+are left as they are. Term maps are matched by their two terms and map type.
+"""
+import datetime
+import uuid
+
+from django.db import transaction
+from django.db.models import Max
+
+from omrs.management.commands import chunks
+from omrs.models import ConceptMapType, ConceptReferenceSource, ConceptReferenceTerm, ConceptReferenceTermMap
+from omrs.streaming import stream_rows, stream_values
+
+
+TERM_TYPE = 'Reference Term'
+TERM_MAP_TYPE = 'Reference Term Map'
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_CREATOR = 1
+
+TERM_FIELDS = ('code', 'name', 'version', 'description', 'retired', 'uuid', 'creator', 'date_created')
+
+
+def format_datetime(value):
+    return value.isoformat() if value is not None else None
+
+
+## EXPORT
+
+def get_sources(source_names=None):
+    """ Returns the reference sources to export or sync, by name, optionally limited to source_names """
+    sources = ConceptReferenceSource.objects.all().order_by('name')
+    if source_names:
+        sources = sources.filter(name__in=source_names)
+    return list(sources)
+
+
+def iter_term_records(source):
+    """ Yields the terms of a reference source, in code order, as export records """
+    terms = ConceptReferenceTerm.objects.filter(concept_source_id=source.concept_source_id).order_by('code')
+    for code, name, version, description, retired, term_uuid, creator, date_created in stream_values(
+            terms, *TERM_FIELDS):
+        yield {
+            'type': TERM_TYPE,
+            'source': source.name,
+            'code': code,
+            'name': name,
+            'version': version,
+            'description': description,
+            'retired': bool(retired),
+            'external_id': term_uuid,
+            'date_created': format_datetime(date_created),
+            'extras': {'creator': creator},
+        }
+
+
+def iter_term_map_records(source, map_type_names):
+    """ Yields the maps from the terms of a reference source, in code order, as export records """
+    sql = ('SELECT a.code, b.code, sb.name, m.a_is_to_b_id, m.uuid, m.creator, m.date_created '
+           'FROM `{map}` m '
+           'JOIN `{term}` a ON a.concept_reference_term_id = m.term_a_id '
+           'JOIN `{term}` b ON b.concept_reference_term_id = m.term_b_id '
+           'JOIN `{source}` sb ON sb.concept_source_id = b.concept_source_id '
+           'WHERE a.concept_source_id = %s ORDER BY a.code, sb.name, b.code').format(
+        map=ConceptReferenceTermMap._meta.db_table, term=ConceptReferenceTerm._meta.db_table,
+        source=ConceptReferenceSource._meta.db_table)
+    for from_code, to_code, to_source, map_type_id, map_uuid, creator, date_created in stream_rows(
+            sql, [source.concept_source_id], using=ConceptReferenceTermMap.objects.db):
+        yield {
+            'type': TERM_MAP_TYPE,
+            'from_source': source.name,
+            'from_code': from_code,
+            'to_source': to_source,
+            'to_code': to_code,
+            'map_type': map_type_names.get(map_type_id),
+            'external_id': map_uuid,
+            'date_created': format_datetime(date_created),
+            'extras': {'creator': creator},
+        }
+
+
+def get_map_type_names():
+    """ Returns a dictionary of concept map type ID to name """
+    return dict(ConceptMapType.objects.values_list('concept_map_type_id', 'name'))
+
+
+## SYNC
+
+class TermSync(object):
+    """ Inserts the reference terms and term maps of an export that are missing from the dictionary """
+
+    def __init__(self, retrier, batch_size=DEFAULT_BATCH_SIZE, creator=DEFAULT_CREATOR, progress=None):
+        self.retrier = retrier
+        self.batch_size = batch_size
+        self.creator = creator
+        self.progress = progress
+        self.sources = dict((source.name, source) for source in ConceptReferenceSource.objects.all())
+        self.map_type_ids = dict((name, map_type_id) for map_type_id, name in get_map_type_names().iteritems())
+        # source ID -> {code: term ID}, filled by one scan per source
+        self.term_ids = {}
+        self.next_ids = {}
+        self.cnt_terms_existing = 0
+        self.cnt_terms_created = 0
+        self.cnt_term_maps_existing = 0
+        self.cnt_term_maps_created = 0
+        # reason -> number of records that were not synced
+        self.skipped = {}
+
+    def skip(self, reason, count=1):
+        self.skipped[reason] = self.skipped.get(reason, 0) + count
+
+    def advance(self, count=1):
+        if self.progress is not None:
+            self.progress.advance(count)
+
+    def allocate_ids(self, model, count):
+        """ Returns count new primary keys for model, continuing from the largest in the table """
+        pk = model._meta.pk.attname
+        if model not in self.next_ids:
+            self.next_ids[model] = (model.objects.aggregate(Max(pk))[pk + '__max'] or 0) + 1
+        first = self.next_ids[model]
+        self.next_ids[model] += count
+        return range(first, first + count)
+
+    def free_uuids(self, model, records):
+        """ Returns the external IDs of records that are not yet used by another row of model """
+        wanted = set(record['external_id'] for record in records if record.get('external_id'))
+        taken = set()
+        for chunk in chunks(sorted(wanted)):
+            taken.update(model.objects.filter(uuid__in=chunk).values_list('uuid', flat=True))
+        return wanted - taken
+
+    def insert_batch(self, model, rows):
+        """ Inserts rows with one multi-row INSERT, replayed after a transient database error """
+        def attempt():
+            with transaction.atomic(using=model.objects.db):
+                model.objects.bulk_create(rows)
+        self.retrier.run(attempt)
+
+    def load_term_ids(self, source):
+        """ Returns {code: term ID} for the terms of a source, scanning its terms once """
+        if source.concept_source_id not in self.term_ids:
+            self.term_ids[source.concept_source_id] = dict(stream_values(
+                ConceptReferenceTerm.objects.filter(concept_source_id=source.concept_source_id),
+                'code', 'concept_reference_term_id'))
+        return self.term_ids[source.concept_source_id]
+
+    def sync_terms(self, source_name, records):
+        """ Inserts the terms of records, a dictionary of code to term record, missing from a source """
+        source = self.sources.get(source_name)
+        if source is None:
+            self.skip('reference source not found in database', len(records))
+            self.advance(len(records))
+            return
+        term_ids = self.load_term_ids(source)
+        missing = [records[code] for code in sorted(records) if code not in term_ids]
+        self.cnt_terms_existing += len(records) - len(missing)
+        self.advance(len(records) - len(missing))
+
+        now = datetime.datetime.now()
+        for batch in chunks(missing, self.batch_size):
+            free_uuids = self.free_uuids(ConceptReferenceTerm, batch)
+            rows = []
+            for term_id, record in zip(self.allocate_ids(ConceptReferenceTerm, len(batch)), batch):
+                rows.append(ConceptReferenceTerm(
+                    concept_reference_term_id=term_id, concept_source_id=source.concept_source_id,
+                    code=record['code'], name=record.get('name') or '', version=record.get('version') or '',
+                    description=record.get('description') or '',
+                    creator=(record.get('extras') or {}).get('creator') or self.creator, date_created=now,
+                    retired=int(bool(record.get('retired'))),
+                    uuid=record['external_id'] if record.get('external_id') in free_uuids else str(uuid.uuid4())))
+            self.insert_batch(ConceptReferenceTerm, rows)
+            for row in rows:
+                term_ids[row.code] = row.concept_reference_term_id
+            self.cnt_terms_created += len(rows)
+            self.advance(len(rows))
+
+    def load_term_map_keys(self, source):
+        """ Returns the (term A ID, term B ID, map type ID) of the maps from the terms of a source """
+        sql = ('SELECT m.term_a_id, m.term_b_id, m.a_is_to_b_id FROM `{map}` m '
+               'JOIN `{term}` a ON a.concept_reference_term_id = m.term_a_id '
+               'WHERE a.concept_source_id = %s').format(
+            map=ConceptReferenceTermMap._meta.db_table, term=ConceptReferenceTerm._meta.db_table)
+        return set(stream_rows(sql, [source.concept_source_id], using=ConceptReferenceTermMap.objects.db))
+
+    def resolve_term(self, source_name, code):
+        source = self.sources.get(source_name)
+        if source is None:
+            return None
+        return self.load_term_ids(source).get(code)
+
+    def sync_term_maps(self, source_name, records):
+        """ Inserts the maps in records, all from terms of one source, that are missing """
+        source = self.sources.get(source_name)
+        if source is None:
+            self.skip('reference source not found in database', len(records))
+            self.advance(len(records))
+            return
+        existing = self.load_term_map_keys(source)
+        missing = []
+        for record in records:
+            key = (self.resolve_term(source_name, record['from_code']),
+                   self.resolve_term(record['to_source'], record['to_code']),
+                   self.map_type_ids.get(record['map_type']))
+            if key[0] is None or key[1] is None:
+                self.skip('term map references a term not found in database')
+            elif key[2] is None:
+                self.skip('term map type not found in database')
+            elif key in existing:
+                self.cnt_term_maps_existing += 1
+            else:
+                # Duplicates within the file are inserted once
+                existing.add(key)
+                missing.append((key, record))
+                continue
+            self.advance()
+
+        now = datetime.datetime.now()
+        for batch in chunks(missing, self.batch_size):
+            free_uuids = self.free_uuids(ConceptReferenceTermMap, [record for key, record in batch])
+            rows = []
+            for map_id, (key, record) in zip(self.allocate_ids(ConceptReferenceTermMap, len(batch)), batch):
+                rows.append(ConceptReferenceTermMap(
+                    concept_reference_term_map_id=map_id, term_a_id=key[0], term_b_id=key[1], a_is_to_b_id=key[2],
+                    creator=(record.get('extras') or {}).get('creator') or self.creator, date_created=now,
+                    uuid=record['external_id'] if record.get('external_id') in free_uuids else str(uuid.uuid4())))
+            self.insert_batch(ConceptReferenceTermMap, rows)
+            self.cnt_term_maps_created += len(rows)
+            self.advance(len(rows))
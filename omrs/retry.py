@@ -0,0 +1,97 @@
+"""
+Recovery from transient MySQL errors in long-running commands.
+
+A lost connection ("MySQL server has gone away", "Lost connection to MySQL server"), a lock
+wait timeout or a deadlock aborts the current statement or transaction, but the work can be
+repeated on a new connection. Retrier.run() calls a function again after such an error,
+closing the connection first so that Django reconnects on next use, and waiting a little
+longer after each attempt. The function must be safe to repeat: run one transaction per call
+and restore any in-memory state it changes.
+
+Retries are counted by MySQL error code for the command summaries.
+"""
+import sys
+import time
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.utils import DatabaseError
+
+
+# MySQL error codes that are worth retrying on a new connection
+TRANSIENT_ERRORS = {
+    1205: 'lock wait timeout',
+    1213: 'deadlock',
+    2006: 'server has gone away',
+    2013: 'lost connection',
+}
+
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_RETRY_DELAY = 1.0
+
+
+def transient_error_code(exc):
+    """ Returns the MySQL error code of exc if it is a transient error, None otherwise """
+    database_errors = (DatabaseError,)
+    try:
+        import MySQLdb
+        database_errors += (MySQLdb.DatabaseError,)
+    except ImportError:
+        pass
+    if isinstance(exc, database_errors) and exc.args and exc.args[0] in TRANSIENT_ERRORS:
+        return exc.args[0]
+    return None
+
+
+class Retrier(object):
+    """ Repeats units of database work after transient errors, with exponential backoff """
+
+    def __init__(self, max_retries=DEFAULT_MAX_RETRIES, delay=DEFAULT_RETRY_DELAY, using=DEFAULT_DB_ALIAS,
+                 verbosity=1):
+        self.max_retries = max_retries
+        self.delay = delay
+        self.using = using
+        self.verbosity = verbosity
+        self.attempts = 0
+        # MySQL error code -> number of retries
+        self.counts = {}
+
+    def run(self, function, *args):
+        """ Returns function(*args), calling it again after each transient error """
+        self.attempts = 0
+        while True:
+            try:
+                result = function(*args)
+            except Exception as e:
+                self.recover(e)
+            else:
+                self.attempts = 0
+                return result
+
+    def recover(self, exc):
+        """
+        Prepares to repeat the work that raised exc: re-raises exc unless it is transient and
+        retries are left, otherwise drops the connection and waits before the next attempt.
+        """
+        code = transient_error_code(exc)
+        if code is None or self.attempts >= self.max_retries:
+            raise
+        self.attempts += 1
+        self.counts[code] = self.counts.get(code, 0) + 1
+        if self.verbosity >= 1:
+            # stderr, as extract_db writes its export to stdout
+            sys.stderr.write('Transient database error (%s), retry %d of %d: %s\n' % (
+                TRANSIENT_ERRORS[code], self.attempts, self.max_retries, exc))
+        connections[self.using].close()
+        time.sleep(self.delay * 2 ** (self.attempts - 1))
+
+    def merge(self, counts):
+        """ Adds the retry counts of another Retrier, e.g. one that ran in a worker process """
+        for code, count in counts.iteritems():
+            self.counts[int(code)] = self.counts.get(int(code), 0) + count
+
+    def summary(self):
+        """ Returns a one-line description of the retries, or None if there were none """
+        if not self.counts:
+            return None
+        return '%d (%s)' % (sum(self.counts.itervalues()), ', '.join(
+            '%s: %d' % (TRANSIENT_ERRORS[code], count) for code, count in sorted(self.counts.iteritems())))
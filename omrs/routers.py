@@ -0,0 +1,33 @@
+"""
+Database routers for the omrs project.
+
+SnapshotRouter sends reads of the OpenMRS dictionary models to the local snapshot database
+created by the snapshot_db command. It is inactive until a command enables it, e.g. with the
+--snapshot option of extract_db or validate_export.
+"""
+
+SNAPSHOT_DB_ALIAS = 'snapshot'
+
+
+class SnapshotRouter(object):
+    """ Routes reads of omrs models to the local snapshot database when enabled """
+
+    enabled = False
+
+    @classmethod
+    def enable(cls):
+        cls.enabled = True
+
+    def db_for_read(self, model, **hints):
+        if self.enabled and model._meta.app_label == 'omrs':
+            return SNAPSHOT_DB_ALIAS
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_syncdb(self, db, model):
+        # The snapshot tables are created by snapshot_db, never by syncdb
+        if db == SNAPSHOT_DB_ALIAS:
+            return False
+        return None
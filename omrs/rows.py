@@ -0,0 +1,204 @@
+"""
+Lightweight row records for the concept dictionary tables.
+
+Bulk readers that need only a few columns per row use these namedtuples instead of Django model
+instances. Rows are read with values_list() and each becomes a tuple with named fields, which
+avoids the per-row cost of model construction, field descriptors and an instance __dict__.
+Attribute names match the model fields they are read from, with related fields flattened (e.g.
+ConceptReferenceMapRow.source_name for concept_reference_term__concept_source__name).
+
+ConceptRecord bundles a concept row with the rows of its related tables and is what
+extract_db serializes.
+"""
+from collections import namedtuple
+
+from django.db import models
+from django.db.models.fields import FieldDoesNotExist
+
+from omrs.models import (Concept, ConceptAnswer, ConceptDescription, ConceptName, ConceptNumeric,
+                         ConceptReferenceMap, ConceptSet)
+from omrs.streaming import stream_values
+
+
+def field_for_path(model, path):
+    """ Returns the model field at the end of a field path, or None for a foreign key's attname """
+    names = path.split('__')
+    for name in names[:-1]:
+        model = model._meta.get_field(name).rel.to
+    try:
+        return model._meta.get_field(names[-1])
+    except FieldDoesNotExist:
+        return None
+
+
+def row_type(name, model, columns):
+    """
+    Returns a namedtuple class for rows of model.
+
+    :param columns: List of (attribute, field path) pairs, e.g. ('map_type_name', 'map_type__name').
+    """
+    record = namedtuple(name, [attribute for attribute, path in columns])
+    record.model = model
+    record.field_paths = tuple(path for attribute, path in columns)
+    # Raw cursors return booleans as integers on MySQL; these columns are converted in iter_rows()
+    record.boolean_columns = tuple(
+        position for position, (attribute, path) in enumerate(columns)
+        if isinstance(field_for_path(model, path), models.BooleanField))
+    return record
+
+
+ConceptRow = row_type('ConceptRow', Concept, [
+    ('concept_id', 'concept_id'),
+    ('uuid', 'uuid'),
+    ('retired', 'retired'),
+    ('is_set', 'is_set'),
+    ('creator', 'creator'),
+    ('date_created', 'date_created'),
+    ('concept_class_name', 'concept_class__name'),
+    ('datatype_name', 'datatype__name'),
+])
+
+ConceptNameRow = row_type('ConceptNameRow', ConceptName, [
+    ('concept_name_id', 'concept_name_id'),
+    ('concept_id', 'concept_id'),
+    ('name', 'name'),
+    ('concept_name_type', 'concept_name_type'),
+    ('locale', 'locale'),
+    ('locale_preferred', 'locale_preferred'),
+    ('uuid', 'uuid'),
+    ('creator', 'creator'),
+    ('date_created', 'date_created'),
+    ('voided', 'voided'),
+])
+
+ConceptDescriptionRow = row_type('ConceptDescriptionRow', ConceptDescription, [
+    ('concept_description_id', 'concept_description_id'),
+    ('concept_id', 'concept_id'),
+    ('description', 'description'),
+    ('locale', 'locale'),
+    ('uuid', 'uuid'),
+])
+
+ConceptNumericRow = row_type('ConceptNumericRow', ConceptNumeric, [
+    ('concept_id', 'concept_id'),
+    ('hi_absolute', 'hi_absolute'),
+    ('hi_critical', 'hi_critical'),
+    ('hi_normal', 'hi_normal'),
+    ('low_absolute', 'low_absolute'),
+    ('low_critical', 'low_critical'),
+    ('low_normal', 'low_normal'),
+    ('units', 'units'),
+    ('precise', 'precise'),
+    ('display_precision', 'display_precision'),
+])
+
+ConceptReferenceMapRow = row_type('ConceptReferenceMapRow', ConceptReferenceMap, [
+    ('concept_map_id', 'concept_map_id'),
+    ('concept_id', 'concept_id'),
+    ('uuid', 'uuid'),
+    ('creator', 'creator'),
+    ('date_created', 'date_created'),
+    ('map_type_name', 'map_type__name'),
+    ('term_id', 'concept_reference_term_id'),
+    ('term_code', 'concept_reference_term__code'),
+    ('term_name', 'concept_reference_term__name'),
+    ('term_uuid', 'concept_reference_term__uuid'),
+    ('source_name', 'concept_reference_term__concept_source__name'),
+])
+
+ConceptAnswerRow = row_type('ConceptAnswerRow', ConceptAnswer, [
+    ('concept_answer_id', 'concept_answer_id'),
+    ('question_concept_id', 'question_concept_id'),
+    ('answer_concept_id', 'answer_concept_id'),
+    ('uuid', 'uuid'),
+    ('creator', 'creator'),
+    ('date_created', 'date_created'),
+])
+
+ConceptSetRow = row_type('ConceptSetRow', ConceptSet, [
+    ('concept_set_id', 'concept_set_id'),
+    ('concept_set_owner_id', 'concept_set_owner_id'),
+    ('concept_id', 'concept_id'),
+    ('uuid', 'uuid'),
+    ('creator', 'creator'),
+    ('date_created', 'date_created'),
+])
+
+
+def iter_rows(row_class, queryset=None):
+    """ Streams a row_class record for each row of queryset, by default all rows of the model """
+    if queryset is None:
+        queryset = row_class.model.objects.all()
+    for values in stream_values(queryset, *row_class.field_paths):
+        if row_class.boolean_columns:
+            values = list(values)
+            for position in row_class.boolean_columns:
+                if values[position] is not None:
+                    values[position] = bool(values[position])
+        yield row_class._make(values)
+
+
+def query_rows(row_class, queryset):
+    """ Returns a list of row_class records for the rows of a (small) queryset, in primary key order """
+    pk_name = row_class.model._meta.pk.name
+    return [row_class._make(values)
+            for values in queryset.order_by(pk_name).values_list(*row_class.field_paths)]
+
+
+class ConceptRecord(object):
+    """ A concept's columns together with the rows of its names, descriptions and mappings """
+
+    __slots__ = ConceptRow._fields + ('names', 'descriptions', 'numerics', 'reference_maps', 'answers',
+                                      'set_members')
+
+    def __init__(self, concept_row, **related):
+        for attribute, value in zip(ConceptRow._fields, concept_row):
+            setattr(self, attribute, value)
+        for attribute, value in related.iteritems():
+            setattr(self, attribute, value)
+
+    # Records are pickled when extract_db serializes them in worker processes
+    def __getstate__(self):
+        return tuple(getattr(self, attribute) for attribute in self.__slots__)
+
+    def __setstate__(self, state):
+        for attribute, value in zip(self.__slots__, state):
+            setattr(self, attribute, value)
+
+
+# Related rows loaded into each ConceptRecord: (attribute, row class, attribute holding the concept ID)
+CONCEPT_RELATIONS = (
+    ('names', ConceptNameRow, 'concept_id'),
+    ('descriptions', ConceptDescriptionRow, 'concept_id'),
+    ('numerics', ConceptNumericRow, 'concept_id'),
+    ('reference_maps', ConceptReferenceMapRow, 'concept_id'),
+    ('answers', ConceptAnswerRow, 'question_concept_id'),
+    ('set_members', ConceptSetRow, 'concept_set_owner_id'),
+)
+
+
+def load_concept_records(concept_ids, export_filter=None):
+    """
+    Returns a dictionary of concept_id to ConceptRecord for the concepts in concept_ids that
+    exist, using one query on concept and one per related table. Pass at most one chunk of IDs.
+    :param export_filter: ExportFilter restricting the concepts and related rows loaded, if set.
+    """
+    related = {}
+    for attribute, row_class, concept_attribute in CONCEPT_RELATIONS:
+        rows_by_concept = related[attribute] = {}
+        lookups = export_filter.relation_lookups(attribute) if export_filter else {}
+        if lookups is None:
+            continue
+        queryset = row_class.model.objects.filter(**{concept_attribute + '__in': concept_ids}).filter(**lookups)
+        for row in query_rows(row_class, queryset):
+            rows_by_concept.setdefault(getattr(row, concept_attribute), []).append(row)
+
+    concepts = Concept.objects.filter(concept_id__in=concept_ids)
+    if export_filter:
+        concepts = export_filter.filter_concepts(concepts)
+    records = {}
+    for concept_row in query_rows(ConceptRow, concepts):
+        concept_id = concept_row.concept_id
+        records[concept_id] = ConceptRecord(concept_row, **dict(
+            (attribute, rows_by_concept.get(concept_id, [])) for attribute, rows_by_concept in related.iteritems()))
+    return records
@@ -49,12 +49,32 @@ DATABASES = {
         'PASSWORD': 'admin',
         'HOST': '192.168.33.10',
         'PORT': '3306',
-    }
+    },
+    # Local copy of the concept dictionary tables, created with the snapshot_db command
+    'snapshot': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('OMRS_SNAPSHOT_DB', os.path.join(BASE_DIR, 'omrs_snapshot.sqlite3')),
+    },
 }
 
+DATABASE_ROUTERS = ['omrs.routers.SnapshotRouter']
+
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
 USE_I18N = True
 USE_L10N = True
 USE_TZ = False
 STATIC_URL = '/static/'
+
+# Read-only concept lookup API (omrs.views): org and source used in exported URLs, and the
+# size and lifetime in seconds of each worker's in-process cache of serialized concepts
+OMRS_API_ORG_ID = os.environ.get('OMRS_API_ORG_ID', 'CIEL')
+OMRS_API_SOURCE_ID = os.environ.get('OMRS_API_SOURCE_ID', 'CIEL')
+OMRS_API_CACHE_SIZE = int(os.environ.get('OMRS_API_CACHE_SIZE', 10000))
+OMRS_API_CACHE_TTL = int(os.environ.get('OMRS_API_CACHE_TTL', 300))
+
+# OCL source version exports read as ocl://OWNER/SOURCE/VERSION inputs (see omrs.ocl_download)
+# are downloaded from this API with this token, into a local cache directory
+OCL_API_URL = os.environ.get('OCL_API_URL', 'http://api.openconceptlab.com/')
+OCL_API_TOKEN = os.environ.get('OCL_API_TOKEN')
+OCL_EXPORT_CACHE = os.environ.get('OCL_EXPORT_CACHE', os.path.join(BASE_DIR, 'ocl_export_cache'))
@@ -0,0 +1,18 @@
+"""
+Minimal settings profile for the omrs management commands.
+
+Only the omrs app is installed and translations are disabled, so command-line invocations
+skip loading the admin, auth, sessions, messages and staticfiles apps. manage.py selects
+this profile for the commands in omrs/management/commands unless --settings or
+DJANGO_SETTINGS_MODULE says otherwise.
+"""
+from omrs.settings import *
+
+INSTALLED_APPS = (
+    'omrs',
+)
+
+MIDDLEWARE_CLASSES = ()
+
+USE_I18N = False
+USE_L10N = False
@@ -0,0 +1,23 @@
+"""
+Settings profile for the tests in omrs/tests.
+
+Both databases are temporary SQLite files, so the tests run without a MySQL server. Tests that
+need the concept dictionary tables create them with omrs.snapshot.create_table_sql().
+"""
+import os
+import tempfile
+
+from omrs.settings_cli import *
+
+TEST_DB_DIR = tempfile.mkdtemp(prefix='omrs-tests-')
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(TEST_DB_DIR, 'default.sqlite3'),
+    },
+    'snapshot': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(TEST_DB_DIR, 'snapshot.sqlite3'),
+    },
+}
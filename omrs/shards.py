@@ -0,0 +1,88 @@
+"""
+Sharded JSON-lines output with a manifest.
+
+ShardWriter writes groups of records (a concept and its mappings) to numbered shard files in a
+directory, starting a new shard before a group that would take the current one past the record
+or byte limit, so a group is never split across shards. close() writes manifest.json listing
+each shard's record count, size, SHA-256 checksum and concept ID range, so shards can be
+imported in parallel and a failed shard can be verified and retried on its own.
+"""
+import hashlib
+import json
+import os
+
+
+MANIFEST_FILENAME = 'manifest.json'
+
+
+class ShardWriter(object):
+    """ Writes groups of JSON lines to size-limited shard files """
+
+    def __init__(self, directory, prefix, max_records=None, max_bytes=None, metadata=None):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.metadata = metadata or {}
+        self.shards = []
+        self.fp = None
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def is_full(self, record_count, byte_count):
+        """ Returns True if a group of this size does not fit in the current, non-empty shard """
+        shard = self.shards[-1]
+        if self.max_records and shard['records'] + record_count > self.max_records:
+            return True
+        if self.max_bytes and shard['bytes'] + byte_count > self.max_bytes:
+            return True
+        return False
+
+    def write_group(self, lines, concept_id):
+        """ Writes the JSON lines of one concept to the current shard, starting a new one if needed """
+        if not lines:
+            return
+        data = ''.join('%s\n' % line for line in lines)
+        if self.fp is not None and self.is_full(len(lines), len(data)):
+            self.close_shard()
+        if self.fp is None:
+            self.open_shard(concept_id)
+        shard = self.shards[-1]
+        self.fp.write(data)
+        self.checksum.update(data)
+        shard['records'] += len(lines)
+        shard['concepts'] += 1
+        shard['bytes'] += len(data)
+        shard['last_concept_id'] = concept_id
+
+    def open_shard(self, concept_id):
+        filename = '%s-%05d.json' % (self.prefix, len(self.shards) + 1)
+        self.fp = open(os.path.join(self.directory, filename), 'wb')
+        self.checksum = hashlib.sha256()
+        self.shards.append({
+            'filename': filename,
+            'records': 0,
+            'concepts': 0,
+            'bytes': 0,
+            'first_concept_id': concept_id,
+            'last_concept_id': concept_id,
+        })
+
+    def close_shard(self):
+        self.fp.close()
+        self.fp = None
+        self.shards[-1]['sha256'] = self.checksum.hexdigest()
+
+    def close(self):
+        """ Closes the last shard and writes the manifest; returns the manifest """
+        if self.fp is not None:
+            self.close_shard()
+        manifest = dict(self.metadata)
+        manifest['shards'] = self.shards
+        manifest['total_records'] = sum(shard['records'] for shard in self.shards)
+        # Write to a temporary file first so that a manifest is never left half-written
+        manifest_filename = os.path.join(self.directory, MANIFEST_FILENAME)
+        with open(manifest_filename + '.tmp', 'w') as fp:
+            json.dump(manifest, fp, indent=4)
+        os.rename(manifest_filename + '.tmp', manifest_filename)
+        return manifest
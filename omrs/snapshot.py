@@ -0,0 +1,113 @@
+"""
+Local snapshot of the OpenMRS concept dictionary.
+
+create_snapshot() copies the concept-related tables from the default (MySQL) database into
+the file-backed 'snapshot' database defined in settings, one bulk read and one executemany
+per table. Read-only commands can then run against the snapshot with their --snapshot option.
+"""
+import os
+
+from django.conf import settings
+from django.core.management import CommandError
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+from omrs.models import (Concept, ConceptAnswer, ConceptClass, ConceptComplex, ConceptDatatype,
+                         ConceptDescription, ConceptMapType, ConceptName, ConceptNumeric,
+                         ConceptReferenceMap, ConceptReferenceSource, ConceptReferenceTerm,
+                         ConceptReferenceTermMap, ConceptSet, ConceptStopWord)
+from omrs.management.commands import chunks
+from omrs.routers import SNAPSHOT_DB_ALIAS, SnapshotRouter
+from omrs.streaming import stream_rows
+
+
+# Models copied into the snapshot. Models whose table has no primary key column mapped in
+# models.py (e.g. ConceptWord, ConceptNameTagMap) cannot be represented and are skipped.
+SNAPSHOT_MODELS = [
+    ConceptClass,
+    ConceptDatatype,
+    ConceptMapType,
+    ConceptReferenceSource,
+    Concept,
+    ConceptName,
+    ConceptDescription,
+    ConceptNumeric,
+    ConceptComplex,
+    ConceptReferenceTerm,
+    ConceptReferenceTermMap,
+    ConceptReferenceMap,
+    ConceptAnswer,
+    ConceptSet,
+    ConceptStopWord,
+]
+
+
+def snapshot_filename():
+    """ Returns the filename of the snapshot database """
+    return settings.DATABASES[SNAPSHOT_DB_ALIAS]['NAME']
+
+
+def enable_snapshot():
+    """ Routes all reads of the omrs models to the snapshot database """
+    if not os.path.exists(snapshot_filename()):
+        raise CommandError('Snapshot database %s not found, create it with snapshot_db' % snapshot_filename())
+    SnapshotRouter.enable()
+
+
+def create_table_sql(model, connection):
+    """ Returns CREATE TABLE and CREATE INDEX statements for model on the given connection """
+    qn = connection.ops.quote_name
+    table = model._meta.db_table
+    columns = []
+    indexes = []
+    for field in model._meta.local_fields:
+        definition = '%s %s' % (qn(field.column), field.db_type(connection=connection))
+        if field.primary_key:
+            definition += ' PRIMARY KEY'
+        elif field.db_index or field.unique:
+            indexes.append('CREATE INDEX %s ON %s (%s)' % (
+                qn('%s_%s' % (table, field.column)), qn(table), qn(field.column)))
+        columns.append(definition)
+    return ['CREATE TABLE %s (%s)' % (qn(table), ', '.join(columns))] + indexes
+
+
+def copy_table(model, batch_size=5000):
+    """
+    Copies all rows of model's table from the default database into the snapshot database.
+
+    :returns: Number of rows copied.
+    """
+    source = connections[DEFAULT_DB_ALIAS]
+    target = connections[SNAPSHOT_DB_ALIAS]
+    table = model._meta.db_table
+    columns = [field.column for field in model._meta.local_fields]
+
+    target_cursor = target.cursor()
+    target_cursor.execute('DROP TABLE IF EXISTS %s' % target.ops.quote_name(table))
+    for sql in create_table_sql(model, target):
+        target_cursor.execute(sql)
+
+    select_sql = 'SELECT %s FROM %s' % (
+        ', '.join(source.ops.quote_name(column) for column in columns), source.ops.quote_name(table))
+    insert_sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        target.ops.quote_name(table), ', '.join(target.ops.quote_name(column) for column in columns),
+        ', '.join(['%s'] * len(columns)))
+    count = 0
+    for rows in chunks(stream_rows(select_sql, using=DEFAULT_DB_ALIAS, fetch_size=batch_size), batch_size):
+        target_cursor.executemany(insert_sql, rows)
+        count += len(rows)
+    return count
+
+
+def create_snapshot(batch_size=5000, verbosity=1):
+    """
+    Copies all SNAPSHOT_MODELS tables into the snapshot database in a single transaction.
+
+    :returns: List of (table name, row count) tuples.
+    """
+    counts = []
+    with transaction.atomic(using=SNAPSHOT_DB_ALIAS):
+        for model in SNAPSHOT_MODELS:
+            if verbosity >= 2:
+                print 'Copying %s...' % model._meta.db_table
+            counts.append((model._meta.db_table, copy_table(model, batch_size=batch_size)))
+    return counts
@@ -0,0 +1,50 @@
+"""
+Unbuffered reads of large result sets.
+
+MySQLdb's default cursor fetches the whole result set into client memory before the first row
+is returned. stream_rows() runs a query with a server-side cursor (SSCursor) instead, so rows
+are produced as they arrive from the server and memory stays flat.
+
+An unbuffered result must be read to the end before its connection can run another query, so
+each stream opens a connection of its own. Callers can keep running queries on the regular
+Django connection while a stream is open, e.g. to prefetch the related rows of each chunk of
+streamed IDs. Other backends, such as the SQLite snapshot, already fetch rows lazily and are
+read with a regular cursor.
+"""
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+STREAM_FETCH_SIZE = 2000
+
+
+def stream_rows(sql, params=(), using=DEFAULT_DB_ALIAS, fetch_size=STREAM_FETCH_SIZE):
+    """ Yields the rows of a query as tuples without buffering the result set in client memory """
+    connection = connections[using]
+    stream_connection = None
+    if connection.vendor == 'mysql':
+        from MySQLdb.cursors import SSCursor
+        stream_connection = connection.get_new_connection(connection.get_connection_params())
+        cursor = stream_connection.cursor(SSCursor)
+    else:
+        cursor = connection.cursor()
+    try:
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        cursor.close()
+        if stream_connection is not None:
+            stream_connection.close()
+
+
+def stream_values(queryset, *fields):
+    """
+    Yields a tuple of fields for each row of queryset, like values_list(*fields).iterator(),
+    reading from the database that the queryset is routed to.
+    """
+    sql, params = queryset.values_list(*fields).query.sql_with_params()
+    return stream_rows(sql, params, using=queryset.db)
@@ -0,0 +1,12 @@
+"""
+Tests for the omrs commands and modules.
+
+The tests use the standard library unittest and need neither MySQL nor network access: HTTP
+clients run against stub servers on localhost, and database code against temporary SQLite
+databases (see omrs/settings_test.py). Run them from the repository root with:
+
+    python -m unittest discover -s omrs/tests -t .
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'omrs.settings_test')
@@ -0,0 +1,38 @@
+"""
+Concept dictionary tables for database tests.
+
+create_dictionary_tables() creates the tables copied by snapshot_db in a test database, and
+insert() adds a row with only the columns a test needs.
+"""
+import datetime
+import uuid
+
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from omrs.snapshot import SNAPSHOT_MODELS, create_table_sql
+
+
+def create_dictionary_tables(using=DEFAULT_DB_ALIAS):
+    """ (Re)creates empty concept dictionary tables """
+    connection = connections[using]
+    cursor = connection.cursor()
+    for model in SNAPSHOT_MODELS:
+        cursor.execute('DROP TABLE IF EXISTS %s' % connection.ops.quote_name(model._meta.db_table))
+        for sql in create_table_sql(model, connection):
+            cursor.execute(sql)
+
+
+def insert(model, using=DEFAULT_DB_ALIAS, **values):
+    """ Inserts a row of model, filling in its uuid, creator and date_created if it has them """
+    connection = connections[using]
+    columns = dict((field.name, field.column) for field in model._meta.local_fields)
+    columns.update((field.attname, field.column) for field in model._meta.local_fields)
+    defaults = {'uuid': str(uuid.uuid4()), 'creator': 1, 'date_created': datetime.datetime(2019, 1, 1)}
+    for name, value in defaults.iteritems():
+        if name in columns:
+            values.setdefault(name, value)
+    names = sorted(values)
+    connection.cursor().execute('INSERT INTO %s (%s) VALUES (%s)' % (
+        connection.ops.quote_name(model._meta.db_table),
+        ', '.join(connection.ops.quote_name(columns[name]) for name in names),
+        ', '.join(['%s'] * len(names))), [values[name] for name in names])
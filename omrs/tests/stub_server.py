@@ -0,0 +1,65 @@
+"""
+A stub HTTP server on localhost for testing the OCL API clients.
+
+StubServer runs in a daemon thread and passes each request to a handler function, which
+writes the response with send() or by hand, e.g. to drop the connection part way through a body.
+"""
+import BaseHTTPServer
+import json
+from SocketServer import ThreadingMixIn
+import threading
+import urlparse
+
+
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle_stub_request(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length) if length else ''
+        url = urlparse.urlparse(self.path)
+        self.url_path = url.path
+        self.query = dict(urlparse.parse_qsl(url.query))
+        with self.server.stub.lock:
+            self.server.stub.requests.append((self.command, self.path, self.headers.get('Range')))
+        self.server.stub.handler(self)
+
+    do_GET = do_POST = do_PUT = handle_stub_request
+
+
+class ThreadingHTTPServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StubServer(object):
+    """ Serves requests with handler(request) until stopped; requests records (method, path, Range header) """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubRequestHandler)
+        self.server.stub = self
+        self.url = 'http://127.0.0.1:%d/' % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def send(request, status, body='', headers=None):
+    """ Writes a complete response; a dict or list body is sent as JSON """
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+    request.send_response(status)
+    for name, value in (headers or {}).iteritems():
+        request.send_header(name, value)
+    request.send_header('Content-Length', str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
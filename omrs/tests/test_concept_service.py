@@ -0,0 +1,41 @@
+"""
+Smoke tests of the concept lookup API's service against a concept dictionary in a SQLite test database.
+"""
+import json
+import unittest
+
+from omrs.concept_service import CONCEPT_DOCUMENT, MAPPINGS_DOCUMENT, SET_MEMBERS_DOCUMENT, ConceptLookupService
+from omrs.models import Concept, ConceptAnswer, ConceptClass, ConceptDatatype, ConceptName, ConceptSet
+from omrs.tests.dictionary import create_dictionary_tables, insert
+
+
+class ConceptLookupServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        create_dictionary_tables()
+        insert(ConceptClass, concept_class_id=1, name='Question')
+        insert(ConceptDatatype, concept_datatype_id=1, name='Coded')
+        for concept_id in (1, 2, 3):
+            insert(Concept, concept_id=concept_id, concept_class_id=1, datatype_id=1, retired=False, is_set=0)
+            insert(ConceptName, concept_name_id=concept_id, concept_id=concept_id, name='Concept %d' % concept_id,
+                   locale='en', locale_preferred=True, concept_name_type='FULLY_SPECIFIED', voided=False)
+        insert(ConceptAnswer, concept_answer_id=1, question_concept_id=1, answer_concept_id=2)
+        insert(ConceptSet, concept_set_id=1, concept_set_owner_id=3, concept_id=1)
+        self.service = ConceptLookupService('CIEL', 'CIEL', cache_size=10, cache_ttl=60)
+
+    def test_get_many_serializes_cache_misses(self):
+        found = self.service.get_many([1, 3, 99])
+        self.assertEqual(sorted(found), [1, 3])
+        concept = json.loads(found[1][CONCEPT_DOCUMENT][0])
+        self.assertEqual(concept['id'], 1)
+        self.assertEqual([name['name'] for name in concept['names']], ['Concept 1'])
+        mappings = json.loads(found[1][MAPPINGS_DOCUMENT][0])
+        self.assertEqual([mapping['map_type'] for mapping in mappings], ['Q-AND-A'])
+        set_members = json.loads(found[3][SET_MEMBERS_DOCUMENT][0])
+        self.assertEqual(len(set_members), 1)
+
+    def test_get_serves_cached_documents(self):
+        documents = self.service.get(2)
+        self.assertEqual(self.service.get(2), documents)
+        self.assertEqual(self.service.documents.hits, 1)
+        self.assertIsNone(self.service.get(99))
@@ -0,0 +1,28 @@
+"""
+Tests for omrs.id_sets.
+"""
+import unittest
+
+from omrs.id_sets import IdBitmap, RangeIdSet, parse_id
+
+
+class IdSetsTest(unittest.TestCase):
+
+    def test_parse_id_accepts_only_integer_ids(self):
+        self.assertEqual([parse_id(value) for value in (12, '12', u'12', '012', ' 12', '-1', 'X1', None)],
+                         [12, 12, 12, None, None, None, None, None])
+
+    def test_bitmap_keeps_ids_in_order(self):
+        bitmap = IdBitmap([9, 3, 300, 17])
+        bitmap.discard(17)
+        self.assertEqual((list(bitmap), len(bitmap), 3 in bitmap, 17 in bitmap), ([3, 9, 300], 3, True, False))
+        self.assertEqual(bitmap.bounds(), (0, 303))
+
+    def test_range_id_set_keeps_outlying_ids_out_of_the_bitmap(self):
+        ids = RangeIdSet(IdBitmap([100, 200]).bounds(), [150, 7, 10 ** 9, 271649006000000])
+        self.assertLessEqual(len(ids.bitmap.bits), 26)
+        self.assertEqual(list(ids), [7, 150, 10 ** 9, 271649006000000])
+        ids.discard(10 ** 9)
+        ids.discard(150)
+        self.assertEqual((len(ids), 7 in ids, 150 in ids), (2, True, False))
+        self.assertEqual(list(RangeIdSet(None, [5, 1])), [1, 5])
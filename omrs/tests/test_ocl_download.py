@@ -0,0 +1,138 @@
+"""
+Tests for omrs.ocl_download against a stub OCL export endpoint.
+"""
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from omrs.ocl_download import DownloadError, ExportDownloader
+from omrs.tests.stub_server import StubServer, send
+
+
+EXPORT_PATH = '/orgs/CIEL/sources/CIEL/v1/export/'
+
+
+def export_body(seed, size=300000):
+    """ Returns size bytes of incompressible export content, different for each seed """
+    return ''.join(hashlib.sha256('%s-%d' % (seed, block)).digest() for block in xrange(size // 32))
+
+
+class ExportApi(object):
+    """
+    Stub export endpoint serving body with an MD5 ETag, as S3 does. Honours Range requests whose
+    If-Range matches the current ETag, and drops the connection once after drop_at bytes.
+    """
+
+    def __init__(self, body):
+        self.drop_at = None
+        self.set_body(body)
+
+    def set_body(self, body):
+        self.body = body
+        self.etag = '"%s"' % hashlib.md5(body).hexdigest()
+
+    def __call__(self, request):
+        if request.url_path != EXPORT_PATH:
+            send(request, 404, {'detail': 'Not found'})
+            return
+        start = 0
+        byte_range = request.headers.get('Range')
+        if byte_range and request.headers.get('If-Range') == self.etag:
+            start = int(byte_range.split('=')[1].rstrip('-'))
+            request.send_response(206)
+            request.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(self.body) - 1, len(self.body)))
+        else:
+            request.send_response(200)
+        request.send_header('Content-Length', str(len(self.body) - start))
+        request.send_header('ETag', self.etag)
+        request.end_headers()
+        if self.drop_at is not None and start < self.drop_at:
+            request.wfile.write(self.body[start:self.drop_at])
+            request.wfile.flush()
+            self.drop_at = None
+            request.close_connection = True
+            return
+        request.wfile.write(self.body[start:])
+
+
+class ExportDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.api = ExportApi(export_body(1))
+        self.server = StubServer(self.api)
+        self.addCleanup(self.server.stop)
+        self.cache_directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_directory)
+
+    def make_downloader(self, **kwargs):
+        kwargs.setdefault('retry_delay', 0.01)
+        return ExportDownloader(self.server.url, 'secret', self.cache_directory, verbosity=0, **kwargs)
+
+    def ranges(self):
+        return [byte_range for method, path, byte_range in self.server.requests]
+
+    def read_part(self, downloader, size):
+        """ Reads the start of the export and stops, leaving a partial download """
+        stream = downloader.open('CIEL', 'CIEL', 'v1')
+        data = stream.read(size)
+        stream.close()
+        return data
+
+    def test_export_is_downloaded_into_the_cache(self):
+        filename = self.make_downloader().fetch('CIEL', 'CIEL', 'v1')
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), self.api.body)
+        self.assertEqual(self.ranges(), [None])
+        self.assertEqual(os.path.basename(filename), hashlib.sha256(self.api.body).hexdigest())
+
+    def test_dropped_connection_is_resumed_with_a_range_request(self):
+        self.api.drop_at = 100000
+        downloader = self.make_downloader()
+        filename = downloader.fetch('CIEL', 'CIEL', 'v1')
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), self.api.body)
+        self.assertEqual(self.ranges(), [None, 'bytes=100000-'])
+
+    def test_partial_download_is_resumed_by_a_later_download(self):
+        downloader = self.make_downloader()
+        self.read_part(downloader, 1000)
+        filename = downloader.fetch('CIEL', 'CIEL', 'v1')
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), self.api.body)
+        self.assertEqual(len(self.ranges()), 2)
+        self.assertTrue(self.ranges()[1].startswith('bytes='))
+
+    def test_changed_export_is_downloaded_again_from_the_start(self):
+        downloader = self.make_downloader(max_retries=0)
+        self.read_part(downloader, 1000)
+        self.api.set_body(export_body(2))
+        filename = downloader.fetch('CIEL', 'CIEL', 'v1')
+        with open(filename, 'rb') as fp:
+            self.assertEqual(fp.read(), self.api.body)
+        # The range request gets the whole changed export, which is requested once more from the start
+        ranges = self.ranges()
+        self.assertEqual(len(ranges), 3)
+        self.assertTrue(ranges[1].startswith('bytes='))
+        self.assertEqual(ranges[2], None)
+
+    def test_checksum_mismatch_fails_and_discards_the_download(self):
+        downloader = self.make_downloader()
+        with self.assertRaisesRegexp(DownloadError, 'failed verification: SHA-256'):
+            downloader.fetch('CIEL', 'CIEL', 'v1', sha256='00' * 32)
+        self.assertIsNone(downloader.cache.lookup('CIEL', 'CIEL', 'v1'))
+        self.assertFalse(os.path.exists(downloader.cache.partial_filename('CIEL', 'CIEL', 'v1')))
+
+    def test_cached_export_is_not_downloaded_again(self):
+        downloader = self.make_downloader()
+        filename = downloader.fetch('CIEL', 'CIEL', 'v1')
+        del self.server.requests[:]
+        self.assertEqual(self.make_downloader().fetch('CIEL', 'CIEL', 'v1'), filename)
+        with self.make_downloader().open('CIEL', 'CIEL', 'v1') as fp:
+            self.assertEqual(fp.read(), self.api.body)
+        self.assertEqual(self.server.requests, [])
+
+    def test_missing_export_fails(self):
+        with self.assertRaisesRegexp(DownloadError, 'HTTP 404'):
+            self.make_downloader().fetch('CIEL', 'CIEL', 'v2')
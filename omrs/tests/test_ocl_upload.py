@@ -0,0 +1,202 @@
+"""
+Tests for omrs.ocl_upload and upload_ocl against a stub OCL bulk import API.
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from django.core.management import CommandError, call_command
+from django.test.utils import override_settings
+
+from omrs.ocl_upload import FAILURE, SUCCESS, BulkImporter, Chunk, UploadState
+from omrs.tests.stub_server import StubServer, send
+
+
+def concept(concept_id):
+    return {'id': str(concept_id), 'concept_class': 'Diagnosis', 'datatype': 'N/A'}
+
+
+def mapping(mapping_id):
+    return {'id': 'm%d' % mapping_id, 'map_type': 'SAME-AS', 'from_concept_code': '1'}
+
+
+class BulkImportApi(object):
+    """
+    Stub bulk import endpoint: a POST queues its records as a task, which is PENDING for the
+    first pending_polls polls and then succeeds, or fails if it holds a record in fail_ids.
+    Responses with the status codes in faults are sent first.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.faults = []
+        self.fail_ids = set()
+        self.pending_polls = 1
+        # ('post', task, records) and ('done', task, records) in the order they happened
+        self.events = []
+        self.tokens = set()
+
+    def __call__(self, request):
+        with self.lock:
+            self.tokens.add(request.headers.get('Authorization'))
+            if self.faults:
+                send(request, self.faults.pop(0), 'Server busy')
+                return
+            if request.command == 'POST':
+                records = [json.loads(line) for line in request.body.splitlines()]
+                task = 'task-%d' % (len(self.tasks) + 1)
+                self.tasks[task] = {'records': records, 'polls': 0}
+                self.events.append(('post', task, records))
+                send(request, 202, {'task': task})
+                return
+            task = self.tasks.get(request.query.get('task'))
+            if task is None:
+                send(request, 404, {'detail': 'Not found'})
+                return
+            task['polls'] += 1
+            if task['polls'] <= self.pending_polls:
+                send(request, 202, {'state': 'PENDING'})
+            elif any(record['id'] in self.fail_ids for record in task['records']):
+                send(request, 200, {'state': 'FAILURE', 'result': 'bad record'})
+            else:
+                self.events.append(('done', request.query['task'], task['records']))
+                send(request, 200, {'state': 'SUCCESS', 'result': 'imported'})
+
+    def posted_ids(self):
+        return [[record['id'] for record in records] for event, task, records in self.events if event == 'post']
+
+
+class UploadTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.api = BulkImportApi()
+        self.server = StubServer(self.api)
+        self.addCleanup(self.server.stop)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.state_filename = os.path.join(self.directory, 'state.json')
+
+
+class BulkImporterTest(UploadTestCase):
+
+    def make_importer(self, **kwargs):
+        return BulkImporter(self.server.url, 'secret', UploadState(self.state_filename), poll_interval=0.01,
+                            retry_delay=0.01, verbosity=0, **kwargs)
+
+    def test_chunk_is_submitted_and_its_task_polled(self):
+        chunk = Chunk('concepts-1', [json.dumps(concept(1)), json.dumps(concept(2))])
+        outcome = self.make_importer().upload(chunk)
+        self.assertEqual((outcome['state'], outcome['records'], outcome['error']), (SUCCESS, 2, None))
+        self.assertEqual([method for method, path, byte_range in self.server.requests], ['POST', 'GET', 'GET'])
+        self.assertTrue(self.server.requests[0][1].startswith('/importers/bulk-import/?'))
+        self.assertEqual(self.api.tokens, set(['Token secret']))
+        saved = UploadState(self.state_filename).get(chunk)
+        self.assertEqual((saved['task'], saved['state']), ('task-1', SUCCESS))
+
+    def test_server_errors_and_rate_limits_are_retried(self):
+        self.api.faults = [503, 429, 502]
+        importer = self.make_importer()
+        outcome = importer.upload(Chunk('concepts-1', [json.dumps(concept(1))]))
+        self.assertEqual(outcome['state'], SUCCESS)
+        self.assertEqual(importer.cnt_retries, 3)
+
+    def test_request_fails_once_retries_are_used_up(self):
+        self.api.faults = [500, 500, 500]
+        outcome = self.make_importer(max_retries=2).upload(Chunk('concepts-1', [json.dumps(concept(1))]))
+        self.assertEqual(outcome['state'], FAILURE)
+        self.assertIn('failed after 2 retries', outcome['error'])
+
+    def test_failed_task_is_reported(self):
+        self.api.fail_ids = set(['2'])
+        chunk = Chunk('concepts-1', [json.dumps(concept(1)), json.dumps(concept(2))])
+        outcome = self.make_importer().upload(chunk)
+        self.assertEqual(outcome['state'], FAILURE)
+        self.assertIn('bad record', outcome['error'])
+        self.assertEqual(UploadState(self.state_filename).get(chunk)['state'], FAILURE)
+
+    def test_upload_resumes_from_the_state_file(self):
+        imported = Chunk('concepts-1', [json.dumps(concept(1))])
+        failed = Chunk('concepts-2', [json.dumps(concept(2))])
+        running = Chunk('concepts-3', [json.dumps(concept(3))])
+        self.api.fail_ids = set(['2'])
+        importer = self.make_importer()
+        self.assertEqual(importer.upload(imported)['state'], SUCCESS)
+        self.assertEqual(importer.upload(failed)['state'], FAILURE)
+        # An interrupted run leaves a task that was posted but not seen to finish
+        self.api.tasks['task-running'] = {'records': [concept(3)], 'polls': 0}
+        importer.state.update(running, task='task-running', state='PENDING')
+
+        self.api.fail_ids = set()
+        del self.api.events[:]
+        importer = self.make_importer()
+        outcomes = [importer.upload(chunk) for chunk in (imported, failed, running)]
+        self.assertEqual([(outcome['state'], outcome['skipped']) for outcome in outcomes],
+                         [(SUCCESS, True), (SUCCESS, False), (SUCCESS, False)])
+        # Only the failed chunk is posted again; the running task is polled to completion
+        self.assertEqual(self.api.posted_ids(), [['2']])
+        self.assertIn(('done', 'task-running', [concept(3)]), self.api.events)
+
+    def test_changed_chunk_is_not_skipped(self):
+        importer = self.make_importer()
+        importer.upload(Chunk('concepts-1', [json.dumps(concept(1))]))
+        outcome = self.make_importer().upload(Chunk('concepts-1', [json.dumps(concept(5))]))
+        self.assertFalse(outcome['skipped'])
+        self.assertEqual(self.api.posted_ids(), [['1'], ['5']])
+
+
+class UploadCommandTest(UploadTestCase):
+
+    def write_records(self, records):
+        filename = os.path.join(self.directory, 'export.json')
+        with open(filename, 'w') as fp:
+            for record in records:
+                fp.write(json.dumps(record) + '\n')
+        return filename
+
+    def upload(self, filename, **options):
+        options.setdefault('token', 'secret')
+        call_command('upload_ocl', upload_filename=filename, api_url=self.server.url, chunk_size=2,
+                     concurrency=3, poll_interval=0.01, verbosity=0, **options)
+
+    def test_concepts_are_imported_before_mappings_are_posted(self):
+        # Concepts and mappings interleaved, as in a shard of extract_db
+        records = []
+        for number in range(1, 6):
+            records += [concept(number), mapping(number)]
+        self.api.pending_polls = 3
+        self.upload(self.write_records(records))
+
+        # Chunks of a phase are posted concurrently, in any order
+        self.assertEqual(sorted(self.api.posted_ids()), [['1', '2'], ['3', '4'], ['5'], ['m1', 'm2'], ['m3', 'm4'], ['m5']])
+        first_mapping_post = min(index for index, (event, task, chunk_records) in enumerate(self.api.events)
+                                 if event == 'post' and 'map_type' in chunk_records[0])
+        last_concept_done = max(index for index, (event, task, chunk_records) in enumerate(self.api.events)
+                                if event == 'done' and 'concept_class' in chunk_records[0])
+        self.assertGreater(first_mapping_post, last_concept_done)
+
+    def test_mappings_are_not_posted_after_a_failed_concept_chunk(self):
+        self.api.fail_ids = set(['3'])
+        with self.assertRaisesRegexp(CommandError, '1 chunks failed to upload: concepts-2'):
+            self.upload(self.write_records([concept(1), concept(2), concept(3), mapping(1)]),
+                        state_filename=self.state_filename)
+        self.assertEqual(sorted(self.api.posted_ids()), [['1', '2'], ['3']])
+
+        # Running the command again posts only the failed chunk, then the mappings
+        self.api.fail_ids = set()
+        self.upload(self.write_records([concept(1), concept(2), concept(3), mapping(1)]),
+                    state_filename=self.state_filename)
+        self.assertEqual(self.api.posted_ids()[2:], [['3'], ['m1']])
+
+    def test_token_defaults_to_the_setting(self):
+        with override_settings(OCL_API_TOKEN='from-settings'):
+            self.upload(self.write_records([concept(1)]), token=None)
+        self.assertEqual(self.api.tokens, set(['Token from-settings']))
+
+    def test_token_is_required(self):
+        with override_settings(OCL_API_TOKEN=None):
+            with self.assertRaisesRegexp(CommandError, 'OCL_API_TOKEN'):
+                self.upload(self.write_records([concept(1)]), token=None)
@@ -0,0 +1,74 @@
+"""
+Tests for sync_terms against a concept dictionary in a SQLite test database.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.core.management import CommandError, call_command
+
+from omrs.models import ConceptMapType, ConceptReferenceSource, ConceptReferenceTerm, ConceptReferenceTermMap
+from omrs.reference_terms import TERM_MAP_TYPE, TERM_TYPE
+from omrs.tests.dictionary import create_dictionary_tables, insert
+
+
+def term(source, code):
+    return {'type': TERM_TYPE, 'source': source, 'code': code, 'name': 'Term %s' % code}
+
+
+def term_map(from_source, from_code, to_source, to_code):
+    return {'type': TERM_MAP_TYPE, 'from_source': from_source, 'from_code': from_code,
+            'to_source': to_source, 'to_code': to_code, 'map_type': 'SAME-AS'}
+
+
+class SyncTermsTest(unittest.TestCase):
+
+    def setUp(self):
+        create_dictionary_tables()
+        insert(ConceptReferenceSource, concept_source_id=1, name='ICD-10-WHO', description='', retired=0)
+        insert(ConceptReferenceSource, concept_source_id=2, name='SNOMED CT', description='', retired=0)
+        insert(ConceptMapType, concept_map_type_id=1, name='SAME-AS')
+        insert(ConceptReferenceTerm, concept_reference_term_id=1, concept_source_id=1, code='A00', retired=0)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def sync(self, records, **options):
+        filename = os.path.join(self.directory, 'terms.json')
+        with open(filename, 'w') as fp:
+            for record in records:
+                fp.write(json.dumps(record) + '\n')
+        call_command('sync_terms', term_filename=filename, verbosity=0, **options)
+
+    def terms(self):
+        return sorted(ConceptReferenceTerm.objects.values_list('concept_source_id', 'code'))
+
+    def term_maps(self):
+        codes = dict(ConceptReferenceTerm.objects.values_list('concept_reference_term_id', 'code'))
+        return sorted((codes[term_a_id], codes[term_b_id])
+                      for term_a_id, term_b_id in ConceptReferenceTermMap.objects.values_list('term_a_id', 'term_b_id'))
+
+    def test_term_maps_to_terms_later_in_the_file_are_synced(self):
+        # As written by extract_terms: each source's terms, then the maps from them
+        self.sync([
+            term('ICD-10-WHO', 'A00'), term('ICD-10-WHO', 'A01'), term('ICD-10-WHO', 'A01'),
+            term_map('ICD-10-WHO', 'A00', 'SNOMED CT', '100'),
+            term_map('ICD-10-WHO', 'A01', 'SNOMED CT', '200'),
+            term('SNOMED CT', '100'), term('SNOMED CT', '200'),
+            term_map('SNOMED CT', '100', 'ICD-10-WHO', 'A00'),
+            term('LOINC', '1-8'), term_map('LOINC', '1-8', 'SNOMED CT', '100'),
+        ])
+        self.assertEqual(self.terms(), [(1, 'A00'), (1, 'A01'), (2, '100'), (2, '200')])
+        self.assertEqual(self.term_maps(), [('100', 'A00'), ('A00', '100'), ('A01', '200')])
+
+    def test_sources_option_limits_the_sync(self):
+        self.sync([term('ICD-10-WHO', 'A01'), term_map('ICD-10-WHO', 'A01', 'ICD-10-WHO', 'A00'),
+                   term('SNOMED CT', '100'), term_map('SNOMED CT', '100', 'ICD-10-WHO', 'A00')],
+                  source_names='SNOMED CT')
+        self.assertEqual(self.terms(), [(1, 'A00'), (2, '100')])
+        self.assertEqual(self.term_maps(), [('100', 'A00')])
+
+    def test_other_files_are_rejected(self):
+        with self.assertRaisesRegexp(CommandError, 'not a reference term file'):
+            self.sync([{'id': '1', 'concept_class': 'Diagnosis'}])
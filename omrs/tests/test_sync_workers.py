@@ -0,0 +1,95 @@
+"""
+Tests for the worker processes of sync_bahmni_db --workers.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.core.management import CommandError
+
+from omrs.management.commands.sync_bahmni_db import Command
+from omrs.progress import ProgressReporter
+from omrs.retry import Retrier
+
+
+def make_command(workers):
+    command = Command()
+    command.workers = workers
+    command.progress = ProgressReporter('sync_bahmni_db')
+    command.retrier = Retrier(verbosity=0)
+    command.progress_queue = None
+    command.id_ranges = {}
+    command.next_ids = {}
+    command.id_limits = {}
+    command.concepts_id_added = {}
+    command.rejected_mappings = []
+    for counter in Command.WORKER_COUNTERS:
+        setattr(command, counter, 0)
+    return command
+
+
+class RunPartitionsTest(unittest.TestCase):
+
+    def test_merges_worker_results(self):
+        command = make_command(3)
+        status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, status_dir)
+        command.progress = ProgressReporter('sync_bahmni_db', status_filename=os.path.join(status_dir, 'status.json'))
+        command.progress.start_phase('mappings')
+
+        def target(partition):
+            command.cnt_mappings_synced += len(partition)
+            command.report_progress(len(partition))
+        command.run_partitions(target, [[1, 2], [3], [4, 5, 6]])
+        self.assertEqual(command.cnt_mappings_synced, 6)
+        self.assertEqual(command.progress.phases['mappings']['processed'], 6)
+
+    def test_worker_exception_is_reported(self):
+        command = make_command(2)
+
+        def target(partition):
+            if partition == ['bad']:
+                raise ValueError('broken record')
+        with self.assertRaisesRegexp(CommandError, 'broken record'):
+            command.run_partitions(target, [['good'], ['bad']])
+
+    def test_dead_worker_is_reported(self):
+        command = make_command(2)
+        command.WORKER_POLL_INTERVAL = 0.2
+
+        def target(partition):
+            if partition == ['killed']:
+                os._exit(9)
+        with self.assertRaisesRegexp(CommandError, 'partition 1 exited with code 9'):
+            command.run_partitions(target, [['good'], ['killed']])
+
+
+def ocl_concept(concept_id, *names):
+    return {'id': concept_id, 'external_id': 'concept-%d' % concept_id, 'concept_class': 'Diagnosis',
+            'datatype': 'N/A', 'retired': False, 'descriptions': [], 'extras': {},
+            'names': [{'name': name, 'external_id': 'name-%d-%d' % (concept_id, number), 'name_type': name_type,
+                       'locale': 'en', 'locale_preferred': name_type == 'FULLY_SPECIFIED', 'voided': False}
+                      for number, (name, name_type) in enumerate(names)]}
+
+
+class PartitionConceptsTest(unittest.TestCase):
+
+    def test_concepts_sharing_a_name_go_to_one_worker(self):
+        concepts = [
+            ocl_concept(1, ('Malaria', 'FULLY_SPECIFIED')),
+            # Goes to the other worker by ID, but is matched to concept 1 by its name
+            ocl_concept(2, ('Malaria', 'FULLY_SPECIFIED'), ('Paludism', 'SYNONYM')),
+            # Linked to concepts 1 and 2 through the synonym of concept 2, whatever its case
+            ocl_concept(7, ('paludism ', 'SYNONYM')),
+            ocl_concept(3, ('Fever', 'FULLY_SPECIFIED')),
+            ocl_concept(4, ('Cough', 'FULLY_SPECIFIED')),
+        ]
+        command = make_command(2)
+        command.create_concept_classes_and_datatypes = lambda concepts: None
+        command.reserve_id_ranges = lambda *args, **kwargs: None
+        partitions = []
+        command.run_partitions = lambda target, concept_partitions: partitions.extend(concept_partitions)
+        command.sync_concepts(concepts)
+        # Each worker syncs its concepts in file order, so concept 2 matches concept 1 as in a sequential sync
+        self.assertEqual([[concept['id'] for concept in partition] for partition in partitions], [[4], [1, 2, 7, 3]])
@@ -0,0 +1,77 @@
+"""
+Tests for validate_export against a concept dictionary in a SQLite test database.
+"""
+from StringIO import StringIO
+import sys
+import unittest
+
+from omrs.management.commands.validate_export import Command
+from omrs.models import (Concept, ConceptAnswer, ConceptMapType, ConceptReferenceMap, ConceptReferenceSource,
+                         ConceptReferenceTerm, ConceptSet)
+from omrs.progress import ProgressReporter
+from omrs.tests.dictionary import create_dictionary_tables, insert
+
+
+def ocl_mapping(mapping_id, map_type, from_concept_code, to_source_name, to_concept_code, retired=False):
+    return {'id': mapping_id, 'map_type': map_type, 'from_concept_code': from_concept_code,
+            'to_source_name': to_source_name, 'to_concept_code': to_concept_code, 'retired': retired}
+
+
+class ValidateExportTest(unittest.TestCase):
+
+    def setUp(self):
+        create_dictionary_tables()
+        for concept_id in range(1, 6):
+            insert(Concept, concept_id=concept_id)
+        insert(ConceptReferenceSource, concept_source_id=1, name='SNOMED CT')
+        insert(ConceptMapType, concept_map_type_id=1, name='SAME-AS')
+        insert(ConceptReferenceTerm, concept_reference_term_id=1, concept_source_id=1, code='A00.0')
+        insert(ConceptReferenceTerm, concept_reference_term_id=2, concept_source_id=1, code='12345')
+        insert(ConceptReferenceMap, concept_map_id=10, concept_id=1, concept_reference_term_id=1, map_type_id=1)
+        insert(ConceptReferenceMap, concept_map_id=11, concept_id=2, concept_reference_term_id=2, map_type_id=1)
+        insert(ConceptReferenceMap, concept_map_id=12, concept_id=5, concept_reference_term_id=2, map_type_id=1)
+        insert(ConceptAnswer, concept_answer_id=20, question_concept_id=1, answer_concept_id=2)
+        insert(ConceptSet, concept_set_id=30, concept_set_owner_id=3, concept_id=4)
+
+        self.command = Command()
+        self.command.verbosity = 0
+        self.command.ignore_retired_mappings = False
+        self.command.progress = ProgressReporter('validate_export')
+
+    def run_validation(self, method, data):
+        stdout = sys.stdout
+        sys.stdout = output = StringIO()
+        try:
+            getattr(self.command, method)(data)
+        finally:
+            sys.stdout = stdout
+        return output.getvalue()
+
+    def test_mappings_match_by_integer_id_and_case_insensitive_code(self):
+        self.run_validation('validate_mappings', {'mappings': [
+            # Codes differing in case and numeric codes written as integers match, like MySQL's .get()
+            ocl_mapping('m1', 'same-as', '1', 'SNOMED-CT', 'a00.0'),
+            ocl_mapping('m2', 'SAME-AS', 2, 'SNOMED-CT', 12345),
+            ocl_mapping('m3', 'Q-AND-A', 1, 'CIEL', '2'),
+            ocl_mapping('m4', 'CONCEPT-SET', '3', 'CIEL', 4),
+            ocl_mapping('m5', 'SAME-AS', '4', 'SNOMED-CT', 'B99'),
+        ]})
+        self.assertEqual(list(self.command.refmap_comparison[Command.MISSING_IN_OCL]), [12])
+        self.assertEqual(self.command.refmap_comparison[Command.MISSING_IN_MYSQL], ['m5'])
+        self.assertEqual(list(self.command.qanda_comparison[Command.MISSING_IN_OCL]), [])
+        self.assertEqual(self.command.qanda_comparison[Command.MISSING_IN_MYSQL], [])
+        self.assertEqual(list(self.command.conceptset_comparison[Command.MISSING_IN_OCL]), [])
+        self.assertEqual(self.command.conceptset_comparison[Command.MISSING_IN_MYSQL], [])
+
+    def test_duplicate_concepts_missing_in_mysql_are_found_by_integer_id(self):
+        # extract_db writes concept IDs as integers
+        output = self.run_validation('validate_concepts', {'concepts': [
+            {'id': concept_id} for concept_id in (1, 2, 3, 4, 5, 7, 7, u'8', 'X1', 'X1', 'X2')]})
+        self.assertIn('7: 2 duplicates found in export file', output)
+        self.assertIn('X1: 2 duplicates found in export file', output)
+        self.assertNotIn('No duplicates found', output)
+
+    def test_outlying_concept_ids_are_not_kept_in_a_bitmap(self):
+        output = self.run_validation('validate_concepts', {'concepts': [
+            {'id': concept_id} for concept_id in (1, 2, 3, 4, 5, 7, 10 ** 9, '271649006000000', 'X1')]})
+        self.assertIn("['7', '1000000000', '271649006000000', 'X1']", output)
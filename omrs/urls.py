@@ -6,4 +6,11 @@ admin.autodiscover()
 urlpatterns = patterns(
     '',
     url(r'^admin/', include(admin.site.urls)),
+
+    # Read-only concept lookup API
+    url(r'^api/concepts/$', 'omrs.views.concept_multi_get'),
+    url(r'^api/concepts/uuid/(?P<uuid>[\w-]+)/$', 'omrs.views.concept_by_uuid'),
+    url(r'^api/concepts/(?P<concept_id>\d+)/$', 'omrs.views.concept_detail'),
+    url(r'^api/concepts/(?P<concept_id>\d+)/mappings/$', 'omrs.views.concept_mappings'),
+    url(r'^api/concepts/(?P<concept_id>\d+)/set_members/$', 'omrs.views.concept_set_members'),
 )
@@ -0,0 +1,99 @@
+"""
+Read-only JSON endpoints for concept lookups, served from ConceptLookupService.
+
+    GET /api/concepts/5839/                 concept in the OCL export format
+    GET /api/concepts/uuid/<uuid>/          concept by uuid
+    GET /api/concepts/5839/mappings/        mappings and linked answers of a concept
+    GET /api/concepts/5839/set_members/     set members of a concept
+    GET /api/concepts/?ids=5839,1065        multi-get: {"results": [...], "missing": [...]}
+
+Every response carries an ETag; a request whose If-None-Match matches it gets an empty 304.
+"""
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound
+from django.views.decorators.http import require_GET
+
+from omrs.concept_service import (CONCEPT_DOCUMENT, MAPPINGS_DOCUMENT, SET_MEMBERS_DOCUMENT,
+                                  ConceptLookupService, make_etag)
+
+
+# Maximum number of concepts in one multi-get request
+MAX_MULTI_GET = 1000
+
+# One service, and so one cache, per WSGI worker process
+service = ConceptLookupService(settings.OMRS_API_ORG_ID, settings.OMRS_API_SOURCE_ID,
+                               settings.OMRS_API_CACHE_SIZE, settings.OMRS_API_CACHE_TTL)
+
+
+def parse_ids_parameter(value):
+    """ Returns the distinct integer IDs of a comma-separated parameter, in order """
+    concept_ids = []
+    seen = set()
+    for token in value.split(','):
+        if token.strip():
+            concept_id = int(token)
+            if concept_id not in seen:
+                seen.add(concept_id)
+                concept_ids.append(concept_id)
+    return concept_ids
+
+
+def json_response(request, body, etag):
+    """ Returns a JSON response, or 304 Not Modified if the client has the current version """
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    return response
+
+
+def document_response(request, concept_id, document):
+    documents = service.get(concept_id)
+    if documents is None:
+        return HttpResponseNotFound('Concept %s not found' % concept_id)
+    body, etag = documents[document]
+    return json_response(request, body, etag)
+
+
+@require_GET
+def concept_detail(request, concept_id):
+    return document_response(request, int(concept_id), CONCEPT_DOCUMENT)
+
+
+@require_GET
+def concept_by_uuid(request, uuid):
+    concept_id = service.get_concept_id_for_uuid(uuid)
+    if concept_id is None:
+        return HttpResponseNotFound('Concept %s not found' % uuid)
+    return document_response(request, concept_id, CONCEPT_DOCUMENT)
+
+
+@require_GET
+def concept_mappings(request, concept_id):
+    return document_response(request, int(concept_id), MAPPINGS_DOCUMENT)
+
+
+@require_GET
+def concept_set_members(request, concept_id):
+    return document_response(request, int(concept_id), SET_MEMBERS_DOCUMENT)
+
+
+@require_GET
+def concept_multi_get(request):
+    """ Returns the concepts listed in the comma-separated 'ids' parameter, in that order """
+    try:
+        concept_ids = parse_ids_parameter(request.GET.get('ids', ''))
+    except ValueError as e:
+        return HttpResponseBadRequest('Invalid concept ID: %s' % e)
+    if not concept_ids:
+        return HttpResponseBadRequest('The ids parameter is required')
+    if len(concept_ids) > MAX_MULTI_GET:
+        return HttpResponseBadRequest('At most %d concepts can be requested at once' % MAX_MULTI_GET)
+
+    found = service.get_many(concept_ids)
+    # The cached concept JSON is spliced in as is rather than decoded and re-encoded
+    results = [found[concept_id][CONCEPT_DOCUMENT][0] for concept_id in concept_ids if concept_id in found]
+    missing = [str(concept_id) for concept_id in concept_ids if concept_id not in found]
+    body = '{"results": [%s], "missing": [%s]}' % (', '.join(results), ', '.join(missing))
+    return json_response(request, body, make_etag(body))
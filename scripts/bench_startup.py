@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Benchmark the startup cost of the omrs management commands.
+
+Runs a real, cheap invocation repeatedly under the full settings profile and the minimal
+command-line profile and prints the mean and best wall-clock time of each: diff_export of two
+tiny exports written to a temporary directory, which loads the settings, the installed apps
+and the command module and runs the command without touching the database. ('--help' stops
+before the installed apps are loaded, so it does not show the difference.)
+
+    python scripts/bench_startup.py [--runs=20] [--sqlite]
+
+Loading the full profile opens the database backend. With --sqlite, both profiles are run with
+their databases switched to SQLite, for hosts without the MySQL driver.
+"""
+from optparse import OptionParser
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MANAGE_PY = os.path.join(BASE_DIR, 'manage.py')
+PROFILES = ['omrs.settings', 'omrs.settings_cli']
+
+SQLITE_SETTINGS = """from %s import *
+
+DATABASES = dict((alias, dict(database, ENGINE='django.db.backends.sqlite3', NAME=%r))
+                 for alias, database in DATABASES.items())
+"""
+
+
+def write_export(filename, concept_ids):
+    """ Writes a JSON-lines export of a few minimal concepts """
+    with open(filename, 'w') as fp:
+        for concept_id in concept_ids:
+            fp.write(json.dumps({'id': concept_id, 'concept_class': 'Diagnosis', 'datatype': 'N/A',
+                                 'names': [{'name': 'Concept %d' % concept_id}]}) + '\n')
+
+
+def write_sqlite_settings(directory, settings_module):
+    """ Writes a settings module that switches the databases of settings_module to SQLite and returns its name """
+    name = 'bench_' + settings_module.replace('.', '_')
+    with open(os.path.join(directory, name + '.py'), 'w') as fp:
+        fp.write(SQLITE_SETTINGS % (settings_module, os.path.join(directory, 'bench.sqlite3')))
+    return name
+
+
+def time_invocation(args, settings_module, python_path=None):
+    """ Returns the wall-clock seconds taken by one 'manage.py ARGS' run """
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+    if python_path:
+        env['PYTHONPATH'] = os.pathsep.join([python_path, BASE_DIR, env.get('PYTHONPATH', '')])
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable, MANAGE_PY] + args, env=env, stdout=devnull, stderr=devnull)
+        return time.time() - start
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--runs', dest='runs', type='int', default=20,
+                      help='Number of invocations per settings profile')
+    parser.add_option('--sqlite', dest='sqlite', action='store_true', default=False,
+                      help='Run both profiles with SQLite databases')
+    options, args = parser.parse_args()
+
+    fixture_dir = tempfile.mkdtemp(prefix='bench-startup-')
+    try:
+        old_filename = os.path.join(fixture_dir, 'old.json')
+        new_filename = os.path.join(fixture_dir, 'new.json')
+        write_export(old_filename, [1, 2, 3])
+        write_export(new_filename, [2, 3, 4])
+        args = ['diff_export', '--old=%s' % old_filename, '--new=%s' % new_filename,
+                '--temp_dir=%s' % fixture_dir, '-v0']
+
+        print 'Startup time for "manage.py diff_export" of two 3-concept exports over %d runs:' % options.runs
+        for settings_module in PROFILES:
+            if options.sqlite:
+                run_module, python_path = write_sqlite_settings(fixture_dir, settings_module), fixture_dir
+            else:
+                run_module, python_path = settings_module, None
+            timings = [time_invocation(args, run_module, python_path) for _ in range(options.runs)]
+            print '%-20s mean %.3fs  best %.3fs' % (settings_module, sum(timings) / len(timings), min(timings))
+    finally:
+        shutil.rmtree(fixture_dir)
+
+
+if __name__ == '__main__':
+    main()